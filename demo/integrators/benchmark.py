@@ -0,0 +1,105 @@
+# Compares the integrators in verse.analysis.integrators against the scipy based simulation used
+# before: a new `scipy.integrate.ode` per time step (the old CarAgent.TC_simulate) and one `odeint`
+# call per trajectory (BaseAgent.TC_simulate).
+
+import time
+
+import numpy as np
+from scipy.integrate import ode, odeint, solve_ivp
+
+from verse.agents.example_agent import CarAgent
+from verse.analysis.integrators import Integrator, simulate
+
+TIME_BOUND = 20
+TIME_STEP = 0.05
+NUM_TRACES = 32
+
+
+def control(state):
+    # Steer towards the x axis; constant over each time step like `action_handler`
+    y, theta = state[1], state[2]
+    steering = np.clip(-theta - 0.3 * y, -0.61, 0.61)
+    return steering, np.zeros_like(steering)
+
+
+def scipy_ode_per_step(init):
+    num_points = int(np.ceil(TIME_BOUND / TIME_STEP))
+    trace = np.zeros((num_points + 1, 1 + len(init)))
+    trace[0, 1:] = init
+    for i in range(num_points):
+        r = ode(CarAgent.dynamic)
+        r.set_initial_value(init).set_f_params(control(np.array(init)))
+        init = r.integrate(r.t + TIME_STEP).flatten()
+        trace[i + 1, 0] = TIME_STEP * (i + 1)
+        trace[i + 1, 1:] = init
+    return trace
+
+
+def scipy_odeint_per_trace(init):
+    # odeint can't hold the control constant over a step, so the control is applied continuously
+    t = np.round(np.arange(0.0, TIME_BOUND + TIME_STEP / 2, TIME_STEP), 8)
+    sol = odeint(lambda y, t: CarAgent.dynamic(t, y, control(y)), init, t)
+    return np.hstack((t.reshape(-1, 1), sol))
+
+
+def reference(init):
+    # Tight tolerance solution with the same piecewise constant control
+    num_points = int(np.ceil(TIME_BOUND / TIME_STEP))
+    trace = np.zeros((num_points + 1, 1 + len(init)))
+    trace[0, 1:] = init
+    state = np.array(init, dtype=float)
+    for i in range(num_points):
+        u = control(state)
+        sol = solve_ivp(CarAgent.dynamic, (0, TIME_STEP), state, args=(u,), rtol=1e-12, atol=1e-12)
+        state = sol.y[:, -1]
+        trace[i + 1, 0] = TIME_STEP * (i + 1)
+        trace[i + 1, 1:] = state
+    return trace
+
+
+def timed(f):
+    start = time.perf_counter()
+    res = f()
+    return time.perf_counter() - start, res
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    inits = np.column_stack(
+        (
+            np.zeros(NUM_TRACES),
+            rng.uniform(-2, 2, NUM_TRACES),
+            rng.uniform(-0.5, 0.5, NUM_TRACES),
+            rng.uniform(1, 3, NUM_TRACES),
+        )
+    )
+    refs = np.stack([reference(init) for init in inits])
+
+    runs = {
+        "scipy ode per step": lambda: np.stack([scipy_ode_per_step(init) for init in inits]),
+        "scipy odeint per trace*": lambda: np.stack(
+            [scipy_odeint_per_trace(init) for init in inits]
+        ),
+    }
+    for method in Integrator:
+        for adaptive in (False, True):
+            name = f"{method.name} {'adaptive' if adaptive else 'fixed'}"
+            runs[f"{name} per trace"] = lambda method=method, adaptive=adaptive: np.stack(
+                [
+                    simulate(
+                        CarAgent.dynamic, control, init, TIME_BOUND, TIME_STEP, method, adaptive
+                    )
+                    for init in inits
+                ]
+            )
+            runs[f"{name} batched"] = lambda method=method, adaptive=adaptive: simulate(
+                CarAgent.dynamic, control, inits, TIME_BOUND, TIME_STEP, method, adaptive
+            )
+
+    print(f"{NUM_TRACES} traces, {int(np.ceil(TIME_BOUND / TIME_STEP))} steps each")
+    print(f"{'method':<28}{'time (s)':>10}{'max error':>12}")
+    for name, run in runs.items():
+        duration, traces = timed(run)
+        error = np.max(np.abs(traces[:, :, 1:] - refs[:, :, 1:]))
+        print(f"{name:<28}{duration:>10.4f}{error:>12.2e}")
+    print("* continuous control, so its error also includes the difference in control")
@@ -9,8 +9,9 @@ import os
 class BallMode(Enum):
     Normal = auto()
 
-def ball_bounce_test():
-    bouncingBall = Scenario(ScenarioConfig(parallel=True, print_level=2))  # scenario too small, parallel too slow
+def ball_bounce_scenario(**config) -> Scenario:
+    config.setdefault("parallel", False)
+    bouncingBall = Scenario(ScenarioConfig(**config))
     script_dir = os.path.realpath(os.path.dirname(__file__))
     ball_controller = os.path.join(script_dir, './test_controller/ball_controller.py')
     ball_controller2 = os.path.join(script_dir, './test_controller/ball_controller2.py')
@@ -22,6 +23,10 @@ def ball_bounce_test():
         [[[5, 10, 2, 2], [5, 10, 2, 2]], [[15, 1, 1, -2], [15, 1, 1, -2]]],
         [(BallMode.Normal,), (BallMode.Normal,)],
     )
+    return bouncingBall
+
+def ball_bounce_test():
+    bouncingBall = ball_bounce_scenario(parallel=True, print_level=2)  # scenario too small, parallel too slow
     # TODO: WE should be able to initialize each of the balls separately
     # this may be the cause for the VisibleDeprecationWarning
     # TODO: Longer term: We should initialize by writing expressions like "-2 \leq myball1.x \leq 5"
@@ -50,11 +50,12 @@ class State:
         pass
 
 
-def highway_test():
+def highway_scenario(**config) -> Scenario:
     script_dir = os.path.realpath(os.path.dirname(__file__))
     input_code_name = os.path.join(script_dir, "./test_controller/example_controller5.py")
 
-    scenario = Scenario(ScenarioConfig(parallel=False))
+    config.setdefault("parallel", False)
+    scenario = Scenario(ScenarioConfig(**config))
     car = CarAgent("car1", file_name=input_code_name)
     scenario.add_agent(car)
     car = NPCAgent("car2")
@@ -75,6 +76,11 @@ def highway_test():
             (AgentMode.Normal, TrackMode.T0),
         ],
     )
+    return scenario
+
+
+def highway_test():
+    scenario = highway_scenario()
     time_step = 0.1
     traces_sim = scenario.simulate(40, time_step)
     traces_veri = scenario.verify(40, time_step, params={"bloating_method": "GLOBAL"})
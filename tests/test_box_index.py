@@ -0,0 +1,89 @@
+# Tests for the index of boxes used by the incremental caches, checked against a linear scan
+import random
+import unittest
+import numpy as np
+from verse.analysis.box_index import BoxIndex, _PackedKDTree
+
+
+class SmallBoxIndex(BoxIndex):
+    # Small buffers, so that a few hundred boxes fill several trees and trigger rebuilds
+    BUFFER_SIZE = 4
+
+
+def random_box(rng, dims):
+    # Integer bounds on a small grid, so that boxes often contain each other or share bounds
+    lower = [rng.randint(0, 6) for _ in range(dims)]
+    return lower, [low + rng.randint(0, 4) for low in lower]
+
+
+def as_lists(entries):
+    return [(lower.tolist(), upper.tolist(), data) for lower, upper, data in entries]
+
+
+class TestBoxIndex(unittest.TestCase):
+    def assertMatchesScan(self, index, boxes, lower, upper):
+        '''
+        Check `containing` and iteration against a linear scan over `boxes`, which maps handles
+        to the boxes that weren't removed
+        '''
+        expected = [
+            (box_lower, box_upper, data)
+            for box_lower, box_upper, data in boxes.values()
+            if all(bl <= l for bl, l in zip(box_lower, lower))
+            and all(bu >= u for bu, u in zip(box_upper, upper))
+        ]
+        self.assertEqual(as_lists(index.containing(lower, upper)), expected)
+        self.assertEqual(as_lists(index), list(boxes.values()))
+        self.assertEqual(len(index), len(boxes))
+
+    def checkRandom(self, index_type, dims, steps, seed):
+        rng = random.Random(seed)
+        index, boxes = index_type(), {}
+        for step in range(steps):
+            if boxes and rng.random() < 0.3:
+                seq = rng.choice(list(boxes))
+                index.remove(seq)
+                del boxes[seq]
+            else:
+                lower, upper = random_box(rng, dims)
+                seq = index.add(lower, upper, step)
+                boxes[seq] = ([float(x) for x in lower], [float(x) for x in upper], step)
+            if step % 10 == 0:
+                self.assertMatchesScan(index, boxes, *random_box(rng, dims))
+        for _ in range(50):
+            self.assertMatchesScan(index, boxes, *random_box(rng, dims))
+
+    def testEmpty(self):
+        index = BoxIndex()
+        self.assertEqual(index.containing([0], [1]), [])
+        self.assertEqual(len(index), 0)
+
+    def testRandomSmallBuffers(self):
+        for dims, seed in [(1, 0), (2, 1), (3, 2)]:
+            self.checkRandom(SmallBoxIndex, dims, 400, seed)
+
+    def testRandom(self):
+        # Enough boxes to fill trees deeper than one leaf
+        self.checkRandom(BoxIndex, 2, 3000, 3)
+
+    def testRemoveAll(self):
+        index, boxes = SmallBoxIndex(), {}
+        seqs = [index.add([i], [i + 1], i) for i in range(20)]
+        for seq in seqs:
+            index.remove(seq)
+        self.assertMatchesScan(index, boxes, [0], [0])
+        seq = index.add([0], [1], "new")
+        self.assertNotIn(seq, seqs)
+        self.assertMatchesScan(index, {seq: ([0.0], [1.0], "new")}, [0.5], [0.5])
+
+    def testDominated(self):
+        rng = np.random.default_rng(0)
+        points = rng.integers(0, 10, (500, 3)).astype(float)
+        tree = _PackedKDTree(points, np.arange(500), list(range(500)))
+        for query in rng.integers(0, 10, (50, 3)).astype(float):
+            hits = sorted(tree.data[i] for i in tree.dominated(query))
+            self.assertEqual(hits, (points <= query).all(1).nonzero()[0].tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
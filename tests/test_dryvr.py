@@ -0,0 +1,59 @@
+# Tests for the sensitivities that DryVR bloats reachtubes with
+import unittest
+import numpy as np
+from scipy import spatial
+from verse.analysis.dryvr import _SMALL_EPSILON, all_sensitivities_calc
+
+
+def loop_sensitivities(training_traces, initial_radii):
+    '''
+    The sensitivities computed one dimension and time step at a time with `pdist`, as
+    `all_sensitivities_calc` did before it was vectorized
+    '''
+    num_traces, trace_len, ndims = training_traces.shape
+    radii = initial_radii.copy()
+    radii[radii == 0] = 1.0
+    y_points = np.zeros((len(radii), trace_len - 1))
+    initial_points = training_traces[:, 0, 1:] / radii
+    initial_distances = spatial.distance.pdist(initial_points, "chebyshev") + _SMALL_EPSILON
+    for dim in range(1, ndims):
+        for time in range(1, trace_len):
+            points = np.reshape(training_traces[:, time, dim], (num_traces, 1))
+            distances = spatial.distance.pdist(points, "chebyshev") / radii[dim - 1]
+            y_points[dim - 1, time - 1] = np.max(distances / initial_distances)
+    return y_points
+
+
+class TestSensitivities(unittest.TestCase):
+    def testRandomTraces(self):
+        '''
+        Test the vectorized sensitivities against the per-dimension, per-time-step loop on random
+        traces, with chunks that do and don't divide the time steps
+        '''
+        rng = np.random.default_rng(0)
+        for num_traces, trace_len, ndims in [(2, 2, 2), (3, 11, 3), (11, 50, 5), (5, 17, 4)]:
+            traces = rng.normal(size=(num_traces, trace_len, ndims))
+            traces[:, :, 0] = np.arange(trace_len) * 0.1
+            radii = rng.uniform(0, 2, ndims - 1)
+            # A dimension with a point initial set is normalized by 1
+            radii[0] = 0
+            expected = loop_sensitivities(traces, radii)
+            pairs = num_traces * (num_traces - 1) // 2
+            # One time step per chunk, chunks of 3 time steps, and a single chunk
+            for max_elements in [1, 3 * pairs * (ndims - 1), 1 << 22]:
+                res = all_sensitivities_calc(traces, radii, max_elements)
+                np.testing.assert_array_equal(res, expected)
+            # The radii of the caller are left as they were
+            self.assertEqual(radii[0], 0)
+
+    def testDuplicateInitialPoints(self):
+        # Traces from the same initial point are divided by the small epsilon only
+        traces = np.zeros((2, 3, 2))
+        traces[1, 1:, 1] = 1
+        res = all_sensitivities_calc(traces, np.array([1.0]), 1)
+        np.testing.assert_allclose(res, loop_sensitivities(traces, np.array([1.0])))
+        self.assertEqual(res[0, 0], 1 / _SMALL_EPSILON)
+
+
+if __name__ == "__main__":
+    unittest.main()
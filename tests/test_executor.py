@@ -0,0 +1,70 @@
+# Tests for the process backend of parallel simulation and verification
+import os
+import unittest
+from unittest import mock
+from verse.analysis import executor
+from verse.analysis.executor import ProcessExecutor, _SharedRef
+
+
+def scaled_sum(shared, scale):
+    return sum(shared["values"]) * scale
+
+
+class Unpicklable:
+    def __reduce__(self):
+        raise TypeError("can't pickle")
+
+
+class TestProcessExecutor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = ProcessExecutor(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def testSharedRef(self):
+        '''
+        Test that an object `put` once is passed to every task in place of its reference, and that
+        `release` removes its file
+        '''
+        ref = self.executor.put({"values": [1, 2, 3]})
+        self.assertIsInstance(ref, _SharedRef)
+        self.assertTrue(os.path.exists(ref.path))
+        handles = [self.executor.submit(scaled_sum, ref, scale) for scale in range(4)]
+        self.assertEqual([self.executor.get(handle) for handle in handles], [0, 6, 12, 18])
+        # Lambdas and closures go through cloudpickle
+        handle = self.executor.submit(lambda shared: len(shared["values"]), ref)
+        self.assertEqual(self.executor.get(handle), 3)
+        self.executor.release(ref)
+        self.assertFalse(os.path.exists(ref.path))
+        self.assertNotIn(ref.path, self.executor.shared_paths)
+
+    def testFailedPut(self):
+        # The file is removed when the object can't be written
+        paths = []
+        mkstemp = executor.tempfile.mkstemp
+
+        def recorded_mkstemp(*args, **kwargs):
+            fd, path = mkstemp(*args, **kwargs)
+            paths.append(path)
+            return fd, path
+
+        with mock.patch.object(executor.tempfile, "mkstemp", recorded_mkstemp):
+            with self.assertRaises(TypeError):
+                self.executor.put(Unpicklable())
+        self.assertEqual(len(paths), 1)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertEqual(self.executor.shared_paths, set())
+
+    def testShutdownReleases(self):
+        # Objects that weren't released, e.g. when a run fails, are removed on shutdown
+        process_executor = ProcessExecutor(1)
+        ref = process_executor.put([1, 2])
+        process_executor.shutdown()
+        self.assertFalse(os.path.exists(ref.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# Tests for the memory budget shared by the incremental caches
+import unittest
+import numpy as np
+from verse.analysis.incremental import CacheBudget, approx_size
+
+
+class RecordingCache:
+    def __init__(self):
+        self.evicted = []
+
+    def evict(self, key, seq):
+        self.evicted.append((key, seq))
+
+
+class TestCacheBudget(unittest.TestCase):
+    def testApproxSize(self):
+        arr = np.zeros(10)
+        self.assertEqual(approx_size(arr), 112 + 80)
+        self.assertEqual(approx_size([arr, arr]), 56 + 16 + 2 * (112 + 80))
+        self.assertEqual(approx_size({"a": 1}), 64 + 24 + 50 + 24)
+        self.assertEqual(approx_size(None), 0)
+
+    def testLRUOrder(self):
+        '''
+        Test that entries are evicted least recently used first, counting hits and updates as uses
+        '''
+        cache = RecordingCache()
+        entries = [np.zeros(10) for _ in range(5)]
+        size = approx_size(entries[0])
+        budget = CacheBudget(3 * size)
+        for i in range(3):
+            budget.add(cache, ("key",), i, entries[i])
+        self.assertEqual((cache.evicted, budget.evictions), ([], 0))
+        budget.touch(entries[0])
+        budget.add(cache, ("key",), 3, entries[3])
+        self.assertEqual(cache.evicted, [(("key",), 1)])
+        budget.add(cache, ("key",), 4, entries[4])
+        self.assertEqual(cache.evicted, [(("key",), 1), (("key",), 2)])
+        self.assertEqual(budget.evictions, 2)
+        self.assertEqual((len(budget), budget.size), (3, 3 * size))
+
+        # Growing an entry makes it the most recently used, and evicts others until it fits
+        entries[0].resize(20, refcheck=False)
+        budget.update(entries[0])
+        self.assertEqual(cache.evicted[2:], [(("key",), 3)])
+        self.assertEqual((len(budget), budget.evictions), (2, 3))
+        self.assertLessEqual(budget.size, budget.max_bytes)
+
+        # Lowering the budget evicts down to it
+        budget.max_bytes = 0
+        budget.evict()
+        self.assertEqual(cache.evicted[3:], [(("key",), 4), (("key",), 0)])
+        self.assertEqual((len(budget), budget.size, budget.evictions), (0, 0, 5))
+
+    def testNoLimit(self):
+        cache, budget = RecordingCache(), CacheBudget()
+        for i in range(100):
+            budget.add(cache, ("key",), i, np.zeros(100))
+        self.assertEqual((len(budget), budget.evictions, cache.evicted), (100, 0, []))
+
+
+if __name__ == "__main__":
+    unittest.main()
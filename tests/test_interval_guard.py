@@ -0,0 +1,75 @@
+# Tests for deciding guards over a box with interval arithmetic, checked against z3
+import random
+import unittest
+from verse.automaton.guard import Z3Guard
+from verse.automaton.interval_guard import evaluate_guard_interval
+
+GUARDS = [
+    "ego.x > 1",
+    "ego.x - other.x < 5",
+    "And(ego.x > 1, ego.x < 3)",
+    "And(ego.x - other.x > -1, ego.x - other.x < 1)",
+    "Or(ego.x < 0, ego.y > 2)",
+    "Or(ego.x < 0, ego.x > 2)",
+    "Not(And(ego.x > 1, ego.y < 1))",
+    "And(Or(ego.x < 0, ego.y > 2), Not(other.x > ego.y))",
+    "ego.x * ego.x < 0.25",
+    "ego.x * ego.y + other.x >= 1",
+]
+
+
+class TestIntervalGuard(unittest.TestCase):
+    def assertMatchesZ3(self, guard, box, *decision):
+        '''
+        Check that the interval evaluation of `guard` over `box` agrees with z3 when it decides,
+        and that it gives `decision` when one is given, None for leaving the guard to z3
+        '''
+        res = evaluate_guard_interval(guard, box)
+        if res != None:
+            self.assertEqual(tuple(res), Z3Guard(guard, list(box)).check(box), (guard, box))
+        if decision:
+            self.assertEqual(res if res == None else tuple(res), decision[0], (guard, box))
+
+    def testComparison(self):
+        # Straddles, is contained in and misses the guard
+        self.assertMatchesZ3("ego.x > 1", {"ego.x": [0, 2]}, (True, False))
+        self.assertMatchesZ3("ego.x > 1", {"ego.x": [2, 3]}, (True, True))
+        self.assertMatchesZ3("ego.x > 1", {"ego.x": [-1, 0]}, (False, False))
+        box = {"ego.x": [0, 1], "other.x": [-10, -3]}
+        self.assertMatchesZ3("ego.x - other.x < 5", box, (True, False))
+
+    def testMargin(self):
+        # Boxes touching the boundary up to rounding are left to z3
+        self.assertMatchesZ3("ego.x > 1", {"ego.x": [1 + 1e-12, 2]}, None)
+        self.assertMatchesZ3("ego.x < 1", {"ego.x": [1 - 1e-12, 2]}, None)
+        self.assertMatchesZ3("ego.x >= 1", {"ego.x": [0, 1 - 1e-12]}, None)
+
+    def testWitness(self):
+        # Interval arithmetic can't decide x * x, but points of the box can
+        self.assertMatchesZ3("ego.x * ego.x < 0.25", {"ego.x": [-1, 1]}, (True, False))
+        # No point of the box satisfies x * x < -0.5, which needs z3
+        self.assertMatchesZ3("ego.x * ego.x < -0.5", {"ego.x": [-1, 1]}, None)
+
+    def testNesting(self):
+        box = {"ego.x": [1.5, 2.5], "ego.y": [0, 0.5], "other.x": [0, 1]}
+        self.assertMatchesZ3("And(ego.x > 1, ego.x < 3)", box, (True, True))
+        self.assertMatchesZ3("Not(And(ego.x > 1, ego.y < 1))", box, (False, False))
+        self.assertMatchesZ3("Or(ego.x < 0, ego.y > 2)", box, (False, False))
+        self.assertMatchesZ3("And(Or(ego.x < 0, ego.y > 2), Not(other.x > ego.y))", box)
+        # Both sides of the disjunction share ego.x
+        self.assertMatchesZ3("Or(ego.x < 0, ego.x > 2)", {"ego.x": [-1, 3]}, (True, False))
+        self.assertMatchesZ3("Or(ego.x < 0, ego.x > 2)", {"ego.x": [0.5, 1.5]}, (False, False))
+        self.assertMatchesZ3("Or(ego.x < 0, ego.x > 2)", {"ego.x": [-1, -0.5]}, (True, True))
+
+    def testRandomBoxes(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            box = {}
+            for var in ["ego.x", "ego.y", "other.x"]:
+                lower = rng.uniform(-4, 4)
+                box[var] = [lower, lower + rng.choice([0, rng.uniform(0, 3)])]
+            self.assertMatchesZ3(rng.choice(GUARDS), box)
+
+
+if __name__ == "__main__":
+    unittest.main()
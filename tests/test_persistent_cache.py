@@ -0,0 +1,111 @@
+# Tests for the on-disk store of the simulation and incremental caches
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from verse.agents.example_agent import NPCAgent
+from verse.analysis.integrators import Integrator
+from verse.analysis.persistent_cache import PersistentCache, fingerprint
+from verse.analysis.sim_cache import SimulationCache
+from verse.map.example_map.map_tacas import M3
+
+MODE, INIT = ("Normal", "T1"), [0, 3, 0, 5]
+
+
+class TestPersistentCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reopen(self, store):
+        store.close()
+        return PersistentCache(self.path)
+
+    def testReopen(self):
+        '''
+        Test that traces and tubes written to the store are read back after reopening it
+        '''
+        store = PersistentCache(self.path)
+        trace = np.arange(12, dtype=float).reshape(4, 3)
+        store.put_traces([("a", 2.0, trace), ("b", 1.0, trace[:2])])
+        tube = np.arange(8, dtype=float).reshape(4, 2)
+        store.put_tube("g", np.zeros(2), np.ones(2), tube)
+        store.put_tube("g", np.ones(2), np.full(2, 2.0), tube + 1)
+
+        store = self.reopen(store)
+        horizon, stored = store.get_trace("a")
+        self.assertEqual(horizon, 2.0)
+        np.testing.assert_array_equal(stored, trace)
+        self.assertIsNone(store.get_trace("c"))
+        tubes = store.get_tubes("g")
+        self.assertEqual(len(tubes), 2)
+        for (lower, upper, stored), expected in zip(tubes, [(0, 1, tube), (1, 2, tube + 1)]):
+            np.testing.assert_array_equal(lower, np.full(2, expected[0], dtype=float))
+            np.testing.assert_array_equal(upper, np.full(2, expected[1], dtype=float))
+            np.testing.assert_array_equal(stored, expected[2])
+        self.assertEqual(store.get_tubes("h"), [])
+
+        # A shorter trace doesn't replace a longer one, a longer one does
+        store.put_traces([("a", 1.0, trace[:2]), ("b", 3.0, trace)])
+        store = self.reopen(store)
+        self.assertEqual(store.get_trace("a")[0], 2.0)
+        self.assertEqual(store.get_trace("b")[0], 3.0)
+        store.close()
+
+    def testFingerprint(self):
+        '''
+        Test that the fingerprint changes with the dynamics of the agent, including attributes
+        set on its class, but not with its decision logic or initial conditions
+        '''
+        agent, lane_map = NPCAgent("car"), M3()
+        store = PersistentCache(self.path)
+        expected = fingerprint(agent, lane_map)
+        self.assertEqual(store.fingerprint(agent, lane_map), expected)
+        self.assertEqual(fingerprint(NPCAgent("car"), M3()), expected)
+
+        agent.set_initial_state([[0, 0, 0, 1], [0, 0, 0, 2]])
+        agent.decision_logic = None
+        self.assertEqual(store.fingerprint(agent, lane_map), expected)
+
+        try:
+            NPCAgent.integrator = Integrator.RK4
+            self.assertNotEqual(store.fingerprint(agent, lane_map), expected)
+        finally:
+            NPCAgent.integrator = None
+        self.assertEqual(store.fingerprint(agent, lane_map), expected)
+
+        agent.integrator = Integrator.RK45
+        self.assertNotEqual(store.fingerprint(agent, lane_map), expected)
+        store.close()
+
+    def testChangedAgentMisses(self):
+        '''
+        Test that traces written by one cache are read back by a cache on the reopened store, and
+        that changing the dynamics of the agent misses instead of reading them
+        '''
+        agent, lane_map = NPCAgent("car"), M3()
+        cache = SimulationCache(store=PersistentCache(self.path))
+        expected = cache.simulate(agent, MODE, INIT, 1, 0.1, lane_map)
+        cache.flush()
+        self.assertEqual(cache.hits, (0, 1))
+
+        cache = SimulationCache(store=self.reopen(cache.store))
+        np.testing.assert_array_equal(cache.simulate(agent, MODE, INIT, 1, 0.1, lane_map), expected)
+        self.assertEqual(cache.hits, (1, 0))
+
+        cache = SimulationCache(store=self.reopen(cache.store))
+        try:
+            NPCAgent.integrator = Integrator.RK4
+            cache.simulate(agent, MODE, INIT, 1, 0.1, lane_map)
+        finally:
+            NPCAgent.integrator = None
+        self.assertEqual(cache.hits, (0, 1))
+        cache.store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+# Tests for the range of continuous resets over a box, used by the verifier to reset reachtubes
+import math
+import unittest
+import numpy as np
+from verse.automaton.reset import compiled_reset
+
+
+class TestCompiledReset(unittest.TestCase):
+    def assertImageSound(self, expr, bounds, exact):
+        '''
+        Check that the image of `expr` over `bounds` contains its values on a dense grid, and
+        that it is tight when `exact`
+        '''
+        lower, upper = compiled_reset(expr).image(bounds)
+        grid = np.meshgrid(*(np.linspace(lo, hi, 201) for lo, hi in bounds.values()))
+        env = {"sin": np.sin, "cos": np.cos, "math": np}
+        env.update({var.replace(".", "_"): values for var, values in zip(bounds, grid)})
+        values = eval(expr.replace("ego.", "ego_"), env)
+        values = np.broadcast_to(values, grid[0].shape)
+        self.assertLessEqual(lower, values.min() + 1e-12)
+        self.assertGreaterEqual(upper, values.max() - 1e-12)
+        if exact:
+            self.assertAlmostEqual(lower, values.min(), places=3)
+            self.assertAlmostEqual(upper, values.max(), places=3)
+
+    def testSquare(self):
+        self.assertImageSound("ego.x * ego.x", {"ego.x": [-1, 1]}, exact=False)
+        self.assertImageSound("ego.x * ego.x", {"ego.x": [1, 2]}, exact=True)
+
+    def testCancellation(self):
+        self.assertImageSound("ego.x - ego.x", {"ego.x": [-1, 1]}, exact=True)
+
+    def testSine(self):
+        self.assertImageSound("sin(ego.x)", {"ego.x": [0, 4]}, exact=True)
+        self.assertImageSound("math.sin(ego.x) + ego.x", {"ego.x": [0, 4]}, exact=True)
+        self.assertImageSound("sin(ego.x) * ego.x", {"ego.x": [-4, 4]}, exact=False)
+        self.assertImageSound("cos(ego.x)", {"ego.x": [-7, 1]}, exact=True)
+
+    def testLinear(self):
+        bounds = {"ego.x": [-1, 2], "ego.y": [0.5, 3]}
+        self.assertImageSound("2 * ego.x - 0.5 * ego.y + 3", bounds, exact=True)
+        self.assertImageSound("ego.x + 2 * ego.y - ego.x * 0.5", bounds, exact=True)
+
+    def testUnbounded(self):
+        with self.assertRaises(ValueError):
+            compiled_reset("ego.x / ego.x").image({"ego.x": [-1, 1]})
+
+
+if __name__ == "__main__":
+    unittest.main()
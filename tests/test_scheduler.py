@@ -0,0 +1,81 @@
+# Tests for the order in which simulation and verification explore the tree
+import random
+import unittest
+from verse.analysis.analysis_tree import AnalysisTreeNode, AnalysisTreeNodeType
+from verse.analysis.scheduler import Scheduler, SchedulingPolicy
+
+
+def make_node(id, start_time=0):
+    return AnalysisTreeNode(
+        {}, {}, {}, {}, {}, {}, 0, {}, [], start_time, 10, AnalysisTreeNodeType.SIM_TRACE, id
+    )
+
+
+class TestScheduler(unittest.TestCase):
+    def pop_all(self, scheduler):
+        order = []
+        while len(scheduler) > 0:
+            node, _ = scheduler.pop()
+            order.append(node.id)
+        return order
+
+    def push_all(self, scheduler, start_times, laters=None):
+        for i, start_time in enumerate(start_times):
+            scheduler.push(make_node(i, start_time), 0 if laters == None else laters[i])
+
+    def testBFS(self):
+        scheduler = Scheduler(SchedulingPolicy.BFS)
+        self.push_all(scheduler, [3, 1, 2, 0])
+        self.assertEqual(self.pop_all(scheduler), [0, 1, 2, 3])
+
+    def testDFS(self):
+        scheduler = Scheduler(SchedulingPolicy.DFS)
+        self.push_all(scheduler, [3, 1, 2, 0])
+        self.assertEqual(self.pop_all(scheduler), [3, 2, 1, 0])
+
+    def testEarliestStart(self):
+        scheduler = Scheduler(SchedulingPolicy.EARLIEST_START)
+        self.push_all(scheduler, [3, 1, 2, 1, 0.5])
+        # Nodes with the same start time come out in the order they were pushed
+        self.assertEqual(self.pop_all(scheduler), [4, 1, 3, 2, 0])
+
+    def testPriority(self):
+        with self.assertRaises(ValueError):
+            Scheduler(SchedulingPolicy.PRIORITY)
+        scheduler = Scheduler(SchedulingPolicy.PRIORITY, lambda node: -node.start_time)
+        self.push_all(scheduler, [3, 1, 2, 3, 0])
+        self.assertEqual(self.pop_all(scheduler), [0, 3, 2, 1, 4])
+
+    def testDefault(self):
+        scheduler = Scheduler()
+        self.push_all(scheduler, [0, 0, 0, 0], laters=[1, 0, 1, 0])
+        self.assertEqual(self.pop_all(scheduler), [1, 3, 0, 2])
+
+    def testDefaultMatchesSortedList(self):
+        '''
+        Test that DEFAULT pops nodes in the order of the list the verifier used to keep, sorted by
+        `later` after queueing the children of each node
+        '''
+        rng = random.Random(0)
+        for _ in range(50):
+            scheduler, queue = Scheduler(), []
+            order, expected, next_id = [], [], 0
+            for _ in range(40):
+                if queue and rng.random() < 0.4:
+                    node, _ = scheduler.pop()
+                    order.append(node.id)
+                    expected.append(queue.pop(0)[0].id)
+                    continue
+                for i in range(rng.randint(1, 3)):
+                    node, later = make_node(next_id), 0 if i == 0 else 1
+                    next_id += 1
+                    scheduler.push(node, later)
+                    queue.append((node, later))
+                queue.sort(key=lambda p: p[1:])
+            order += self.pop_all(scheduler)
+            expected += [node.id for node, _ in queue]
+            self.assertEqual(order, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
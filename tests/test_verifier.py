@@ -0,0 +1,107 @@
+# Tests for helpers of the verifier
+import unittest
+import numpy as np
+from verse import ScenarioConfig
+from verse.analysis.analysis_tree import AnalysisTreeNode, AnalysisTreeNodeType
+from verse.analysis.verifier import RectHull, Verifier, combine_rect, covers, merge_nodes
+
+
+def make_node(rect, start_time=1, mode=("Normal",), static=None):
+    return AnalysisTreeNode(
+        {},
+        {"car": [rect]},
+        {"car": mode},
+        {"car": [] if static == None else static},
+        {"car": []},
+        {},
+        1,
+        {},
+        [],
+        start_time,
+        10,
+        AnalysisTreeNodeType.REACH_TUBE,
+        0,
+    )
+
+
+class TestRectHull(unittest.TestCase):
+    def testRandomWindows(self):
+        '''
+        Test the hull of random windows of random reachtubes against the min/max over the window
+        '''
+        rng = np.random.default_rng(0)
+        for rects in [1, 2, 3, 7, 16, 33]:
+            lower = rng.uniform(-10, 10, (rects, 3))
+            trace = np.empty((rects * 2, 3))
+            trace[0::2], trace[1::2] = lower, lower + rng.uniform(0, 5, (rects, 3))
+            hull = RectHull(trace)
+            self.assertEqual(len(hull), rects)
+            for _ in range(50):
+                start = int(rng.integers(0, rects))
+                end = int(rng.integers(start + 1, rects + 1))
+                expected = [
+                    trace[start * 2 : end * 2 : 2].min(axis=0).tolist(),
+                    trace[start * 2 + 1 : end * 2 : 2].max(axis=0).tolist(),
+                ]
+                self.assertEqual(hull.hull(start, end), expected)
+                self.assertEqual(hull.hull(start, end), combine_rect(trace[start * 2 : end * 2]))
+
+    def testEmptyWindow(self):
+        hull = RectHull(np.zeros((8, 2)))
+        for start, end in [(2, 2), (3, 1), (0, 5), (-1, 2)]:
+            with self.assertRaises(ValueError):
+                hull.hull(start, end)
+
+
+class TestMerge(unittest.TestCase):
+    def testMergeNodes(self):
+        a = make_node([[0, 0], [1, 1]])
+        b = make_node([[1, 0], [2, 1]])
+        original_a, original_b = make_node(*a.init["car"]), make_node(*b.init["car"])
+        # Adjacent boxes: the hull adds no volume
+        self.assertTrue(merge_nodes(a, b, 0))
+        self.assertEqual(a.init["car"], [[[0, 0], [2, 1]]])
+        self.assertTrue(covers(a, original_a))
+        self.assertTrue(covers(a, original_b))
+        self.assertFalse(covers(original_a, a))
+
+    def testMergeTolerance(self):
+        # The hull of two unit boxes at opposite corners is 4 times as large as each
+        a, b = make_node([[0, 0], [1, 1]]), make_node([[1, 1], [2, 2]])
+        self.assertFalse(merge_nodes(a, b, 0.5))
+        self.assertEqual(a.init["car"], [[[0, 0], [1, 1]]])
+        self.assertTrue(merge_nodes(a, b, 1))
+        self.assertEqual(a.init["car"], [[[0, 0], [2, 2]]])
+        # Nodes with other static parameters are never merged
+        a, b = make_node([[0, 0], [1, 1]]), make_node([[0, 0], [1, 1]], static=["x"])
+        self.assertFalse(merge_nodes(a, b, 10))
+
+    def testMergeTraces(self):
+        a, b = make_node([[0, 0], [1, 1]]), make_node([[1, 0], [2, 1]])
+        a.trace["car"] = np.array([[0, 0, 0], [0, 1, 1], [0.1, 0, 0], [0.1, 1, 1]])
+        b.trace["car"] = np.array([[0, 1, 0], [0, 2, 1], [0.1, 1, 0], [0.1, 2, 1]])
+        self.assertTrue(merge_nodes(a, b, 0))
+        expected = [[0, 0, 0], [0, 2, 1], [0.1, 0, 0], [0.1, 2, 1]]
+        self.assertEqual(a.trace["car"].tolist(), expected)
+        # Traces over other time steps are dropped, to be recomputed from the merged set
+        c = make_node([[2, 0], [3, 1]])
+        c.trace["car"] = np.array([[0, 2, 0], [0, 3, 1]])
+        self.assertTrue(merge_nodes(a, c, 0))
+        self.assertNotIn("car", a.trace)
+
+    def testMergeQueued(self):
+        verifier = Verifier(ScenarioConfig(merge_tolerance=0))
+        verifier.merge_index = {}
+        a, b = make_node([[0, 0], [1, 1]]), make_node([[1, 0], [2, 1]])
+        self.assertFalse(verifier.merge_queued(a))
+        self.assertTrue(verifier.merge_queued(b))
+        self.assertEqual(a.init["car"], [[[0, 0], [2, 1]]])
+        # Nodes with other modes or start times are queued on their own
+        self.assertFalse(verifier.merge_queued(make_node([[1, 0], [2, 1]], start_time=2)))
+        self.assertFalse(verifier.merge_queued(make_node([[1, 0], [2, 1]], mode=("Stop",))))
+        self.assertEqual(len(verifier.merge_index), 3)
+        self.assertEqual([len(queued) for queued, _ in verifier.merge_index.values()], [1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
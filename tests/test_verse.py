@@ -2,11 +2,24 @@
 # Read more from https://docs.python.org/3/library/unittest.html
 
 # A scenario is created for testing
+import contextlib
+import io
+import os
 import unittest
-from ball_bounce_test import ball_bounce_test
-from highway_test import highway_test
+from unittest import mock
+import numpy as np
+from ball_bounce_test import ball_bounce_scenario, ball_bounce_test
+from highway_test import highway_scenario, highway_test
 from verse import BaseAgent
+from verse.agents.example_agent import CarAgent, NPCAgent
 from verse.analysis.analysis_tree import AnalysisTreeNodeType
+from verse.analysis import verifier
+from verse.analysis.executor import ExecutorBackend, run_fused
+from verse.analysis.integrators import Integrator
+from verse.analysis.utils import sample_rect
+from verse.automaton.guard import guard_cache
+from verse.map.example_map.map_tacas import M3
+from verse.scenario.scenario import Benchmark
 
 from enum import Enum, auto
 
@@ -15,6 +28,18 @@ class TestSimulatorMethods(unittest.TestCase):
     def setUp(self):
         pass
 
+    def assertSameNodes(self, nodes, other_nodes):
+        '''
+        Check that two lists of analysis tree nodes have the same modes, start times and traces
+        '''
+        self.assertEqual(len(nodes), len(other_nodes))
+        for node, other_node in zip(nodes, other_nodes):
+            self.assertEqual(node.mode, other_node.mode)
+            self.assertEqual(node.start_time, other_node.start_time)
+            self.assertEqual(node.trace.keys(), other_node.trace.keys())
+            for agent_id in node.trace:
+                np.testing.assert_array_equal(node.trace[agent_id], other_node.trace[agent_id])
+
     # def test_m2_2c5n(self):
     #     trace = m2_2c5n_test()
     #     root = trace.root
@@ -82,6 +107,313 @@ class TestSimulatorMethods(unittest.TestCase):
         # assert trace_sim.type == AnalysisTreeNodeType.SIM_TRACE
         # assert trace_veri.type == AnalysisTreeNodeType.REACH_TUBE
 
+    def testVectorizeGuards(self):
+        '''
+        Test that guards lowered to NumPy find the same transitions as the interpreted guards
+        '''
+        for make_scenario, time_horizon, time_step in [
+            (ball_bounce_scenario, 20, 0.01),
+            (highway_scenario, 40, 0.1),
+        ]:
+            trace = make_scenario(vectorize_guards=True).simulate(time_horizon, time_step, seed=4)
+            expected = make_scenario(vectorize_guards=False).simulate(
+                time_horizon, time_step, seed=4
+            )
+            self.assertSameNodes(trace.nodes, expected.nodes)
+
+    def testStreamSimulate(self):
+        '''
+        Test that stopping each node's simulation at the first guard gives the same tree as
+        simulating to the time horizon
+        '''
+        for make_scenario, time_horizon, time_step in [
+            (ball_bounce_scenario, 20, 0.01),
+            (highway_scenario, 40, 0.1),
+        ]:
+            trace = make_scenario(stream_simulate=True).simulate(time_horizon, time_step, seed=4)
+            expected = make_scenario(stream_simulate=False).simulate(
+                time_horizon, time_step, seed=4
+            )
+            self.assertSameNodes(trace.nodes, expected.nodes)
+
+    def testEventLocation(self):
+        '''
+        Test that event location switches the balls at the exact bounce times, and takes the
+        same transitions as the time grid
+        '''
+        trace = ball_bounce_scenario(event_location=True).simulate(20, 0.1, seed=4)
+        expected = ball_bounce_scenario().simulate(20, 0.1, seed=4)
+        self.assertEqual([n.mode for n in trace.nodes], [n.mode for n in expected.nodes])
+        # The red ball reaches a wall at 5, 7.5, 15 and 17.5, the green ball at 0.5, 5 and 10.5
+        bounce_times = [0, 0.5, 5, 5, 7.5, 10.5, 15, 17.5]
+        np.testing.assert_allclose([n.start_time for n in trace.nodes], bounce_times, atol=1e-5)
+
+    def testSimulateBatch(self):
+        '''
+        Test that batched simulation matches one TC_simulate call per initial condition, with
+        both the default integrator and the stacked RK45 one
+        '''
+        lane_map = M3()
+        script_dir = os.path.realpath(os.path.dirname(__file__))
+        controller = os.path.join(script_dir, "./test_controller/example_controller5.py")
+        inits = [[5, -0.5 + 0.1 * i, 0, 1.0] for i in range(5)]
+        for integrator in [None, Integrator.RK45]:
+            for agent in [CarAgent("car1", file_name=controller), NPCAgent("car2")]:
+                agent.integrator = integrator
+                traces = agent.TC_simulate_batch(("Normal", "T1"), inits, 10, 0.1, lane_map)
+                expected = np.stack(
+                    [agent.TC_simulate(("Normal", "T1"), init, 10, 0.1, lane_map) for init in inits]
+                )
+                np.testing.assert_array_equal(traces, expected)
+
+            batched, separate = highway_scenario(batch_simulate=True), highway_scenario()
+            for scenario in [batched, separate]:
+                for agent in scenario.agent_dict.values():
+                    agent.integrator = integrator
+            init_dict_list = [
+                {aid: sample_rect(init, seed) for aid, init in separate.init_dict.items()}
+                for seed in range(3)
+            ]
+            trees = batched.simulate_multi(20, 0.1, init_dict_list)
+            expected_trees = separate.simulate_multi(20, 0.1, init_dict_list)
+            self.assertEqual(len(trees), len(expected_trees))
+            for tree, expected in zip(trees, expected_trees):
+                self.assertSameNodes(tree.nodes, expected.nodes)
+
+    def testVerifyIter(self):
+        '''
+        Test that verify_iter yields the tree of verify, and keeps a partial tree when it runs out
+        of budget or is closed early
+        '''
+        expected = highway_scenario().verify(25, 0.1)
+
+        scenario = highway_scenario()
+        # Nodes are yielded as they finish, which needn't be the order of the tree
+        nodes = sorted(scenario.verify_iter(25, 0.1), key=lambda node: node.id)
+        self.assertTrue(scenario.past_runs[-1].complete)
+        self.assertSameNodes(nodes, expected.nodes)
+        self.assertSameNodes(scenario.past_runs[-1].nodes, expected.nodes)
+
+        for config, num_nodes in [({"node_budget": 2}, 2), ({"time_budget": 0}, 1)]:
+            scenario = highway_scenario(**config)
+            nodes = sorted(scenario.verify_iter(25, 0.1), key=lambda node: node.id)
+            self.assertFalse(scenario.past_runs[-1].complete)
+            self.assertSameNodes(nodes, expected.nodes[:num_nodes])
+            self.assertSameNodes(scenario.past_runs[-1].nodes, expected.nodes[:num_nodes])
+
+        scenario = highway_scenario()
+        for node in scenario.verify_iter(25, 0.1):
+            break
+        self.assertFalse(scenario.past_runs[-1].complete)
+        self.assertSameNodes(scenario.past_runs[-1].nodes, expected.nodes[:1])
+
+    def testExecutors(self):
+        '''
+        Test that simulation and verification give the same trees on every local backend
+        '''
+        expected_sim = highway_scenario().simulate(25, 0.1, seed=4)
+        expected_veri = highway_scenario().verify(25, 0.1)
+        for backend in [ExecutorBackend.INLINE, ExecutorBackend.THREAD, ExecutorBackend.PROCESS]:
+            scenario = highway_scenario(parallel=True, executor=backend, num_workers=2)
+            self.assertSameNodes(scenario.simulate(25, 0.1, seed=4).nodes, expected_sim.nodes)
+            self.assertSameNodes(scenario.verify(25, 0.1).nodes, expected_veri.nodes)
+
+    def testTaskFusion(self):
+        '''
+        Test that fusing queued nodes into one task doesn't change the verification tree
+        '''
+        batch_sizes = []
+
+        def counted_run_fused(fn, calls, shared):
+            batch_sizes.append(len(calls))
+            return run_fused(fn, calls, shared)
+
+        trees = []
+        for task_fusion in [True, False]:
+            batch_sizes.clear()
+            # One task in flight at a time, so that nodes queue up and get fused
+            scenario = ball_bounce_scenario(
+                parallel=True,
+                executor=ExecutorBackend.INLINE,
+                parallel_ver_ahead=1,
+                task_fusion=task_fusion,
+                fused_task_duration=1.0,
+            )
+            with mock.patch.object(verifier, "run_fused", counted_run_fused):
+                trees.append(scenario.verify(20, 0.01))
+            if task_fusion:
+                self.assertGreater(len(batch_sizes), 1)
+                self.assertGreater(max(batch_sizes), 1)
+            else:
+                self.assertEqual(max(batch_sizes), 1)
+        self.assertSameNodes(trees[0].nodes, trees[1].nodes)
+
+    def testRefinement(self):
+        '''
+        Test that refining the initial set covers it with the parts, numbers the merged tree
+        uniquely and reaches every mode the unrefined tree reaches
+        '''
+        expected = highway_scenario().verify(25, 0.1)
+        scenario = highway_scenario(refine_budget=1, refine_width=1.0)
+        tree = scenario.verify(25, 0.1)
+        parts = [child.init for child in tree.root.child]
+        self.assertGreater(len(parts), 1)
+        self.assertEqual([child.partition for child in tree.root.child], list(range(len(parts))))
+
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            point = {aid: rng.uniform(*rect) for aid, rect in scenario.init_dict.items()}
+            self.assertTrue(
+                any(
+                    all(
+                        np.all(part[aid][0][0] <= point[aid])
+                        and np.all(point[aid] <= part[aid][0][1])
+                        for aid in point
+                    )
+                    for part in parts
+                )
+            )
+        for part in parts:
+            for aid, (lower, upper) in scenario.init_dict.items():
+                self.assertTrue(np.all(np.array(lower) <= part[aid][0][0]))
+                self.assertTrue(np.all(np.array(part[aid][0][1]) <= upper))
+
+        ids = [node.id for node in tree.nodes]
+        self.assertEqual(len(set(ids)), len(ids))
+        modes = {tuple(sorted(node.mode.items())) for node in tree.nodes}
+        expected_modes = {tuple(sorted(node.mode.items())) for node in expected.nodes}
+        self.assertTrue(expected_modes <= modes)
+
+    def testGuardCacheMaps(self):
+        '''
+        Test that guards compiled for one map aren't reused with another map by the same
+        controller
+        '''
+        no_right_switch = M3()
+        del no_right_switch.h_dict[("T1", "Normal", "SwitchRight")]
+
+        scenario = highway_scenario()
+        scenario.verify(25, 0.1)
+        scenario.set_map(no_right_switch)
+        trace = scenario.verify(25, 0.1)
+
+        guard_cache.clear()
+        fresh = highway_scenario()
+        fresh.set_map(no_right_switch)
+        self.assertSameNodes(trace.nodes, fresh.verify(25, 0.1).nodes)
+
+    def testHorizonReuse(self):
+        '''
+        Test incremental simulation and verification over several time horizons against fresh
+        runs. Without horizon reuse the trees must be identical; with it, transitions may move by
+        up to one time step, but must keep their modes
+        '''
+        time_horizons, time_step = [20, 30, 10], 0.1
+        expected = {}
+        for time_horizon in time_horizons:
+            scenario = highway_scenario()
+            expected[time_horizon] = (
+                scenario.simulate(time_horizon, time_step, seed=4),
+                scenario.verify(time_horizon, time_step),
+            )
+
+        scenario = highway_scenario(incremental=True)
+        for time_horizon in time_horizons:
+            expected_sim, expected_veri = expected[time_horizon]
+            trace_sim = scenario.simulate(time_horizon, time_step, seed=4)
+            self.assertSameNodes(trace_sim.nodes, expected_sim.nodes)
+            trace_veri = scenario.verify(time_horizon, time_step)
+            self.assertSameNodes(trace_veri.nodes, expected_veri.nodes)
+
+        scenario = highway_scenario(incremental=True, horizon_reuse=True)
+        for time_horizon in time_horizons:
+            trace_sim = scenario.simulate(time_horizon, time_step, seed=4)
+            trace_veri = scenario.verify(time_horizon, time_step)
+            for trace, expected_trace in zip((trace_sim, trace_veri), expected[time_horizon]):
+                modes = [n.mode for n in trace.nodes]
+                self.assertEqual(modes, [n.mode for n in expected_trace.nodes])
+                np.testing.assert_allclose(
+                    [n.start_time for n in trace.nodes],
+                    [n.start_time for n in expected_trace.nodes],
+                    atol=time_step + 1e-9,
+                    rtol=0,
+                )
+
+    def testMergeDisabled(self):
+        '''
+        Test that verification doesn't look for nodes to merge when `merge_tolerance` is None,
+        and that merging nodes the ball demo never repeats leaves its tree unchanged
+        '''
+        refuse = mock.Mock(side_effect=AssertionError("merging is disabled"))
+        with mock.patch.object(verifier.Verifier, "merge_queued", refuse):
+            trace = ball_bounce_scenario(merge_tolerance=None).verify(20, 0.01)
+        refuse.assert_not_called()
+        merged = ball_bounce_scenario(merge_tolerance=0).verify(20, 0.01)
+        self.assertSameNodes(trace.nodes, merged.nodes)
+
+    def testCacheBudget(self):
+        '''
+        Test that incremental verification with a tiny `cache_memory_budget` evicts entries, keeps
+        the caches within the budget, reports the evictions and gives the same tree
+        '''
+        expected = highway_scenario().verify(25, 0.1)
+        budget = 20_000
+        bench = Benchmark(["", "iv"], cache_memory_budget=budget)
+        bench.scenario = highway_scenario(incremental=True, cache_memory_budget=budget)
+        for _ in range(2):
+            trace = bench.run(25, 0.1)
+            self.assertSameNodes(trace.nodes, expected.nodes)
+        cache_budget = bench.scenario.verifier.cache_budget
+        self.assertGreater(bench.cache_evictions, 0)
+        self.assertEqual(bench.cache_evictions, cache_budget.evictions)
+        self.assertLessEqual(cache_budget.size, budget)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            bench.report()
+        self.assertIn(f"cache evictions: {bench.cache_evictions}", output.getvalue())
+
+    def testSimCache(self):
+        '''
+        Test that simulating the same initial point again takes the traces from the simulation
+        cache, including through the store shared with parallel workers, and that
+        `sim_cache_size=0` disables the cache
+        '''
+        calls = []
+
+        def counted(original):
+            def tc_simulate(agent, *args, **kwargs):
+                calls.append(agent.id)
+                return original(agent, *args, **kwargs)
+
+            return tc_simulate
+
+        configs = [
+            ({"sim_cache_size": 1000}, True),
+            ({"sim_cache_size": 1000, "parallel": True, "executor": ExecutorBackend.THREAD}, True),
+            ({"sim_cache_size": 0}, False),
+        ]
+        expected = highway_scenario().simulate(25, 0.1, seed=4)
+        for config, cached in configs:
+            scenario = highway_scenario(**config)
+            num_calls = []
+            with mock.patch.object(CarAgent, "TC_simulate", counted(CarAgent.TC_simulate)):
+                with mock.patch.object(NPCAgent, "TC_simulate", counted(NPCAgent.TC_simulate)):
+                    for _ in range(2):
+                        calls.clear()
+                        trace = scenario.simulate(25, 0.1, seed=4)
+                        self.assertSameNodes(trace.nodes, expected.nodes)
+                        num_calls.append(len(calls))
+            self.assertGreater(num_calls[0], 0, config)
+            sim_cache = scenario.simulator.sim_cache
+            if cached:
+                self.assertEqual(num_calls[1], 0, config)
+            else:
+                self.assertEqual(num_calls[1], num_calls[0])
+                self.assertIsNone(scenario.simulator.get_sim_cache())
+                self.assertEqual((len(sim_cache), sim_cache.hits), (0, (0, 0)))
+            if cached and not config.get("parallel"):
+                self.assertEqual(sim_cache.hits, (num_calls[0], num_calls[0]), config)
+
 
 if __name__ == "__main__":
     unittest.main()
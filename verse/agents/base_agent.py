@@ -11,6 +11,8 @@ class BaseAgent:
     Methods
     -------
     TC_simulate
+    TC_simulate_batch
+    TC_simulate_stream
     """
 
     def __init__(
@@ -91,3 +93,75 @@ class BaseAgent:
         t = t.reshape((-1,1))
         trace = np.hstack((t, trace))
         return trace
+
+    def TC_simulate_batch(self, mode, initialSets, time_horizon, time_step, map=None):
+        """
+        Batched simulation function. Simulates every initial condition in
+        `initialSets` in the same mode and stacks the traces.
+
+        Agents whose dynamics can be evaluated on stacked states should override
+        this method; the default falls back to one `TC_simulate` call per
+        initial condition, and raises a ValueError if the traces don't all have
+        the same length.
+
+        Parameters
+        ----------
+            mode: str
+                The current mode to simulate
+            initialSets: List[List[float]]
+                The initial conditions to perform the simulations from
+            time_horizon: float
+                The time horizon for simulation
+            time_step: float
+                time_step for performing simulation
+            map: LaneMap, optional
+                Provided if the map is used
+
+        Returns
+        -------
+            np.ndarray of shape (len(initialSets), trace length, 1 + state dimension)
+        """
+        traces = [
+            self.TC_simulate(mode, init, time_horizon, time_step, map) for init in initialSets
+        ]
+        lengths = set(len(trace) for trace in traces)
+        if len(lengths) > 1:
+            raise ValueError(
+                f"TC_simulate returned traces of lengths {sorted(lengths)}, which can't be stacked"
+            )
+        return np.stack([np.asarray(trace) for trace in traces])
+
+    def TC_simulate_stream(
+        self, mode, initialSet, time_horizon, time_step, map=None, chunk_size=50
+    ):
+        """
+        Streaming simulation function. Yields the trace that `TC_simulate` would
+        return in consecutive chunks of about `chunk_size` rows, so that the
+        caller can stop integrating as soon as it has seen enough.
+
+        Agents that integrate step by step should override this method; the
+        default simulates the whole horizon with `TC_simulate` and slices the
+        result.
+
+        Parameters
+        ----------
+            mode: str
+                The current mode to simulate
+            initialSet: List[float]
+                The initial condition to perform the simulation
+            time_horizon: float
+                The time horizon for simulation
+            time_step: float
+                time_step for performing simulation
+            map: LaneMap, optional
+                Provided if the map is used
+            chunk_size: int
+                Number of trace rows per chunk
+
+        Yields
+        ------
+            np.ndarray of shape (rows, 1 + state dimension)
+        """
+        trace = np.asarray(self.TC_simulate(mode, initialSet, time_horizon, time_step, map))
+        for start in range(0, len(trace), chunk_size):
+            yield trace[start : start + chunk_size]
@@ -1,17 +1,50 @@
 # Example agent.
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 
 import numpy as np
 from scipy.integrate import ode
 
 from verse import BaseAgent
 from verse import LaneMap
+from verse.analysis import integrators
 from verse.analysis.utils import wrap_to_pi
 from verse.analysis.analysis_tree import TraceType
 from verse.parser import ControllerIR
 
 
+def _stacked_control(action_handler, mode, lane_map):
+    """Wraps `action_handler` so that it also accepts a stack of states of shape (d, N), returning
+    the controls as arrays of shape (N,)."""
+
+    def control(state):
+        if state.ndim == 1:
+            return action_handler(mode, state, lane_map)
+        controls = [action_handler(mode, column, lane_map) for column in state.T]
+        return tuple(np.array(u) for u in zip(*controls))
+
+    return control
+
+
+def _clamp_speed(state):
+    state[3] = np.maximum(state[3], 0)
+
+
+def _batchable(agent: BaseAgent, cls: type) -> bool:
+    """Whether `agent` can integrate stacked states: it uses an integrator from `integrators`, and
+    neither its simulation nor its dynamics were replaced by code that may only take one state."""
+    return (
+        agent.integrator is not None
+        and type(agent).TC_simulate is cls.TC_simulate
+        and integrators.is_vectorized(agent.dynamic)
+    )
+
+
 class NPCAgent(BaseAgent):
+    integrator: Optional[integrators.Integrator] = None
+    """The integrator of `TC_simulate`, or None to integrate each time step with
+    `scipy.integrate.ode`. Setting one also lets `TC_simulate_batch` integrate all initial
+    conditions as one stack."""
+
     def __init__(self, id, initial_state=None, initial_mode=None):
         self.id = id
         self.decision_logic = ControllerIR.empty()
@@ -21,6 +54,7 @@ class NPCAgent(BaseAgent):
         self.set_uncertain_parameter(None)
 
     @staticmethod
+    @integrators.vectorized
     def dynamic(t, state, u):
         theta, v = state[2:4]
         delta, a = u
@@ -50,6 +84,17 @@ class NPCAgent(BaseAgent):
     def TC_simulate(
         self, mode: Tuple[str], init, time_bound, time_step, lane_map: LaneMap = None
     ) -> TraceType:
+        if self.integrator is not None:
+            control = _stacked_control(self.action_handler, mode, lane_map)
+            return integrators.simulate(
+                self.dynamic,
+                control,
+                init,
+                time_bound,
+                time_step,
+                self.integrator,
+                post_step=_clamp_speed,
+            )
         time_bound = float(time_bound)
         num_points = int(np.ceil(time_bound / time_step))
         trace = np.zeros((num_points + 1, 1 + len(init)))
@@ -67,8 +112,27 @@ class NPCAgent(BaseAgent):
             trace[i + 1, 1:] = init
         return trace
 
+    def TC_simulate_batch(self, mode, initialSets, time_horizon, time_step, map=None):
+        if not _batchable(self, NPCAgent):
+            return super().TC_simulate_batch(mode, initialSets, time_horizon, time_step, map)
+        control = _stacked_control(self.action_handler, mode, map)
+        return integrators.simulate(
+            self.dynamic,
+            control,
+            initialSets,
+            time_horizon,
+            time_step,
+            self.integrator,
+            post_step=_clamp_speed,
+        )
+
 
 class CarAgent(BaseAgent):
+    integrator: Optional[integrators.Integrator] = None
+    """The integrator of `TC_simulate`, or None to integrate each time step with
+    `scipy.integrate.ode`. Setting one also lets `TC_simulate_batch` integrate all initial
+    conditions as one stack."""
+
     def __init__(
         self,
         id,
@@ -86,6 +150,7 @@ class CarAgent(BaseAgent):
         self.accel = accel
 
     @staticmethod
+    @integrators.vectorized
     def dynamic(t, state, u):
         x, y, theta, v = state
         delta, a = u
@@ -124,22 +189,74 @@ class CarAgent(BaseAgent):
     def TC_simulate(
         self, mode: List[str], init, time_bound, time_step, lane_map: LaneMap = None
     ) -> TraceType:
+        return np.vstack(
+            list(self._simulate_chunks(mode, init, time_bound, time_step, lane_map, None))
+        )
+
+    def TC_simulate_stream(
+        self, mode: List[str], init, time_bound, time_step, lane_map: LaneMap = None, chunk_size=50
+    ):
+        if type(self).TC_simulate is not CarAgent.TC_simulate:
+            # Subclasses with their own simulation go through the default adapter
+            yield from super().TC_simulate_stream(
+                mode, init, time_bound, time_step, lane_map, chunk_size
+            )
+            return
+        yield from self._simulate_chunks(mode, init, time_bound, time_step, lane_map, chunk_size)
+
+    def TC_simulate_batch(self, mode, initialSets, time_horizon, time_step, map=None):
+        if not _batchable(self, CarAgent):
+            return super().TC_simulate_batch(mode, initialSets, time_horizon, time_step, map)
+        control = _stacked_control(self.action_handler, mode, map)
+        return integrators.simulate(
+            self.dynamic,
+            control,
+            initialSets,
+            time_horizon,
+            time_step,
+            self.integrator,
+            post_step=_clamp_speed,
+        )
+
+    def _simulate_chunks(self, mode, init, time_bound, time_step, lane_map, chunk_size):
+        """Integrates one step at a time, yielding every `chunk_size` rows (everything at once
+        when None)."""
         time_bound = float(time_bound)
         num_points = int(np.ceil(time_bound / time_step))
-        trace = np.zeros((num_points + 1, 1 + len(init)))
-        trace[1:, 0] = [round(i * time_step, 10) for i in range(num_points)]
-        trace[0, 1:] = init
+        if chunk_size is None:
+            chunk_size = num_points + 1
+        chunk = np.zeros((min(chunk_size, num_points + 1), 1 + len(init)))
+        chunk[0, 1:] = init
+        row = 1
+        buffer = np.empty((7, len(init)))
         for i in range(num_points):
+            if row == len(chunk):
+                yield chunk
+                chunk = np.zeros((min(chunk_size, num_points - i), 1 + len(init)))
+                row = 0
             steering, a = self.action_handler(mode, init, lane_map)
-            r = ode(self.dynamic)
-            r.set_initial_value(init).set_f_params([steering, a])
-            res: np.ndarray = r.integrate(r.t + time_step)
-            init = res.flatten()
-            if init[3] < 0:
-                init[3] = 0
-            trace[i + 1, 0] = time_step * (i + 1)
-            trace[i + 1, 1:] = init
-        return trace
+            if self.integrator is None:
+                r = ode(self.dynamic)
+                r.set_initial_value(init).set_f_params([steering, a])
+                res: np.ndarray = r.integrate(r.t + time_step)
+                init = res.flatten()
+                if init[3] < 0:
+                    init[3] = 0
+            else:
+                init = integrators.integrate(
+                    self.dynamic,
+                    time_step * i,
+                    init,
+                    time_step,
+                    (steering, a),
+                    self.integrator,
+                    buffer=buffer,
+                )
+                _clamp_speed(init)
+            chunk[row, 0] = time_step * (i + 1)
+            chunk[row, 1:] = init
+            row += 1
+        yield chunk
 
 
 class WeirdCarAgent(CarAgent):
@@ -1,5 +1,7 @@
 from .analysis_tree import *
 from .simulator import Simulator
 from .verifier import Verifier, ReachabilityMethod
+from .scheduler import Scheduler, SchedulingPolicy
+from .executor import ExecutorBackend
 
-from . import simulator, verifier, analysis_tree
+from . import simulator, verifier, analysis_tree, scheduler, executor
@@ -1,7 +1,7 @@
 from enum import Enum, auto
 from functools import reduce
 from typing import Any, Iterable, List, Dict, Optional, Sequence, TypeVar, Literal
-import json
+import copy, json
 import numpy.typing as nptyp, numpy as np, portion
 import networkx as nx
 from matplotlib import colors
@@ -50,7 +50,8 @@ class AnalysisTreeNode:
     trace: Dict[str, TraceType]
     """The trace for each agent.
     The key of the dict is the agent id and the value of the dict is the simulated traces for each
-    agent"""
+    agent. For reachability, rows alternate between the lower and upper bounds of each rect of the
+    reachtube"""
     init: Dict[str, Sequence[float]]
     """Initial conditions per agent for this node.
     The key of the dict is the agent id and the value of the dict is the range/set of initial
@@ -87,6 +88,9 @@ class AnalysisTreeNode:
     agent"""
     id: int
     """Integer ID for the current node. Unique amongst all nodes in the AnalysisTree"""
+    partition: Optional[int]
+    """Index of the part of the initial set this node was verified from, when `Scenario.verify`
+    refined the initial set (see `ScenarioConfig.refine_budget`). None otherwise."""
 
     def __init__(
         self,
@@ -103,6 +107,7 @@ class AnalysisTreeNode:
         ndigits: int,
         type: AnalysisTreeNodeType,
         id: int,
+        partition: Optional[int] = None,
     ) -> None:
         self.trace = trace
         self.init = init
@@ -117,6 +122,7 @@ class AnalysisTreeNode:
         self.uncertain_param = uncertain_param
         self.id = id
         self.ndigits = ndigits
+        self.partition = partition
 
     @staticmethod
     def root_from_inits(
@@ -168,8 +174,17 @@ class AnalysisTreeNode:
             assert_hits={},
             start_time=start_time,
             id=id,
+            partition=self.partition,
         )
 
+    def without_agents(self) -> "AnalysisTreeNode":
+        """A shallow copy of the node without `agent` and `child`. Used to send nodes to workers,
+        which already hold the agents, without serializing the agents and their decision logic."""
+        node = copy.copy(self)
+        node.agent = None
+        node.child = []
+        return node
+
     def _to_dict(self) -> Dict[str, Any]:
         rst_dict = {
             "id": self.id,
@@ -181,15 +196,12 @@ class AnalysisTreeNode:
             "height": self.height,
             "static": self.static,
             "start_time": self.start_time,
-            "trace": (
-                {aid: t.tolist() for aid, t in self.trace.items()}
-                if self.type == AnalysisTreeNodeType.SIM_TRACE
-                else self.trace
-            ),
+            "trace": {aid: np.asarray(t).tolist() for aid, t in self.trace.items()},
             "type": str(self.type),
             "assert_hits": self.assert_hits,
             "uncertain_param": self.uncertain_param,
             "ndigits": self.ndigits,
+            "partition": self.partition,
         }
         agent_dict = {}
         for agent_id in self.agent:
@@ -223,11 +235,7 @@ class AnalysisTreeNode:
     @staticmethod
     def _from_dict(data: Dict[str, Any]) -> "AnalysisTreeNode":
         return AnalysisTreeNode(
-            trace=(
-                {aid: np.array(data["trace"][aid]) for aid in data["agent"].keys()}
-                if data["type"] == "simtrace"
-                else data["trace"]
-            ),
+            trace={aid: np.array(data["trace"][aid]) for aid in data["agent"].keys()},
             id=data["id"],
             init=data["init"],
             mode=data["mode"],
@@ -240,6 +248,7 @@ class AnalysisTreeNode:
             type=AnalysisTreeNodeType._from_str(data["type"]),
             uncertain_param=data["uncertain_param"],
             ndigits=data["ndigits"],
+            partition=data.get("partition"),
         )
 
 
@@ -258,11 +267,15 @@ class AnalysisTree:
     """All nodes in the tree. Order is not guaranteed"""
     type: AnalysisTreeNodeType
     """Type of the analysis tree"""
+    complete: bool
+    """False when verification stopped at its budget before exploring every node, in which case
+    the tree only holds the nodes that were verified"""
 
-    def __init__(self, root: AnalysisTreeNode) -> None:
+    def __init__(self, root: AnalysisTreeNode, complete: bool = True) -> None:
         self.root = root
         self.nodes = self._get_all_nodes(root)
         self.type = root.type
+        self.complete = complete
 
     @staticmethod
     def _get_all_nodes(root: AnalysisTreeNode) -> List[AnalysisTreeNode]:
@@ -281,6 +294,8 @@ class AnalysisTree:
         """Dumps the AnalysisTree as JSON data to the file "fn"."""
         res_dict = {}
         converted_node = self.root._to_dict()
+        if not self.complete:
+            converted_node["complete"] = False
         res_dict[self.root.id] = converted_node
         queue = [self.root]
         while queue:
@@ -310,7 +325,7 @@ class AnalysisTree:
                 child_node = AnalysisTreeNode._from_dict(child_node_dict)
                 parent_node.child.append(child_node)
                 queue.append((child_node_dict, child_node))
-        return AnalysisTree(root)
+        return AnalysisTree(root, root_node_dict.get("complete", True))
 
     # TODO Generalize to different timesteps
     def contains(
@@ -0,0 +1,185 @@
+from typing import Any, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+Entry = Tuple[np.ndarray, np.ndarray, Any]
+
+
+class _PackedKDTree:
+    """Static k-d tree over points, stored as arrays in heap order: node `i` has children `2i + 1`
+    and `2i + 2`. Each node covers a contiguous range of the sorted points, split at the middle
+    along the coordinate with the largest spread, and keeps the componentwise min and max of its
+    points so that queries can skip or take whole subtrees."""
+
+    LEAF_SIZE = 64
+
+    def __init__(self, points: np.ndarray, seqs: np.ndarray, data: List[Any]):
+        n = len(points)
+        self.depth = max(0, int(np.ceil(np.log2(n / self.LEAF_SIZE)))) if n > 0 else 0
+        size = 2 ** (self.depth + 1) - 1
+        order = np.arange(n)
+        self.starts = np.zeros(size, dtype=int)
+        self.ends = np.zeros(size, dtype=int)
+        self.mins = np.full((size, points.shape[1]), np.inf)
+        self.maxs = np.full((size, points.shape[1]), -np.inf)
+        self.ends[0] = n
+        for node in range(size):
+            start, end = self.starts[node], self.ends[node]
+            if start < end:
+                pts = points[order[start:end]]
+                self.mins[node] = pts.min(axis=0)
+                self.maxs[node] = pts.max(axis=0)
+            if 2 * node + 1 >= size:
+                continue
+            mid = (start + end) // 2
+            if end - start > 1:
+                axis = int(np.argmax(self.maxs[node] - self.mins[node]))
+                part = np.argpartition(pts[:, axis], mid - start)
+                order[start:end] = order[start:end][part]
+            self.starts[2 * node + 1], self.ends[2 * node + 1] = start, mid
+            self.starts[2 * node + 2], self.ends[2 * node + 2] = mid, end
+        self.points = points[order]
+        self.seqs = seqs[order]
+        self.data = [data[i] for i in order]
+        # Nodes are visited one at a time, which is faster on Python floats than on NumPy rows
+        self.starts, self.ends = self.starts.tolist(), self.ends.tolist()
+        self.mins, self.maxs = self.mins.tolist(), self.maxs.tolist()
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def dominated(self, query: np.ndarray) -> np.ndarray:
+        """Positions of the points `p` with `p <= query` in every coordinate"""
+        res = []
+        bound = query.tolist()
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if any(low > q for low, q in zip(self.mins[node], bound)):
+                continue
+            start, end = self.starts[node], self.ends[node]
+            if all(high <= q for high, q in zip(self.maxs[node], bound)):
+                res.append(np.arange(start, end))
+            elif 2 * node + 1 < len(self.starts):
+                stack.extend((2 * node + 2, 2 * node + 1))
+            else:
+                hits = (self.points[start:end] <= query).all(1)
+                res.append(start + hits.nonzero()[0])
+        if not res:
+            return np.zeros(0, dtype=int)
+        return np.concatenate(res)
+
+
+class BoxIndex:
+    """
+    Index of axis aligned boxes answering which boxes contain a given box. A box with bounds
+    `lower`, `upper` is stored as the point `(lower, -upper)`, so that the boxes containing a query
+    box are the points below the query's point in every coordinate. New points go to a buffer that
+    is scanned directly; full buffers are merged into packed k-d trees of doubling sizes, so that
+    adding stays cheap while a query visits a logarithmic number of trees, each down to its depth.
+    Removed boxes are skipped until they make up most of the index, which is then rebuilt.
+    """
+
+    BUFFER_SIZE = 256
+
+    def __init__(self):
+        self.dims: Optional[int] = None
+        self.count = 0
+        self.buffer_points: Optional[np.ndarray] = None
+        self.buffer_seqs = np.zeros(self.BUFFER_SIZE, dtype=int)
+        self.buffer_data: List[Any] = []
+        self.trees: List[Optional[_PackedKDTree]] = []
+        self.removed: Set[int] = set()
+
+    def __len__(self) -> int:
+        stored = len(self.buffer_data) + sum(len(tree) for tree in self.trees if tree != None)
+        return stored - len(self.removed)
+
+    @staticmethod
+    def _point(lower, upper) -> np.ndarray:
+        return np.concatenate([np.asarray(lower, dtype=float), -np.asarray(upper, dtype=float)])
+
+    def _entry(self, point: np.ndarray, data: Any) -> Entry:
+        # Copied, buffer rows are reused
+        return point[: self.dims].copy(), -point[self.dims :], data
+
+    def add(self, lower, upper, data: Any) -> int:
+        """Adds the box with bounds `lower` and `upper` holding `data`. Returns a handle to
+        `remove` it."""
+        point = self._point(lower, upper)
+        if self.dims == None:
+            self.dims = len(point) // 2
+            self.buffer_points = np.zeros((self.BUFFER_SIZE, len(point)))
+        assert len(point) == 2 * self.dims, "boxes of an index must have the same dimensions"
+        seq = self.count
+        self.count += 1
+        self._insert(point, seq, data)
+        return seq
+
+    def remove(self, seq: int):
+        """Removes the box that `add` returned the handle `seq` for."""
+        assert 0 <= seq < self.count and seq not in self.removed
+        self.removed.add(seq)
+        if len(self.removed) < max(self.BUFFER_SIZE, len(self)):
+            return
+        entries = [(seq, point.copy(), data) for seq, point, data in self._entries()]
+        self.buffer_data, self.trees, self.removed = [], [], set()
+        for seq, point, data in entries:
+            self._insert(point, seq, data)
+
+    def _insert(self, point: np.ndarray, seq: int, data: Any):
+        size = len(self.buffer_data)
+        self.buffer_points[size] = point
+        self.buffer_seqs[size] = seq
+        self.buffer_data.append(data)
+        if size + 1 < self.BUFFER_SIZE:
+            return
+        points, seqs = [self.buffer_points.copy()], [self.buffer_seqs.copy()]
+        data = self.buffer_data
+        self.buffer_data = []
+        level = 0
+        while level < len(self.trees) and self.trees[level] != None:
+            tree = self.trees[level]
+            points.append(tree.points)
+            seqs.append(tree.seqs)
+            data = data + tree.data
+            self.trees[level] = None
+            level += 1
+        if level == len(self.trees):
+            self.trees.append(None)
+        self.trees[level] = _PackedKDTree(np.concatenate(points), np.concatenate(seqs), data)
+
+    def _entries(self) -> List[Tuple[int, np.ndarray, Any]]:
+        """The boxes that weren't removed as `(seq, point, data)`, in the order they were added."""
+        size = len(self.buffer_data)
+        entries = []
+        if size > 0:
+            buffered = self.buffer_seqs[:size], self.buffer_points[:size], self.buffer_data
+            entries.extend(zip(*buffered))
+        for tree in self.trees:
+            if tree != None:
+                entries.extend(zip(tree.seqs, tree.points, tree.data))
+        entries = [e for e in entries if e[0] not in self.removed]
+        return sorted(entries, key=lambda e: e[0])
+
+    def __iter__(self) -> Iterator[Entry]:
+        """The boxes as `(lower, upper, data)`, in the order they were added."""
+        for _, point, data in self._entries():
+            yield self._entry(point, data)
+
+    def containing(self, lower, upper) -> List[Entry]:
+        """The boxes that contain the box with bounds `lower` and `upper`, as
+        `(lower, upper, data)` in the order they were added."""
+        if self.dims == None:
+            return []
+        query = self._point(lower, upper)
+        size = len(self.buffer_data)
+        hits = (self.buffer_points[:size] <= query).all(1).nonzero()[0]
+        res = [(self.buffer_seqs[i], self.buffer_points[i], self.buffer_data[i]) for i in hits]
+        for tree in self.trees:
+            if tree != None:
+                res.extend(
+                    (tree.seqs[i], tree.points[i], tree.data[i]) for i in tree.dominated(query)
+                )
+        res.sort(key=lambda e: e[0])
+        return [self._entry(point, data) for seq, point, data in res if seq not in self.removed]
@@ -5,13 +5,25 @@ from scipy import spatial
 _TRUE_MIN_CONST = -10
 _EPSILON = 1.0e-6
 _SMALL_EPSILON = 1e-10
+_SENSITIVITY_CHUNK_ELEMENTS = 1 << 22
 SIMTRACENUM = 10
 
 PW = "PW"
 GLOBAL = "GLOBAL"
 
 
-def all_sensitivities_calc(training_traces: np.ndarray, initial_radii: np.ndarray):
+def all_sensitivities_calc(
+    training_traces: np.ndarray,
+    initial_radii: np.ndarray,
+    max_elements: int = _SENSITIVITY_CHUNK_ELEMENTS,
+):
+    """
+    For each dimension and time step, the largest ratio over all pairs of training traces between
+    their distance in that dimension and the Chebyshev distance of their initial points, both
+    normalized by the initial set radii. All pairs, dimensions and time steps are computed in one
+    broadcast, split into chunks of time steps so that at most `max_elements` ratios are held in
+    memory at once.
+    """
     num_traces: int
     trace_len: int
     ndims: int
@@ -19,28 +31,21 @@ def all_sensitivities_calc(training_traces: np.ndarray, initial_radii: np.ndarra
     normalizing_initial_set_radii: np.array = initial_radii.copy()
     y_points: np.array = np.zeros((normalizing_initial_set_radii.shape[0], trace_len - 1))
     normalizing_initial_set_radii[np.where(normalizing_initial_set_radii == 0)] = 1.0
-    for cur_dim_ind in range(1, ndims):
-        # keyi: move out of loop
-        normalized_initial_points: np.array = (
-            training_traces[:, 0, 1:] / normalizing_initial_set_radii
-        )
-        initial_distances = (
-            spatial.distance.pdist(normalized_initial_points, "chebyshev") + _SMALL_EPSILON
-        )
-        for cur_time_ind in range(1, trace_len):
-            y_points[cur_dim_ind - 1, cur_time_ind - 1] = np.max(
-                (
-                    spatial.distance.pdist(
-                        np.reshape(
-                            training_traces[:, cur_time_ind, cur_dim_ind],
-                            (training_traces.shape[0], 1),
-                        ),
-                        "chebychev",
-                    )
-                    / normalizing_initial_set_radii[cur_dim_ind - 1]
-                )
-                / initial_distances
-            )
+    # The pairs in the order `pdist` lists them
+    left, right = np.triu_indices(num_traces, 1)
+    normalized_initial_points: np.array = training_traces[:, 0, 1:] / normalizing_initial_set_radii
+    initial_distances = (
+        np.max(np.abs(normalized_initial_points[left] - normalized_initial_points[right]), axis=1)
+        + _SMALL_EPSILON
+    )
+    chunk_len = max(1, max_elements // max(1, len(left) * (ndims - 1)))
+    for start in range(1, trace_len, chunk_len):
+        end = min(start + chunk_len, trace_len)
+        points = training_traces[:, start:end, 1:]
+        ratios = (
+            np.abs(points[left] - points[right]) / normalizing_initial_set_radii
+        ) / initial_distances[:, None, None]
+        y_points[:, start - 1 : end - 1] = np.max(ratios, axis=0).T
     return y_points
 
 
@@ -247,6 +252,41 @@ def trimTraces(traces):
     return [trace[:trace_len] for trace in traces]
 
 
+def sample_traces(
+    mode_label,
+    initial_set,
+    center,
+    time_horizon,
+    time_step,
+    sim_func,
+    sim_trace_num,
+    lane_map=None,
+    sim_batch_func=None,
+):
+    """
+    Simulate the center and `sim_trace_num` random points of the initial set
+
+    Args:
+        sim_batch_func (function or None): batched simulation function. When given, all points
+            are simulated in one call, otherwise one `sim_func` call each
+
+    Returns:
+        traces (list) starting with the trace from the center
+
+    """
+    if sim_batch_func is None:
+        traces = [sim_func(mode_label, center, time_horizon, time_step, lane_map)]
+        # Simulate SIMTRACENUM times to learn the sensitivity
+        for i in range(sim_trace_num):
+            new_init_point = randomPoint(initial_set[0], initial_set[1], i)
+            traces.append(sim_func(mode_label, new_init_point, time_horizon, time_step, lane_map))
+        return traces
+    inits = [center] + [
+        randomPoint(initial_set[0], initial_set[1], i) for i in range(sim_trace_num)
+    ]
+    return list(sim_batch_func(mode_label, inits, time_horizon, time_step, lane_map))
+
+
 def calc_bloated_tube(
     mode_label,
     initial_set,
@@ -259,6 +299,7 @@ def calc_bloated_tube(
     guard_checker=None,
     guard_str="",
     lane_map=None,
+    sim_batch_func=None,
 ):
     """
     This function calculate the reach tube for single given mode
@@ -273,6 +314,8 @@ def calc_bloated_tube(
         kvalue (list): list of float used when bloating method set to PW
         guard_checker (verse.core.guard.Guard or None): guard check object
         guard_str (str): guard string
+        sim_batch_func (function or None): batched simulation function with the signature of
+            `TC_simulate_batch`. When given, the center and sample points are simulated in one call
 
     Returns:
         Bloated reach tube
@@ -282,11 +325,17 @@ def calc_bloated_tube(
     # random.seed(4)
     cur_center = calcCenterPoint(initial_set[0], initial_set[1])
     cur_delta = calcDelta(initial_set[0], initial_set[1])
-    traces = [sim_func(mode_label, cur_center, time_horizon, time_step, lane_map)]
-    # Simulate SIMTRACENUM times to learn the sensitivity
-    for i in range(sim_trace_num):
-        new_init_point = randomPoint(initial_set[0], initial_set[1], i)
-        traces.append(sim_func(mode_label, new_init_point, time_horizon, time_step, lane_map))
+    traces = sample_traces(
+        mode_label,
+        initial_set,
+        cur_center,
+        time_horizon,
+        time_step,
+        sim_func,
+        sim_trace_num,
+        lane_map,
+        sim_batch_func,
+    )
 
     # Trim the trace to the same length
     traces = trimTraces(traces)
@@ -317,3 +366,40 @@ def calc_bloated_tube(
     final_tube[1::2, :] = cur_reach_tube[:, 1, :]
     # print(final_tube.tolist()[-2], final_tube.tolist()[-1])
     return final_tube
+
+
+def extend_bloated_tube(
+    tube,
+    mode_label,
+    time_horizon,
+    time_step,
+    sim_func,
+    bloating_method,
+    kvalue,
+    sim_trace_num,
+    lane_map=None,
+    sim_batch_func=None,
+):
+    """
+    Extends a bloated tube computed over a shorter horizon to `time_horizon`, bloating only the
+    rest of it, from the last box of `tube`. As the dynamics of a mode don't depend on time, the
+    result contains the tube that `calc_bloated_tube` would give.
+
+    Returns:
+        Bloated reach tube
+    """
+    duration = tube[-1, 0] - tube[0, 0]
+    rest = calc_bloated_tube(
+        mode_label,
+        [tube[-2, 1:].tolist(), tube[-1, 1:].tolist()],
+        round(time_horizon - duration, 10),
+        time_step,
+        sim_func,
+        bloating_method,
+        kvalue,
+        sim_trace_num,
+        lane_map=lane_map,
+        sim_batch_func=sim_batch_func,
+    )
+    rest[:, 0] += tube[-1, 0]
+    return np.vstack((tube, rest))
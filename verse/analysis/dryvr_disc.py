@@ -2,6 +2,8 @@ import random, numpy as np
 from typing import List, Tuple
 from scipy import spatial
 
+from verse.analysis.dryvr import all_sensitivities_calc, sample_traces
+
 _TRUE_MIN_CONST = -10
 _EPSILON = 1.0e-6
 _SMALL_EPSILON = 1e-10
@@ -10,29 +12,6 @@ SIMTRACENUM = 10
 PW = "PW"
 GLOBAL = "GLOBAL"
 
-def all_sensitivities_calc(training_traces: np.ndarray, initial_radii: np.ndarray):
-    num_traces: int
-    trace_len: int
-    ndims: int
-    num_traces, trace_len, ndims = training_traces.shape
-    normalizing_initial_set_radii: np.array = initial_radii.copy()
-    y_points: np.array = np.zeros(
-        (normalizing_initial_set_radii.shape[0], trace_len - 1))
-    normalizing_initial_set_radii[np.where(
-        normalizing_initial_set_radii == 0)] = 1.0
-    for cur_dim_ind in range(1, ndims):
-        # keyi: move out of loop
-        normalized_initial_points: np.array = training_traces[:,
-                                                              0, 1:] / normalizing_initial_set_radii
-        initial_distances = spatial.distance.pdist(
-            normalized_initial_points, 'chebyshev') + _SMALL_EPSILON
-        for cur_time_ind in range(1, trace_len):
-            y_points[cur_dim_ind - 1, cur_time_ind - 1] = np.max((spatial.distance.pdist(
-                np.reshape(training_traces[:, cur_time_ind, cur_dim_ind],
-                           (training_traces.shape[0], 1)), 'chebychev'
-            ) / normalizing_initial_set_radii[cur_dim_ind - 1]) / initial_distances)
-    return y_points
-
 def get_reachtube_segment(training_traces: np.ndarray, initial_radii: np.ndarray, method='PWGlobal') -> np.array:
     num_traces: int = training_traces.shape[0]
     ndims: int = training_traces.shape[2]  # This includes time
@@ -210,7 +189,8 @@ def calc_bloated_tube_dryvr(
         guard_checker=None,
         guard_str="",
         lane_map = None,
-        traces = None
+        traces = None,
+        sim_batch_func = None
     ):
     """
     This function calculate the reach tube for single given mode
@@ -225,7 +205,9 @@ def calc_bloated_tube_dryvr(
         kvalue (list): list of float used when bloating method set to PW
         guard_checker (verse.core.guard.Guard or None): guard check object
         guard_str (str): guard string
-       
+        traces (list or None): sample traces to use instead of simulating them
+        sim_batch_func (function or None): batched simulation function, see `calc_bloated_tube`
+
     Returns:
         Bloated reach tube
 
@@ -234,11 +216,8 @@ def calc_bloated_tube_dryvr(
     cur_center = calcCenterPoint(initial_set[0], initial_set[1])
     cur_delta = calcDelta(initial_set[0], initial_set[1])
     if traces is None:
-        traces = [sim_func(mode_label, cur_center, time_horizon, time_step, lane_map)]
-        # Simulate SIMTRACENUM times to learn the sensitivity
-        for i in range(sim_trace_num):
-            new_init_point = randomPoint(initial_set[0], initial_set[1], i)
-            traces.append(sim_func(mode_label, new_init_point, time_horizon, time_step, lane_map))
+        traces = sample_traces(mode_label, initial_set, cur_center, time_horizon, time_step,
+                               sim_func, sim_trace_num, lane_map, sim_batch_func)
     # Trim the trace to the same length
     traces = trimTraces(traces)
     if guard_checker is not None:
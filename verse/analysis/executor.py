@@ -0,0 +1,274 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from abc import ABC, abstractmethod
+from enum import Enum, auto
+import atexit, math, os, tempfile, time, uuid
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+
+class ExecutorBackend(Enum):
+    """Where the tasks of parallel simulation/verification run."""
+
+    RAY = auto()
+    """Ray tasks. Scales past one machine, but takes seconds to start."""
+    PROCESS = auto()
+    """A `concurrent.futures.ProcessPoolExecutor` on the local machine."""
+    THREAD = auto()
+    """A `concurrent.futures.ThreadPoolExecutor`. Cheap to start, but only runs tasks concurrently
+    where they release the GIL. Verification tasks run one at a time since z3 isn't thread safe."""
+    INLINE = auto()
+    """Runs every task as soon as it is submitted, in the calling thread. Useful for debugging the
+    parallel code path."""
+
+
+class Executor(ABC):
+    """Interface of the parallel backends. `submit` starts a task and returns a handle to it,
+    `wait` blocks until one of the given handles is done and returns it together with the others,
+    and `get` returns the result of a done handle. `put` ships an argument that is shared by many
+    tasks to the workers once, returning a reference that can be passed to `submit` in its place,
+    and `release` frees it once the tasks are done."""
+
+    def put(self, obj: Any) -> Any:
+        return obj
+
+    def release(self, ref: Any):
+        pass
+
+    @abstractmethod
+    def submit(self, fn: Callable, *args) -> Any:
+        pass
+
+    @abstractmethod
+    def wait(self, handles: List[Any]) -> Tuple[Any, List[Any]]:
+        pass
+
+    @abstractmethod
+    def get(self, handle: Any) -> Any:
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class RayExecutor(Executor):
+    def __init__(self, num_workers: Optional[int] = None):
+        import ray
+
+        if not ray.is_initialized():
+            ray.init(num_cpus=num_workers)
+        self.remote_fns: Dict[Callable, Any] = {}
+
+    def put(self, obj: Any) -> Any:
+        import ray
+
+        return ray.put(obj)
+
+    def submit(self, fn: Callable, *args) -> Any:
+        import ray
+
+        if fn not in self.remote_fns:
+            self.remote_fns[fn] = ray.remote(fn)
+        return self.remote_fns[fn].remote(*args)
+
+    def wait(self, handles: List[Any]) -> Tuple[Any, List[Any]]:
+        import ray
+
+        [done], remaining = ray.wait(handles)
+        return done, remaining
+
+    def get(self, handle: Any) -> Any:
+        import ray
+
+        return ray.get(handle)
+
+
+class PoolExecutor(Executor):
+    """Runs tasks on a `concurrent.futures` pool."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self.pool.submit(fn, *args)
+
+    def wait(self, handles: List[Future]) -> Tuple[Future, List[Future]]:
+        done, _ = wait(handles, return_when=FIRST_COMPLETED)
+        # Take the earliest submitted of the finished tasks
+        idx = next(i for i, handle in enumerate(handles) if handle in done)
+        return handles[idx], handles[:idx] + handles[idx + 1 :]
+
+    def get(self, handle: Future) -> Any:
+        return handle.result()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class _SharedRef:
+    """Reference to an object `put` by a `ProcessExecutor`. The object is written to a file once and
+    loaded by each worker the first time it sees the reference."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+
+# Objects loaded by this worker process, by path. Only the latest few are kept.
+_worker_shared: Dict[str, Any] = {}
+_WORKER_SHARED_SIZE = 4
+
+
+def _cloudpickle():
+    # Imported on first use, so that importing verse doesn't load it
+    try:
+        import cloudpickle
+    except ImportError as e:
+        raise ImportError(
+            "ExecutorBackend.PROCESS needs cloudpickle to send the decision logic to the workers,"
+            " install it with `pip install cloudpickle`"
+        ) from e
+    return cloudpickle
+
+
+def _resolve(arg: Any) -> Any:
+    if not isinstance(arg, _SharedRef):
+        return arg
+    if arg.path not in _worker_shared:
+        with open(arg.path, "rb") as f:
+            obj = _cloudpickle().load(f)
+        if len(_worker_shared) >= _WORKER_SHARED_SIZE:
+            del _worker_shared[next(iter(_worker_shared))]
+        _worker_shared[arg.path] = obj
+    return _worker_shared[arg.path]
+
+
+def _call_pickled(payload: bytes) -> bytes:
+    cloudpickle = _cloudpickle()
+    fn, args = cloudpickle.loads(payload)
+    return cloudpickle.dumps(fn(*[_resolve(arg) for arg in args]))
+
+
+class ProcessExecutor(PoolExecutor):
+    """Runs tasks on a `ProcessPoolExecutor`. Tasks and results are serialized with cloudpickle, as
+    Ray does, since the parsed decision logic holds code objects that `pickle` can't handle."""
+
+    def __init__(self, num_workers: Optional[int] = None):
+        super().__init__(ProcessPoolExecutor(num_workers))
+        # Files of the objects `put` and not released yet, removed on `shutdown` otherwise
+        self.shared_paths: Set[str] = set()
+
+    def put(self, obj: Any) -> _SharedRef:
+        fd, path = tempfile.mkstemp(prefix=f"verse-{uuid.uuid4().hex}-", suffix=".pkl")
+        done = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                _cloudpickle().dump(obj, f)
+            done = True
+        finally:
+            if not done:
+                os.remove(path)
+        self.shared_paths.add(path)
+        return _SharedRef(path)
+
+    def release(self, ref: _SharedRef):
+        self.shared_paths.discard(ref.path)
+        if os.path.exists(ref.path):
+            os.remove(ref.path)
+
+    def shutdown(self):
+        super().shutdown()
+        for path in list(self.shared_paths):
+            self.release(_SharedRef(path))
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self.pool.submit(_call_pickled, _cloudpickle().dumps((fn, args)))
+
+    def get(self, handle: Future) -> Any:
+        return _cloudpickle().loads(handle.result())
+
+
+class InlineExecutor(PoolExecutor):
+    def __init__(self):
+        super().__init__(None)
+
+    def submit(self, fn: Callable, *args) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self):
+        pass
+
+
+def run_fused(fn: Callable, calls: List[tuple], shared: Any) -> Tuple[List[Any], float]:
+    """Runs `fn(*args, shared)` for each `args` in `calls` as a single task. Returns the results and
+    the time it took."""
+    start = time.perf_counter()
+    results = [fn(*args, shared) for args in calls]
+    return results, time.perf_counter() - start
+
+
+class TaskFusion:
+    """Decides how many queued nodes to fuse into one task, so that each task runs for about
+    `target_duration` seconds. The per node runtime is an exponential moving average over the
+    fused tasks that finished so far."""
+
+    def __init__(self, target_duration: float, max_size: int = 64):
+        self.target_duration = target_duration
+        self.max_size = max_size
+        self.node_duration: Optional[float] = None
+
+    def record(self, duration: float, count: int):
+        per_node = duration / max(count, 1)
+        if self.node_duration == None:
+            self.node_duration = per_node
+        else:
+            self.node_duration = 0.8 * self.node_duration + 0.2 * per_node
+
+    def size(self, queued: int, free_slots: int) -> int:
+        """Batch size given the number of `queued` nodes and the number of tasks that can still be
+        dispatched. Never fuses so much that dispatch slots stay empty."""
+        if self.node_duration == None:
+            return 1
+        size = self.max_size
+        if self.node_duration > 0:
+            size = min(size, max(1, int(self.target_duration / self.node_duration)))
+        return max(1, min(size, math.ceil(queued / max(free_slots, 1))))
+
+
+_executors: Dict[Tuple[ExecutorBackend, Optional[int]], Executor] = {}
+
+
+def get_executor(backend: ExecutorBackend, num_workers: Optional[int] = None) -> Executor:
+    """Returns the executor for `backend`. Executors are created on first use and then reused, so
+    that the cost of starting the workers is only paid once per process."""
+    key = (backend, num_workers)
+    if key not in _executors:
+        if backend == ExecutorBackend.RAY:
+            _executors[key] = RayExecutor(num_workers)
+        elif backend == ExecutorBackend.PROCESS:
+            _executors[key] = ProcessExecutor(num_workers)
+        elif backend == ExecutorBackend.THREAD:
+            _executors[key] = PoolExecutor(ThreadPoolExecutor(num_workers))
+        elif backend == ExecutorBackend.INLINE:
+            _executors[key] = InlineExecutor()
+        else:
+            raise ValueError(f"unsupported executor backend {backend}")
+    return _executors[key]
+
+
+def shutdown_executors():
+    """Shuts down the pools started by `get_executor`. Called when the interpreter exits."""
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
+
+
+atexit.register(shutdown_executors)
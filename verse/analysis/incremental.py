@@ -1,10 +1,11 @@
-from collections import defaultdict
-from dataclasses import dataclass
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, fields, is_dataclass
 from pprint import pp
-from typing import Any, DefaultDict, List, Tuple, Optional, Dict, Set
+from typing import Any, DefaultDict, Hashable, List, Tuple, Optional, Dict, Set
 from verse.agents.base_agent import BaseAgent
 from verse.analysis import AnalysisTreeNode
-from intervaltree import IntervalTree
+from verse.analysis.box_index import BoxIndex
+from verse.analysis.persistent_cache import PersistentCache
 import itertools, copy, numpy.typing as nptyp, numpy as np
 
 from verse.analysis.dryvr import _EPSILON
@@ -28,6 +29,7 @@ class CachedSegment:
     asserts: List[str]
     transitions: List[CachedTransition]
     node_ids: Set[Tuple[int, int]]
+    horizon: float  # remaining time of the nodes
 
 
 @dataclass
@@ -46,6 +48,7 @@ class CachedRTTrans:
     asserts: List[str]
     transitions: List[CachedReachTrans]
     node_ids: Set[Tuple[int, int]]  # run_num, node_id
+    horizon: float  # remaining time of the nodes
 
 
 def to_simulate(
@@ -120,6 +123,36 @@ def convert_reach_trans(agent_id, transit_agents, inits, transition, trans_ind):
         return []
 
 
+# Tolerance on times, in time steps
+_TIME_TOL = 1e-6
+
+
+def truncate_trace(trace: np.ndarray, time_horizon: float, time_step: float) -> np.ndarray:
+    """The rows of `trace` up to `time_horizon` after its first one."""
+    times = trace[:, 0] - trace[0, 0]
+    return trace[: np.searchsorted(times, time_horizon + _TIME_TOL * time_step, side="right")]
+
+
+def truncate_tube(tube: np.ndarray, time_horizon: float, time_step: float) -> np.ndarray:
+    """The boxes, as pairs of lower and upper rows, of `tube` that end by `time_horizon` after its
+    start."""
+    ends = tube[1::2, 0] - tube[0, 0]
+    return tube[: 2 * np.searchsorted(ends, time_horizon + _TIME_TOL * time_step, side="right")]
+
+
+def tube_fits(tube: np.ndarray, time_horizon: float, time_step: float) -> bool:
+    """Whether `tube` is over `time_horizon`, with nothing to cut or continue."""
+    return time_left(tube, time_horizon, time_step) == 0 and len(
+        truncate_tube(tube, time_horizon, time_step)
+    ) == len(tube)
+
+
+def time_left(trace: np.ndarray, time_horizon: float, time_step: float) -> float:
+    """How much longer than `trace` (or a tube) `time_horizon` is, or 0 if it isn't."""
+    left = round(time_horizon - (trace[-1, 0] - trace[0, 0]), 10)
+    return left if left > _TIME_TOL * time_step else 0
+
+
 def combine_all(inits):
     return [
         [min(a) for a in np.transpose(np.array(inits)[:, 0])],
@@ -158,9 +191,88 @@ class CachedTube:
         return (self.tube == other.tube).all()
 
 
+def approx_size(obj: Any) -> int:
+    """Rough number of bytes held by a cache entry: arrays by their buffers, Python numbers and
+    containers by their usual sizes. The decision logic paths are shared with the agents, so they
+    aren't counted."""
+    if obj is None:
+        return 0
+    if isinstance(obj, np.ndarray):
+        return 112 + obj.nbytes
+    if isinstance(obj, (bool, int, float)):
+        return 24
+    if isinstance(obj, str):
+        return 49 + len(obj)
+    if isinstance(obj, (list, tuple, set)):
+        return 56 + 8 * len(obj) + sum(approx_size(item) for item in obj)
+    if isinstance(obj, dict):
+        return 64 + sum(24 + approx_size(k) + approx_size(v) for k, v in obj.items())
+    if is_dataclass(obj):
+        return 56 + sum(approx_size(getattr(obj, f.name)) for f in fields(obj) if f.name != "paths")
+    return 0
+
+
+class CacheBudget:
+    """
+    Size aware LRU eviction shared by the incremental caches. The caches report the entries they
+    add and hit; once the `approx_size` of all entries is over `max_bytes`, the least recently used
+    ones are evicted from their caches. Evicted entries are only missed, as the caches hold the
+    `node_ids` of the past runs an entry came from, and never the other way around. None for no
+    limit.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        # By id of the entry, its cache, key, handle in the index of the key, size and the entry
+        self.entries: "OrderedDict[int, Tuple[Any, tuple, int, int, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, cache, key: tuple, seq: int, entry: Any):
+        size = approx_size(entry)
+        self.entries[id(entry)] = cache, key, seq, size, entry
+        self.size += size
+        self.evict()
+
+    def touch(self, entry: Any):
+        if id(entry) in self.entries:
+            self.entries.move_to_end(id(entry))
+
+    def update(self, entry: Any):
+        """Recomputes the size of `entry` after it grew, e.g. by more transitions."""
+        if id(entry) not in self.entries:
+            return
+        cache, key, seq, size, _ = self.entries[id(entry)]
+        new_size = approx_size(entry)
+        self.entries[id(entry)] = cache, key, seq, new_size, entry
+        self.entries.move_to_end(id(entry))
+        self.size += new_size - size
+        self.evict()
+
+    def evict(self):
+        while self.max_bytes != None and self.size > self.max_bytes and self.entries:
+            _, (cache, key, seq, size, _) = self.entries.popitem(last=False)
+            cache.evict(key, seq)
+            self.size -= size
+            self.evictions += 1
+
+
+def _evict(cache: DefaultDict[tuple, BoxIndex], key: tuple, seq: int):
+    cache[key].remove(seq)
+    if len(cache[key]) == 0:
+        del cache[key]
+
+
 class SimTraceCache:
-    def __init__(self):
-        self.cache: DefaultDict[tuple, IntervalTree] = defaultdict(IntervalTree)
+    def __init__(self, budget: Optional[CacheBudget] = None):
+        self.cache: DefaultDict[tuple, BoxIndex] = defaultdict(BoxIndex)
+        self.budget = budget
+
+    def evict(self, key: tuple, seq: int):
+        _evict(self.cache, key, seq)
 
     def add_segment(
         self,
@@ -171,92 +283,99 @@ class SimTraceCache:
         transition,
         trans_ind: int,
         run_num: int,
+        horizon: float,
     ):
         key = (agent_id,) + tuple(node.mode[agent_id])
-        init = node.init[agent_id]
-        tree = self.cache[key]
+        init = np.array(node.init[agent_id], dtype=float)
         assert_hits = node.assert_hits or {}
         # pp(('add seg', agent_id, *node.mode[agent_id], *init))
-        for i, val in enumerate(init):
-            if i == len(init) - 1:
-                transitions = convert_sim_trans(
-                    agent_id, transit_agents, node.init, transition, trans_ind
-                )
-                entry = CachedSegment(
-                    trace, assert_hits.get(agent_id), transitions, set([(run_num, node.id)])
-                )
-                tree[val - _EPSILON : val + _EPSILON] = entry
-                return entry
-            else:
-                next_level_tree = IntervalTree()
-                tree[val - _EPSILON : val + _EPSILON] = next_level_tree
-                tree = next_level_tree
-        raise Exception("???")
-
-    @staticmethod
-    def iter_tree(tree, depth: int) -> List[List[float]]:
-        if depth == 0:
-            return [
-                [
-                    (i.begin + i.end) / 2,
-                    (
-                        i.data.node_ids,
-                        [t.transition for t in i.data.transitions],
-                        len(i.data.trace),
-                    ),
-                ]
-                for i in tree
-            ]
-        res = []
-        for i in tree:
-            mid = (i.begin + i.end) / 2
-            subs = SimTraceCache.iter_tree(i.data, depth - 1)
-            res.extend([mid] + sub for sub in subs)
-        return res
-
-    def get_cached_inits(self, n: int):
+        transitions = convert_sim_trans(agent_id, transit_agents, node.init, transition, trans_ind)
+        entry = CachedSegment(
+            trace, assert_hits.get(agent_id), transitions, set([(run_num, node.id)]), horizon
+        )
+        seq = self.cache[key].add(init - _EPSILON, init + _EPSILON, entry)
+        if self.budget != None:
+            self.budget.add(self, key, seq, entry)
+        return entry
+
+    def get_cached_inits(self):
         inits = defaultdict(list)
-        for key, tree in self.cache.items():
-            inits[key[0]].extend((*key[1:], *init) for init in self.iter_tree(tree, n))
+        for key, index in self.cache.items():
+            for lower, upper, entry in index:
+                info = entry.node_ids, [t.transition for t in entry.transitions], len(entry.trace)
+                inits[key[0]].append((*key[1:], *((lower + upper) / 2).tolist(), info))
         inits = {k: sorted(v) for k, v in inits.items()}
         return inits
 
-    @staticmethod
-    def query_cont(tree: IntervalTree, cont: List[float]) -> List[CachedSegment]:
-        assert isinstance(tree, IntervalTree)
-        next_level_entries = [t.data for t in tree[cont[0]]]
-        if len(cont) == 1:
-            for ent in next_level_entries:
-                assert isinstance(ent, CachedSegment)
-            return next_level_entries
-        else:
-            return [
-                ent for t in next_level_entries for ent in SimTraceCache.query_cont(t, cont[1:])
-            ]
-
     def check_hit(
-        self, agent_id: str, mode: Tuple[str], init: List[float], inits: Dict[str, List[float]]
+        self,
+        agent_id: str,
+        mode: Tuple[str],
+        init: List[float],
+        inits: Dict[str, List[float]],
+        horizon: Optional[float] = None,
     ) -> Optional[CachedSegment]:
+        """The segment cached for `init`. Its transitions only apply to nodes with the same
+        remaining time, so when `horizon` is given, only segments with that `horizon` are hit.
+        Otherwise the one with the longest trace is preferred."""
         key = (agent_id,) + tuple(mode)
         if key not in self.cache:
             return None
-        tree = self.cache[key]
-        entries = self.query_cont(tree, init)
+        entries = [entry for _, _, entry in self.cache[key].containing(init, init)]
+        if horizon != None:
+            entries = [e for e in entries if e.horizon == horizon]
         if len(entries) == 0:
             return None
 
         def num_trans_suit(e: CachedSegment) -> int:
             return sum(1 if sim_trans_suit(t.inits, inits) else 0 for t in e.transitions)
 
-        entries = list(sorted([(e, -num_trans_suit(e)) for e in entries], key=lambda p: p[1]))
+        entries = list(
+            sorted([(e, (-num_trans_suit(e), -e.horizon)) for e in entries], key=lambda p: p[1])
+        )
         # pp(("check hit entries", len(entries), entries[0][1]))
         assert isinstance(entries[0][0], (type(None), CachedSegment))
+        if self.budget != None:
+            self.budget.touch(entries[0][0])
         return entries[0][0]
 
 
 class TubeCache:
-    def __init__(self):
-        self.cache: DefaultDict[tuple, IntervalTree] = defaultdict(IntervalTree)
+    def __init__(self, budget: Optional[CacheBudget] = None):
+        self.cache: DefaultDict[tuple, BoxIndex] = defaultdict(BoxIndex)
+        self.budget = budget
+        self.store: Optional[PersistentCache] = None
+        self.fingerprints: Dict[str, str] = {}
+        self.context: Hashable = None
+        # Groups of the store whose tubes were loaded already
+        self.loaded: Set[str] = set()
+
+    def bind(
+        self, store: Optional[PersistentCache], fingerprints: Dict[str, str], context: Hashable
+    ):
+        """Backs the cache with `store` for a run whose agents have the given `fingerprints`, and
+        whose tubes depend on the parameters in `context`. The tubes of an agent and mode are
+        loaded from the store the first time they are needed, and the new ones are added to it."""
+        self.store, self.fingerprints, self.context = store, fingerprints, context
+
+    def evict(self, key: tuple, seq: int):
+        _evict(self.cache, key, seq)
+
+    def _add(self, key: tuple, low: np.ndarray, high: np.ndarray, entry: CachedTube):
+        seq = self.cache[key].add(low, high + _EPSILON, entry)
+        if self.budget != None:
+            self.budget.add(self, key, seq, entry)
+
+    def _load(self, key: tuple) -> Optional[str]:
+        """The group of `key` in the store, loading its tubes if needed."""
+        if self.store == None:
+            return None
+        group = repr((self.fingerprints[key[0]], key, self.context))
+        if group not in self.loaded:
+            self.loaded.add(group)
+            for low, high, trace in self.store.get_tubes(group):
+                self._add(key, low, high, CachedTube(trace))
+        return group
 
     def add_tube(
         self,
@@ -266,40 +385,52 @@ class TubeCache:
         trace: List[List[List[float]]],
     ):
         key = (agent_id,) + tuple(mode)
-        init = list(map(list, zip(*init)))
-        tree = self.cache[key]
-        for i, (low, high) in enumerate(init):
-            if i == len(init) - 1:
-                entry = CachedTube(trace)
-                tree[low : high + _EPSILON] = entry
-                return entry
-            else:
-                next_level_tree = IntervalTree()
-                tree[low : high + _EPSILON] = next_level_tree
-                tree = next_level_tree
-        raise Exception("???")
+        group = self._load(key)
+        low, high = np.array(init, dtype=float)
+        entry = CachedTube(trace)
+        self._add(key, low, high, entry)
+        if group != None:
+            self.store.put_tube(group, low, high, trace)
+        return entry
 
     def check_hit(
-        self, agent_id: str, mode: Tuple[str], init: List[List[float]]
+        self,
+        agent_id: str,
+        mode: Tuple[str],
+        init: List[List[float]],
+        time_horizon: Optional[float] = None,
+        time_step: Optional[float] = None,
     ) -> Optional[CachedTube]:
+        """The tube cached for `init`. When `time_horizon` and `time_step` are given, tubes over
+        that horizon are preferred to others as tight."""
         key = (agent_id,) + tuple(mode)
+        self._load(key)
         if key not in self.cache:
             return None
-        tree = self.cache[key]
-        for low, high in list(map(list, zip(*init))):
-            next_level_entries = [
-                t for t in tree[low : high + _EPSILON] if t.begin <= low and high <= t.end
-            ]
-            if len(next_level_entries) == 0:
-                return None
-            tree = min(next_level_entries, key=lambda e: low - e.begin + e.end - high).data
-        assert isinstance(tree, CachedTube)
-        return tree
+        low, high = np.array(init, dtype=float)
+        entries = self.cache[key].containing(low, high)
+        if len(entries) == 0:
+            return None
+        # The tube whose initial set is the tightest fit, first in the first dimension, then the
+        # one over the horizon, then the longest one
+        def rank(e):
+            fits = time_horizon == None or tube_fits(e[2].tube, time_horizon, time_step)
+            return tuple((low - e[0] + e[1] - high).tolist()), not fits, -len(e[2].tube)
+
+        _, _, tube = min(entries, key=rank)
+        assert isinstance(tube, CachedTube)
+        if self.budget != None:
+            self.budget.touch(tube)
+        return tube
 
 
 class ReachTubeCache:
-    def __init__(self):
-        self.cache: DefaultDict[tuple, IntervalTree] = defaultdict(IntervalTree)
+    def __init__(self, budget: Optional[CacheBudget] = None):
+        self.cache: DefaultDict[tuple, BoxIndex] = defaultdict(BoxIndex)
+        self.budget = budget
+
+    def evict(self, key: tuple, seq: int):
+        _evict(self.cache, key, seq)
 
     def add_tube(
         self,
@@ -310,43 +441,22 @@ class ReachTubeCache:
         transition,
         trans_ind: int,
         run_num: int,
+        horizon: float,
     ):
         key = (agent_id,) + tuple(node.mode[agent_id])
-        tree = self.cache[key]
         # pp(('add seg', agent_id, node.mode[agent_id], init))
         assert_hits = node.assert_hits or {}
-        init = list(map(tuple, zip(*init[agent_id])))
-        for i, (low, high) in enumerate(init):
-            if i == len(init) - 1:
-                transitions = convert_reach_trans(
-                    agent_id, transit_agents, node.init, transition, trans_ind
-                )
-                entry = CachedRTTrans(
-                    assert_hits.get(agent_id), transitions, set([(run_num, node.id)])
-                )
-                tree[low : high + _EPSILON] = entry
-                return entry
-            else:
-                next_level_tree = IntervalTree()
-                tree[low : high + _EPSILON] = next_level_tree
-                tree = next_level_tree
-        raise Exception("???")
-
-    @staticmethod
-    def query_cont(tree: IntervalTree, cont: List[Tuple[float, float]]) -> List[CachedRTTrans]:
-        assert isinstance(tree, IntervalTree)
-        low, high = cont[0]
-        next_level_entries = [
-            t.data for t in tree[low : high + _EPSILON] if t.begin <= low and high <= t.end
-        ]
-        if len(cont) == 1:
-            for ent in next_level_entries:
-                assert isinstance(ent, CachedRTTrans)
-            return next_level_entries
-        else:
-            return [
-                ent for t in next_level_entries for ent in ReachTubeCache.query_cont(t, cont[1:])
-            ]
+        low, high = np.array(init[agent_id], dtype=float)
+        transitions = convert_reach_trans(
+            agent_id, transit_agents, node.init, transition, trans_ind
+        )
+        entry = CachedRTTrans(
+            assert_hits.get(agent_id), transitions, set([(run_num, node.id)]), horizon
+        )
+        seq = self.cache[key].add(low, high + _EPSILON, entry)
+        if self.budget != None:
+            self.budget.add(self, key, seq, entry)
+        return entry
 
     def check_hit(
         self,
@@ -354,12 +464,15 @@ class ReachTubeCache:
         mode: Tuple[str],
         init: List[float],
         inits: Dict[str, List[List[List[float]]]],
+        horizon: float,
     ) -> Optional[CachedRTTrans]:
+        """The transitions cached for `init` and nodes with `horizon` remaining time."""
         key = (agent_id,) + tuple(mode)
         if key not in self.cache:
             return None
-        tree = self.cache[key]
-        entries = self.query_cont(tree, list(map(tuple, zip(*init))))
+        low, high = init
+        entries = [entry for _, _, entry in self.cache[key].containing(low, high)]
+        entries = [e for e in entries if e.horizon == horizon]
         if len(entries) == 0:
             return None
 
@@ -369,28 +482,15 @@ class ReachTubeCache:
         entries = list(sorted([(e, -num_trans_suit(e)) for e in entries], key=lambda p: p[1]))
         # pp(("check hit entries", len(entries), entries[0][1]))
         assert isinstance(entries[0][0], CachedRTTrans)
+        if self.budget != None:
+            self.budget.touch(entries[0][0])
         return entries[0][0]
 
-    @staticmethod
-    def iter_tree(tree, depth: int) -> List[List[float]]:
-        if depth == 0:
-            return [
-                [
-                    (i.begin + i.end) / 2,
-                    (i.data.run_num, i.data.node_id, [t.transition for t in i.data.transitions]),
-                ]
-                for i in tree
-            ]
-        res = []
-        for i in tree:
-            mid = (i.begin + i.end) / 2
-            subs = ReachTubeCache.iter_tree(i.data, depth - 1)
-            res.extend([mid] + sub for sub in subs)
-        return res
-
-    def get_cached_inits(self, n: int):
+    def get_cached_inits(self):
         inits = defaultdict(list)
-        for key, tree in self.cache.items():
-            inits[key[0]].extend((*key[1:], *init) for init in self.iter_tree(tree, n))
+        for key, index in self.cache.items():
+            for lower, upper, entry in index:
+                info = entry.node_ids, [t.transition for t in entry.transitions]
+                inits[key[0]].append((*key[1:], *((lower + upper) / 2).tolist(), info))
         inits = dict(inits)
         return inits
@@ -0,0 +1,185 @@
+"""Explicit Runge-Kutta integrators for agent dynamics.
+
+The integrators work on `dynamic(t, state, u)` functions as used by the example agents, with the
+control `u` held constant over each call. `state` may be a single state of shape (d,) or a stack of
+states of shape (d, N), one column per trajectory, so that dynamics written with element-wise NumPy
+operations integrate many trajectories at once. Such functions are marked with `vectorized`, so
+that callers only stack states for dynamics known to support it.
+"""
+
+from enum import Enum, auto
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+
+Dynamics = Callable[[float, np.ndarray, Sequence], Sequence]
+
+
+class Integrator(Enum):
+    RK4 = auto()
+    """Classic fourth order Runge-Kutta. The adaptive variant uses step doubling."""
+    RK45 = auto()
+    """Dormand-Prince 5(4). The adaptive variant uses the embedded fourth order error estimate."""
+
+
+def vectorized(f: Dynamics) -> Dynamics:
+    """Marks `f` as accepting stacked states of shape (d, N). Overriding a marked `dynamic` in a
+    subclass drops the mark, as the override may only handle single states."""
+    f.vectorized = True
+    return f
+
+
+def is_vectorized(f: Dynamics) -> bool:
+    return getattr(f, "vectorized", False)
+
+
+# Dormand-Prince coefficients
+_DP_C = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1])
+_DP_A = np.zeros((7, 7))
+_DP_A[1, :1] = [1 / 5]
+_DP_A[2, :2] = [3 / 40, 9 / 40]
+_DP_A[3, :3] = [44 / 45, -56 / 15, 32 / 9]
+_DP_A[4, :4] = [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729]
+_DP_A[5, :5] = [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656]
+_DP_A[6, :6] = [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]
+_DP_B = _DP_A[6]
+_DP_E = _DP_B - np.array(
+    [5179 / 57600, 0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40]
+)
+
+
+def _eval(f: Dynamics, t: float, y: np.ndarray, u) -> np.ndarray:
+    dy = f(t, y, u)
+    try:
+        return np.asarray(dy, dtype=float)
+    except ValueError:
+        # Constant derivatives such as `[..., 1]` next to stacked ones
+        return np.array(np.broadcast_arrays(*dy), dtype=float)
+
+
+def rk4_step(f: Dynamics, t: float, y: np.ndarray, h: float, u) -> np.ndarray:
+    k1 = _eval(f, t, y, u)
+    k2 = _eval(f, t + h / 2, y + h / 2 * k1, u)
+    k3 = _eval(f, t + h / 2, y + h / 2 * k2, u)
+    k4 = _eval(f, t + h, y + h * k3, u)
+    return y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+def rk45_step(f: Dynamics, t: float, y: np.ndarray, h: float, u, k: Optional[np.ndarray] = None):
+    """One Dormand-Prince step. Returns the fifth order solution and its error estimate. `k` is an
+    optional (7, y.size) buffer for the stages."""
+    if k is None:
+        k = np.empty((7, y.size))
+    flat = y.reshape(-1)
+    k[0] = _eval(f, t, y, u).reshape(-1)
+    for i in range(1, 7):
+        stage = flat + h * (_DP_A[i, :i] @ k[:i])
+        k[i] = _eval(f, t + _DP_C[i] * h, stage.reshape(y.shape), u).reshape(-1)
+    y_next = flat + h * (_DP_B @ k)
+    err = h * (_DP_E @ k)
+    return y_next.reshape(y.shape), err.reshape(y.shape)
+
+
+def _error_norm(
+    err: np.ndarray, y: np.ndarray, y_next: np.ndarray, rtol: float, atol: float
+) -> float:
+    scale = atol + rtol * np.maximum(np.abs(y), np.abs(y_next))
+    return float(np.max(np.abs(err) / scale)) if err.size else 0.0
+
+
+def integrate(
+    f: Dynamics,
+    t: float,
+    y: np.ndarray,
+    h: float,
+    u,
+    method: Integrator = Integrator.RK45,
+    adaptive: bool = True,
+    rtol: float = 1e-6,
+    atol: float = 1e-9,
+    buffer: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Integrates `f` from `t` to `t + h` starting at `y` with the control `u` held constant.
+
+    The fixed step variants take a single step of length `h`. The adaptive ones take as many
+    substeps as needed to keep the local error of every trajectory in the stack within
+    `atol + rtol * |y|`. `buffer` is an optional (7, y.size) buffer for the RK45 stages, so that
+    callers integrating step by step can allocate it once.
+    """
+    y = np.asarray(y, dtype=float)
+    k = None
+    if method == Integrator.RK45:
+        k = buffer if buffer is not None else np.empty((7, y.size))
+    if not adaptive:
+        if method == Integrator.RK4:
+            return rk4_step(f, t, y, h, u)
+        return rk45_step(f, t, y, h, u, k)[0]
+
+    end, step = t + h, h
+    while end - t > 1e-12 * max(1.0, abs(end)):
+        step = min(step, end - t)
+        if method == Integrator.RK45:
+            y_next, err = rk45_step(f, t, y, step, u, k)
+            order = 5
+        else:
+            half = rk4_step(f, t, y, step / 2, u)
+            y_next = rk4_step(f, t + step / 2, half, step / 2, u)
+            err = (y_next - rk4_step(f, t, y, step, u)) / 15
+            order = 4
+        norm = _error_norm(err, y, y_next, rtol, atol)
+        if norm <= 1:
+            t, y = t + step, y_next
+        # Standard step size controller with safety factor and growth limits
+        factor = 5.0 if norm == 0 else min(5.0, max(0.2, 0.9 * norm ** (-1 / order)))
+        step *= factor
+    return y
+
+
+def simulate(
+    f: Dynamics,
+    control: Callable[[np.ndarray], Sequence],
+    init,
+    time_bound: float,
+    time_step: float,
+    method: Integrator = Integrator.RK45,
+    adaptive: bool = True,
+    rtol: float = 1e-6,
+    atol: float = 1e-9,
+    post_step: Optional[Callable[[np.ndarray], None]] = None,
+) -> np.ndarray:
+    """Simulates `f` with piecewise constant control over the same time grid as `TC_simulate`.
+
+    Parameters
+    ----------
+        f: Callable
+            The dynamics, `f(t, state, u)`
+        control: Callable
+            Computes the control `u` for the current state at the start of every time step
+        init: array_like
+            An initial state of shape (d,), or a stack of N initial states of shape (N, d)
+        time_bound: float
+            The time horizon for simulation
+        time_step: float
+            The time step of the trace and of the control
+        post_step: Callable, optional
+            Called on the state after every time step, e.g. to clamp it in place
+
+    Returns
+    -------
+        np.ndarray of shape (T, 1 + d), or (N, T, 1 + d) for stacked initial states
+    """
+    init = np.asarray(init, dtype=float)
+    num_points = int(np.ceil(float(time_bound) / time_step))
+    trace = np.zeros((num_points + 1,) + init.shape[:-1] + (1 + init.shape[-1],))
+    trace[0, ..., 1:] = init
+    state = init.T.copy()
+    buffer = np.empty((7, state.size))
+    for i in range(num_points):
+        t = time_step * i
+        u = control(state)
+        state = integrate(f, t, state, time_step, u, method, adaptive, rtol, atol, buffer)
+        if post_step is not None:
+            post_step(state)
+        trace[i + 1, ..., 0] = time_step * (i + 1)
+        trace[i + 1, ..., 1:] = state.T
+    return trace if init.ndim == 1 else trace.transpose(1, 0, 2)
@@ -0,0 +1,261 @@
+import atexit, hashlib, inspect, os, shutil, sqlite3, tempfile, threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Attributes of an agent that don't change its dynamics, so that editing the decision logic or the
+# initial conditions doesn't invalidate cached traces
+_NON_DYNAMICS_ATTRS = {"decision_logic", "init_cont", "init_disc"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS traces (key TEXT PRIMARY KEY, horizon REAL, shape TEXT, trace BLOB);
+CREATE TABLE IF NOT EXISTS tubes (grp TEXT, shape TEXT, lower BLOB, upper BLOB, tube BLOB);
+CREATE INDEX IF NOT EXISTS tubes_grp ON tubes (grp);
+"""
+
+
+def _digest(obj: Any, h: "hashlib._Hash", seen: Dict[int, Any]):
+    """Feeds a description of `obj` that doesn't depend on the process (unlike `pickle`, where the
+    order of sets of strings does) to `h`. `seen` holds the objects visited so far by id, keeping
+    them alive so that their ids aren't reused by temporary ones."""
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, np.ndarray):
+        h.update(f"{obj.dtype}{obj.shape}".encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif id(obj) in seen:
+        h.update(b"<cycle>")
+    elif isinstance(obj, (list, tuple)):
+        seen[id(obj)] = obj
+        h.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in obj:
+            _digest(item, h, seen)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(b"set")
+        for item in sorted(repr(item) for item in obj):
+            h.update(item.encode())
+    elif isinstance(obj, dict):
+        seen[id(obj)] = obj
+        h.update(f"dict{len(obj)}".encode())
+        for key in sorted(obj, key=repr):
+            h.update(repr(key).encode())
+            _digest(obj[key], h, seen)
+    elif inspect.isroutine(obj) or inspect.isclass(obj):
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            name = f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', '')}"
+            h.update(name.encode())
+    else:
+        seen[id(obj)] = obj
+        _digest_class(type(obj), h, seen)
+        _digest(getattr(obj, "__dict__", {}), h, seen)
+
+
+def _is_code(name: str, value: Any) -> bool:
+    """Whether a class attribute is part of the class source rather than data set on it"""
+    if name.startswith("__"):
+        return True
+    return inspect.isroutine(value) or isinstance(value, (staticmethod, classmethod, property))
+
+
+def _class_attrs(cls: type) -> Dict[str, Any]:
+    return {k: v for k, v in vars(cls).items() if not _is_code(k, v)}
+
+
+def _digest_class(cls: type, h: "hashlib._Hash", seen: Dict[int, Any]):
+    """Feeds the source of `cls` and its bases to `h`, with their class-level attributes, which
+    may have been set after the class was defined."""
+    for base in cls.__mro__:
+        if base is object or id(base) in seen:
+            continue
+        seen[id(base)] = base
+        try:
+            h.update(inspect.getsource(base).encode())
+        except (OSError, TypeError):
+            h.update(f"{base.__module__}.{base.__qualname__}".encode())
+        _digest(_class_attrs(base), h, seen)
+
+
+def _digest_modules(cls: type, h: "hashlib._Hash"):
+    """Feeds the source of the modules defining `cls` and its bases to `h`, which covers the
+    module-level helpers and constants their methods use."""
+    modules = []
+    for base in cls.__mro__:
+        module = inspect.getmodule(base)
+        if base is not object and module != None and module not in modules:
+            modules.append(module)
+    for module in modules:
+        try:
+            h.update(inspect.getsource(module).encode())
+        except (OSError, TypeError):
+            h.update(module.__name__.encode())
+
+
+def _attrs(agent, lane_map) -> List[Tuple[str, Any]]:
+    """The attributes of `agent`, and the class-level attributes of its classes and those of the
+    map, to tell when one of them is reassigned."""
+    attrs = list(vars(agent).items())
+    for cls in type(agent).__mro__ + type(lane_map).__mro__:
+        attrs.extend(_class_attrs(cls).items())
+    return attrs
+
+
+def fingerprint(agent, lane_map) -> str:
+    """Hash of what the traces of `agent` depend on: the source of its class and bases and of
+    their modules, their class-level attributes, the attributes of the agent other than the
+    decision logic and initial conditions, and the map."""
+    h = hashlib.sha256()
+    seen = {}
+    _digest_modules(type(agent), h)
+    _digest_class(type(agent), h, seen)
+    attrs = {k: v for k, v in vars(agent).items() if k not in _NON_DYNAMICS_ATTRS}
+    _digest(attrs, h, seen)
+    _digest_modules(type(lane_map), h)
+    _digest(lane_map, h, seen)
+    return h.hexdigest()
+
+
+def _pack(arr: np.ndarray) -> Tuple[str, bytes]:
+    arr = np.ascontiguousarray(arr, dtype=float)
+    return ",".join(map(str, arr.shape)), arr.tobytes()
+
+
+def _unpack(shape: str, data: bytes) -> np.ndarray:
+    dims = tuple(int(d) for d in shape.split(",") if d)
+    return np.frombuffer(data, dtype=float).reshape(dims).copy()
+
+
+class PersistentCache:
+    """
+    On-disk store of simulated traces and DryVR tubes in a SQLite database, so that the caches
+    survive restarts and can be shared by the processes of e.g. a nightly regression run. Keys are
+    plain strings built by the caches; entries are fingerprinted with `fingerprint` so that changing
+    the dynamics of an agent or the map misses instead of returning stale results. The database is
+    in WAL mode so readers don't block each other or the writer, and each process opens its own
+    connection on first use.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        # Fingerprints by agent and map, kept together with the objects so that ids aren't reused,
+        # and with their `_attrs` so that reassigning one recomputes it
+        self._fingerprints: Dict[Tuple[int, int], Tuple[Any, Any, List, str]] = {}
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def fingerprint(self, agent, lane_map) -> str:
+        key = id(agent), id(lane_map)
+        attrs = _attrs(agent, lane_map)
+        cached = self._fingerprints.get(key)
+        if (
+            cached == None
+            or cached[0] is not agent
+            or cached[1] is not lane_map
+            or len(cached[2]) != len(attrs)
+            or any(k != k2 or v is not v2 for (k, v), (k2, v2) in zip(cached[2], attrs))
+        ):
+            cached = agent, lane_map, attrs, fingerprint(agent, lane_map)
+            self._fingerprints[key] = cached
+        return cached[3]
+
+    def get_trace(self, key: str) -> Optional[Tuple[float, np.ndarray]]:
+        with self._lock:
+            row = (
+                self.conn()
+                .execute("SELECT horizon, shape, trace FROM traces WHERE key = ?", (key,))
+                .fetchone()
+            )
+        if row == None:
+            return None
+        return row[0], _unpack(row[1], row[2])
+
+    def put_traces(self, items: List[Tuple[str, float, np.ndarray]]):
+        """Stores each `(key, horizon, trace)` of `items` in one transaction, unless a trace over a
+        longer horizon is stored already for the key."""
+        rows = [(key, horizon, *_pack(trace)) for key, horizon, trace in items]
+        with self._lock, self.conn() as conn:
+            conn.executemany(
+                "INSERT INTO traces VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET"
+                " horizon = excluded.horizon, shape = excluded.shape, trace = excluded.trace"
+                " WHERE excluded.horizon > traces.horizon",
+                rows,
+            )
+
+    def get_tubes(self, group: str) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """The tubes of `group` as `(lower, upper, tube)`, in the order they were stored."""
+        with self._lock:
+            rows = (
+                self.conn()
+                .execute(
+                    "SELECT shape, lower, upper, tube FROM tubes WHERE grp = ? ORDER BY rowid",
+                    (group,),
+                )
+                .fetchall()
+            )
+        return [
+            (np.frombuffer(lower).copy(), np.frombuffer(upper).copy(), _unpack(shape, tube))
+            for shape, lower, upper, tube in rows
+        ]
+
+    def put_tube(self, group: str, lower: np.ndarray, upper: np.ndarray, tube: np.ndarray):
+        shape, data = _pack(tube)
+        lower, upper = _pack(lower)[1], _pack(upper)[1]
+        with self._lock, self.conn() as conn:
+            conn.execute(
+                "INSERT INTO tubes VALUES (?, ?, ?, ?, ?)", (group, shape, lower, upper, data)
+            )
+
+
+_stores: Dict[str, PersistentCache] = {}
+
+
+def open_store(path: Optional[str]) -> Optional[PersistentCache]:
+    """The store at `path`, shared within the process, or None when `path` is None."""
+    if path == None:
+        return None
+    path = os.path.abspath(path)
+    if path not in _stores:
+        _stores[path] = PersistentCache(path)
+    return _stores[path]
+
+
+_session_dir: Optional[str] = None
+
+
+def session_store() -> PersistentCache:
+    """A store in a temporary file that lasts until the process exits, for sharing results with
+    the parallel workers on this machine when no `cache_path` is set."""
+    global _session_dir
+    if _session_dir == None:
+        _session_dir = tempfile.mkdtemp(prefix="verse-cache-")
+        atexit.register(_remove_session_dir, _session_dir)
+    return open_store(os.path.join(_session_dir, "cache.db"))
+
+
+def _remove_session_dir(path: str):
+    for store in _stores.values():
+        if os.path.dirname(store.path) == path:
+            store.close()
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,65 @@
+from collections import deque
+from enum import Enum, auto
+import heapq
+from typing import Callable, Optional, Tuple
+
+from verse.analysis.analysis_tree import AnalysisTreeNode
+
+
+class SchedulingPolicy(Enum):
+    """Order in which the nodes of the simulation/verification tree are explored."""
+
+    DEFAULT = auto()
+    """The first child of each node goes before the other children, which are explored in the
+    order they were found."""
+    BFS = auto()
+    """Nodes are explored in the order they were found."""
+    DFS = auto()
+    """The most recently found node is explored first."""
+    EARLIEST_START = auto()
+    """The node with the earliest `start_time` is explored first."""
+    PRIORITY = auto()
+    """The node with the lowest `priority_fn(node)` is explored first."""
+
+
+class Scheduler:
+    """Work queue of the nodes waiting to be simulated or verified. Ties are broken by the order
+    the nodes were pushed in. Pushing and popping are O(log n), or O(1) for BFS and DFS."""
+
+    def __init__(
+        self,
+        policy: SchedulingPolicy = SchedulingPolicy.DEFAULT,
+        priority_fn: Optional[Callable[[AnalysisTreeNode], float]] = None,
+    ):
+        if policy == SchedulingPolicy.PRIORITY and priority_fn == None:
+            raise ValueError("the PRIORITY scheduling policy needs a priority_fn")
+        self.policy = policy
+        self.priority_fn = priority_fn
+        self.queue = deque() if policy in (SchedulingPolicy.BFS, SchedulingPolicy.DFS) else []
+        self.count = 0
+
+    def _key(self, node: AnalysisTreeNode, later: int):
+        if self.policy == SchedulingPolicy.EARLIEST_START:
+            return node.start_time
+        if self.policy == SchedulingPolicy.PRIORITY:
+            return self.priority_fn(node)
+        return later
+
+    def push(self, node: AnalysisTreeNode, later: int = 0):
+        """Queues `node`. `later` marks nodes that aren't the first child of their parent."""
+        if isinstance(self.queue, deque):
+            self.queue.append((node, later))
+        else:
+            heapq.heappush(self.queue, (self._key(node, later), self.count, node, later))
+        self.count += 1
+
+    def pop(self) -> Tuple[AnalysisTreeNode, int]:
+        if self.policy == SchedulingPolicy.BFS:
+            return self.queue.popleft()
+        if self.policy == SchedulingPolicy.DFS:
+            return self.queue.pop()
+        _, _, node, later = heapq.heappop(self.queue)
+        return node, later
+
+    def __len__(self) -> int:
+        return len(self.queue)
@@ -0,0 +1,201 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from verse.agents.base_agent import BaseAgent
+from verse.analysis.persistent_cache import PersistentCache
+
+
+# Traces per write to the store for the caches that flush at the end of their runs or tasks
+WRITE_BATCH = 64
+
+
+class SimulationCache:
+    """Bounded LRU cache of `TC_simulate` results.
+
+    Traces are keyed by agent id, mode, initial point (rounded to `decimals` decimal places) and
+    time step. A trace simulated over some horizon also answers requests over any shorter horizon
+    that is a whole number of time steps, by returning a prefix of it. Like the incremental caches,
+    the result is undefined when the agent dynamics or the map change between runs, and agents
+    with random dynamics shouldn't be cached.
+
+    With a `store`, traces are also written to it, and read back from it on misses. Stored traces
+    are fingerprinted by the agent dynamics and the map, so those may change between processes.
+    Writes are sent in batches of `write_batch` traces, the rest go with `flush`.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        decimals: int = 10,
+        store: Optional[PersistentCache] = None,
+        write_batch: int = 1,
+    ):
+        self.max_size = max_size
+        self.decimals = decimals
+        self.store = store
+        self.write_batch = write_batch
+        self.cache: "OrderedDict[Hashable, Tuple[float, np.ndarray]]" = OrderedDict()
+        self.hits = (0, 0)
+        # Fingerprints of the agents by id, computed beforehand for workers
+        self.fingerprints: Dict[str, str] = {}
+        self.pending: List[Tuple[str, float, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits[0] + self.hits[1]
+        return self.hits[0] / total if total > 0 else 0.0
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = (0, 0)
+
+    def key(self, agent_id: str, mode, init, time_step: float) -> Hashable:
+        init = np.round(np.asarray(init, dtype=float), self.decimals) + 0.0
+        return (agent_id, tuple(str(m) for m in mode), tuple(init.tolist()), time_step)
+
+    @staticmethod
+    def _prefix_len(time_horizon: float, time_step: float) -> int:
+        """Number of rows of a trace over `time_horizon`, or 0 when the horizon isn't a whole
+        number of time steps and the row count depends on how the agent rounds it."""
+        steps = time_horizon / time_step
+        if abs(steps - round(steps)) > 1e-9 * max(1.0, steps):
+            return 0
+        return int(round(steps)) + 1
+
+    @classmethod
+    def _answer(cls, entry: Tuple[float, np.ndarray], time_horizon: float, time_step: float):
+        """The part of the cached `(horizon, trace)` over `time_horizon`, if it covers it."""
+        horizon, trace = entry
+        if time_horizon == horizon:
+            return trace.copy()
+        if time_horizon < horizon:
+            rows = cls._prefix_len(time_horizon, time_step)
+            if 0 < rows <= len(trace):
+                return trace[:rows].copy()
+        return None
+
+    def lookup(self, key: Hashable, time_horizon: float, time_step: float):
+        entry = self.cache.get(key)
+        if entry == None:
+            return None
+        trace = self._answer(entry, time_horizon, time_step)
+        if trace is not None:
+            self.cache.move_to_end(key)
+        return trace
+
+    def stored_key(self, agent: BaseAgent, lane_map, key: Hashable) -> str:
+        fingerprint = self.fingerprints.get(agent.id)
+        if fingerprint == None:
+            fingerprint = self.store.fingerprint(agent, lane_map)
+        return repr((fingerprint, key))
+
+    def load(self, stored_key: str, key: Hashable, time_horizon: float, time_step: float):
+        """Looks up a trace missing from memory in the store, keeping it in memory if found."""
+        entry = self.store.get_trace(stored_key)
+        if entry == None:
+            return None
+        self.add(key, *entry)
+        return self._answer(entry, time_horizon, time_step)
+
+    def save(self, stored_key: str, time_horizon: float, trace: np.ndarray):
+        self.pending.append((stored_key, time_horizon, trace))
+        if len(self.pending) >= self.write_batch:
+            self.flush()
+
+    def flush(self):
+        """Writes the traces still pending to the store."""
+        pending, self.pending = self.pending, []
+        if pending:
+            self.store.put_traces(pending)
+
+    def worker_view(
+        self, agents: Dict[str, BaseAgent], lane_map, store: Optional[PersistentCache] = None
+    ) -> "SimulationCache":
+        """A cache for parallel workers that shares `store`, by default the store of this one, and
+        nothing else. It keeps no traces in memory, so that threads can share it, and writes to
+        the store in batches that the tasks `flush` when they end."""
+        store = store if store is not None else self.store
+        assert store is not None
+        view = SimulationCache(0, self.decimals, store, write_batch=WRITE_BATCH)
+        view.fingerprints = {
+            aid: store.fingerprint(agent, lane_map) for aid, agent in agents.items()
+        }
+        return view
+
+    def add(self, key: Hashable, time_horizon: float, trace: np.ndarray):
+        if self.max_size <= 0:
+            return
+        entry = self.cache.get(key)
+        if entry != None and entry[0] > time_horizon:
+            # Keep the longer trace, it answers more requests
+            self.cache.move_to_end(key)
+            return
+        self.cache[key] = (time_horizon, np.array(trace, dtype=float))
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def simulate(
+        self, agent: BaseAgent, mode, init, time_horizon: float, time_step: float, lane_map=None
+    ) -> np.ndarray:
+        """`agent.TC_simulate` through the cache. Always returns a fresh array."""
+        key = self.key(agent.id, mode, init, time_step)
+        trace = self.lookup(key, time_horizon, time_step)
+        if trace is None and self.store is not None:
+            stored_key = self.stored_key(agent, lane_map, key)
+            trace = self.load(stored_key, key, time_horizon, time_step)
+        if trace is not None:
+            self.hits = self.hits[0] + 1, self.hits[1]
+            return trace
+        self.hits = self.hits[0], self.hits[1] + 1
+        trace = np.array(agent.TC_simulate(mode, init, time_horizon, time_step, lane_map))
+        self.add(key, time_horizon, trace)
+        if self.store is not None:
+            self.save(stored_key, time_horizon, trace)
+        return trace.copy()
+
+    def simulate_batch(
+        self, agent: BaseAgent, mode, inits, time_horizon: float, time_step: float, lane_map=None
+    ) -> List[np.ndarray]:
+        """`agent.TC_simulate_batch` through the cache. Only the traces that aren't cached are
+        simulated, in one batched call. Always returns fresh arrays."""
+        keys = [self.key(agent.id, mode, init, time_step) for init in inits]
+        traces = [self.lookup(key, time_horizon, time_step) for key in keys]
+        if self.store is not None:
+            stored_keys = [self.stored_key(agent, lane_map, key) for key in keys]
+            for i, trace in enumerate(traces):
+                if trace is None:
+                    traces[i] = self.load(stored_keys[i], keys[i], time_horizon, time_step)
+        missed = [i for i, trace in enumerate(traces) if trace is None]
+        self.hits = self.hits[0] + len(traces) - len(missed), self.hits[1] + len(missed)
+        if missed:
+            batch = agent.TC_simulate_batch(
+                mode, [inits[i] for i in missed], time_horizon, time_step, lane_map
+            )
+            for i, trace in zip(missed, batch):
+                traces[i] = np.array(trace, dtype=float)
+                self.add(keys[i], time_horizon, traces[i])
+                if self.store is not None:
+                    self.save(stored_keys[i], time_horizon, traces[i])
+        return traces
+
+    def wrap(self, agent: BaseAgent) -> Callable:
+        """A drop-in replacement for `agent.TC_simulate` that goes through the cache."""
+
+        def tc_simulate(mode, init, time_horizon, time_step, lane_map=None):
+            return self.simulate(agent, mode, init, time_horizon, time_step, lane_map)
+
+        return tc_simulate
+
+    def wrap_batch(self, agent: BaseAgent) -> Callable:
+        """A drop-in replacement for `agent.TC_simulate_batch` that goes through the cache."""
+
+        def tc_simulate_batch(mode, initialSets, time_horizon, time_step, lane_map=None):
+            return self.simulate_batch(agent, mode, initialSets, time_horizon, time_step, lane_map)
+
+        return tc_simulate_batch
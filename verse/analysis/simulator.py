@@ -1,7 +1,8 @@
+import dataclasses
 from dataclasses import dataclass
 import pickle
 import timeit
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 import copy, itertools, functools, pprint
 from pympler.asizeof import asizeof
 from collections import defaultdict
@@ -11,12 +12,27 @@ import warnings
 import types
 import sys
 from enum import Enum
+import numpy as np
 
 from verse.agents.base_agent import BaseAgent
-from verse.analysis.incremental import CachedSegment, SimTraceCache, convert_sim_trans, to_simulate
+from verse.analysis.executor import TaskFusion, get_executor, run_fused
+from verse.analysis.incremental import (
+    CacheBudget,
+    CachedSegment,
+    SimTraceCache,
+    convert_sim_trans,
+    time_left,
+    to_simulate,
+    truncate_trace,
+)
+from verse.analysis.scheduler import Scheduler
+from verse.analysis.persistent_cache import open_store, session_store
+from verse.analysis.sim_cache import WRITE_BATCH, SimulationCache
 from verse.analysis.utils import dedup
+from verse.analysis.vectorized_guard import VectorizeError, vectorize_controller
 from verse.map.lane_map import LaneMap
 from verse.parser.parser import ModePath, find, unparse
+from verse.sensor.base_sensor import BaseSensor
 from verse.analysis.incremental import (
     CachedRTTrans,
     CachedSegment,
@@ -142,6 +158,56 @@ def check_sim_transitions(agent: BaseAgent, guards: List[Tuple], cont, disc, map
     return None, satisfied_guard
 
 
+def first_guard_hit(
+    agents: List[BaseAgent],
+    node: AnalysisTreeNode,
+    track_map,
+    sensor,
+    start: int = 0,
+    window: int = 32,
+) -> Optional[int]:
+    """Finds the first index of `node.trace` from `start` at which a guard of `agents` fires or one
+    of their asserts is violated, evaluating a growing window of timesteps at a time. Returns the
+    trace length when nothing fires, or None when the guards can't be vectorized."""
+    if type(sensor).sense is not BaseSensor.sense:
+        return None
+    trace_length = min(len(trace) for trace in node.trace.values())
+    try:
+        controllers = [(agent, vectorize_controller(agent.decision_logic)) for agent in agents]
+        while start < trace_length:
+            end = min(trace_length, start + window)
+            state_dict = {
+                aid: (node.trace[aid][start:end], node.mode[aid], node.static[aid])
+                for aid in node.agent
+            }
+            hit = np.zeros(end - start, dtype=bool)
+            for agent, controller in controllers:
+                ego_ty_name = find(agent.decision_logic.args, lambda a: a.name == EGO).typ
+                cont, disc, _ = sensor.sense(agent, state_dict, track_map)
+                env = pack_env(agent, ego_ty_name, cont, disc, track_map)
+                hit |= controller.hits(env, end - start)
+            if np.any(hit):
+                return start + int(np.argmax(hit))
+            start, window = end, window * 2
+    except VectorizeError:
+        return None
+    return trace_length
+
+
+def guard_hit(agents: List[BaseAgent], state_dict, track_map, sensor) -> bool:
+    """Whether a guard of `agents` fires or one of their asserts is violated in `state_dict`."""
+    for agent in agents:
+        ego_ty_name = find(agent.decision_logic.args, lambda a: a.name == EGO).typ
+        cont, disc, _ = sensor.sense(agent, state_dict, track_map)
+        env = pack_env(agent, ego_ty_name, cont, disc, track_map)
+        for assertion in agent.decision_logic.asserts:
+            if eval(assertion.pre, env) and not eval(assertion.cond, env):
+                return True
+        if any(eval(path.cond, env) for path in agent.decision_logic.paths):
+            return True
+    return False
+
+
 def convertStrToEnum(inp, agent: BaseAgent, dl):
     res = inp
     for field in res.__dict__:
@@ -179,18 +245,47 @@ class SimConsts:
     past_runs: List[AnalysisTree]
     sensor: "BaseSensor"
     agent_dict: Dict
+    sim_cache: Optional[SimulationCache] = None
+
+    def tc_simulate(self, agent: BaseAgent, mode, init, time_horizon: float) -> np.ndarray:
+        if self.sim_cache is None:
+            return agent.TC_simulate(mode, init, time_horizon, self.time_step, self.lane_map)
+        return self.sim_cache.simulate(
+            agent, mode, init, time_horizon, self.time_step, self.lane_map
+        )
 
 
 class Simulator:
     def __init__(self, config):
         self.simulation_tree = None
-        self.cache = SimTraceCache()
+        self.cache_budget = CacheBudget(config.cache_memory_budget)
+        self.cache = SimTraceCache(self.cache_budget)
         self.config = config
         self.cache_hits = (0, 0)
-        if self.config.parallel:
-            import ray
+        self.sim_cache = SimulationCache(config.sim_cache_size, write_batch=WRITE_BATCH)
+        self.time_horizon = None
 
-            self.simulate_one_remote = ray.remote(Simulator.simulate_one)
+    @staticmethod
+    def simulate_one_task(
+        config: "ScenarioConfig",
+        cached_segments: Dict[str, CachedSegment],
+        node: AnalysisTreeNode,
+        old_node_id: Optional[Tuple[int, int]],
+        later: int,
+        remain_time: float,
+        consts: SimConsts,
+    ) -> Tuple[int, int, List[AnalysisTreeNode], Dict[str, TraceType], list]:
+        """`simulate_one` for a node sent to a worker without its agents, which are taken from
+        `consts` instead. The children are returned without agents as well."""
+        node.agent = consts.agent_dict
+        res = Simulator.simulate_one(
+            config, cached_segments, node, old_node_id, later, remain_time, consts
+        )
+        if consts.sim_cache is not None:
+            consts.sim_cache.flush()
+        for child in res[2]:
+            child.agent = None
+        return res
 
     @staticmethod
     def simulate_one(
@@ -207,20 +302,28 @@ class Simulator:
             print(f"node {node.id} start: {node.start_time}")
         # print(f"node id: {node.id}")
         cache_updates = []
+        streaming = config.stream_simulate and not config.incremental
         for agent_id in node.agent:
             if agent_id not in node.trace:
                 if agent_id in cached_segments:
-                    node.trace[agent_id] = cached_segments[agent_id].trace
+                    node.trace[agent_id] = Simulator.fit_trace(
+                        cached_segments[agent_id].trace, node, agent_id, remain_time, consts
+                    )
+                elif streaming and Simulator.can_stream(node.agent[agent_id]):
+                    continue
                 else:
                     # pp(("sim", agent_id, *mode, *init))
                     # Simulate the trace starting from initial condition
                     mode = node.mode[agent_id]
                     init = node.init[agent_id]
-                    trace = node.agent[agent_id].TC_simulate(
-                        mode, init, remain_time, consts.time_step, consts.lane_map
-                    )
+                    trace = consts.tc_simulate(node.agent[agent_id], mode, init, remain_time)
                     trace[:, 0] += node.start_time
                     node.trace[agent_id] = trace
+        cut_streams, scan_from = set(), 0
+        if streaming:
+            cut_streams, scan_from = Simulator.stream_traces(
+                node, remain_time, consts, config.stream_chunk_size
+            )
         # pp(("cached_segments", cached_segments.keys()))
         # TODO: for now, make sure all the segments comes from the same node; maybe we can do
         # something to combine results from different nodes in the future
@@ -233,9 +336,42 @@ class Simulator:
                 assert old_node != None
                 new_cache, paths_to_sim = to_simulate(old_node.agent, node.agent, cached_segments)
 
-        asserts, transitions, transition_idx = Simulator.get_transition_simulate(
-            new_cache, paths_to_sim, node, consts.lane_map, consts.sensor, consts.agent_dict, config.print_level
+        get_transitions = functools.partial(
+            Simulator.get_transition_simulate,
+            new_cache,
+            paths_to_sim,
+            node,
+            consts.lane_map,
+            consts.sensor,
+            consts.agent_dict,
+            config.print_level,
+            config.vectorize_guards,
         )
+        asserts, transitions, transition_idx = get_transitions(scan_from)
+        if cut_streams and not transitions and (asserts == None or config.unsafe_continue):
+            # What stopped the streams didn't lead anywhere, so the full traces are needed
+            for agent_id in cut_streams:
+                trace = consts.tc_simulate(
+                    node.agent[agent_id], node.mode[agent_id], node.init[agent_id], remain_time
+                )
+                trace[:, 0] += node.start_time
+                node.trace[agent_id] = trace
+            cut_streams = set()
+            asserts, transitions, transition_idx = get_transitions()
+        # Agents whose traces after the transition can't be carried over to the children
+        partial_traces = set(cut_streams)
+        if config.event_location and transitions and transition_idx > 0:
+            event_traces = Simulator.locate_event(
+                node, transition_idx, consts, config.event_tolerance
+            )
+            if event_traces != None:
+                grid_traces, node.trace = node.trace, event_traces
+                located = get_transitions(transition_idx)
+                if located[1] and located[2] == transition_idx:
+                    asserts, transitions, transition_idx = located
+                    partial_traces = set(node.agent)
+                else:
+                    node.trace = grid_traces
         node.assert_hits = asserts
         
         # pp(("transitions:", transition_idx, transitions))
@@ -303,7 +439,7 @@ class Simulator:
                             consts.run_num,
                         )
                     )
-            # pp(("cached inits", self.cache.get_cached_inits(3)))
+            # pp(("cached inits", self.cache.get_cached_inits()))
             # Generate the transition combinations if multiple agents can transit at the same time step
             transition_list = list(transitions.values())
             all_transition_combinations = itertools.product(*transition_list)
@@ -329,7 +465,9 @@ class Simulator:
                     next_node_init[transit_agent_idx] = next_init
                 for agent_idx in next_node_agent:
                     if agent_idx not in next_node_init:
-                        next_node_trace[agent_idx] = truncated_trace[agent_idx]
+                        # Those are simulated again from the transition point instead
+                        if agent_idx not in partial_traces:
+                            next_node_trace[agent_idx] = truncated_trace[agent_idx]
                         next_node_init[agent_idx] = truncated_trace[agent_idx][0][1:].tolist()
 
                 all_transition_paths.append(transition_paths)
@@ -345,6 +483,149 @@ class Simulator:
             # print(f"node {node.id} dur {timeit.default_timer() - t}")
             return (node.id, later, next_nodes, node.trace, cache_updates)
 
+    @staticmethod
+    def fit_trace(
+        trace: np.ndarray,
+        node: AnalysisTreeNode,
+        agent_id: str,
+        remain_time: float,
+        consts: SimConsts,
+    ) -> np.ndarray:
+        """The cached `trace` of `agent_id` moved to the start of `node` and fitted to
+        `remain_time`: cut if it's longer, or continued by simulating from its last state if it's
+        shorter, as the dynamics of a mode don't depend on time. A continued trace isn't the one a
+        single simulation gives, as the integration restarts at the cached end (see
+        `ScenarioConfig.horizon_reuse`)."""
+        trace = truncate_trace(trace, remain_time, consts.time_step).copy()
+        trace[:, 0] += node.start_time - trace[0, 0]
+        left = time_left(trace, remain_time, consts.time_step)
+        if left > 0:
+            rest = consts.tc_simulate(
+                node.agent[agent_id], node.mode[agent_id], trace[-1, 1:].tolist(), left
+            )
+            rest[:, 0] += trace[-1, 0]
+            trace = np.vstack((trace, rest[1:]))
+        return trace
+
+    @staticmethod
+    def can_stream(agent: BaseAgent) -> bool:
+        """Whether `agent` implements its own `TC_simulate_stream`. The default one simulates the
+        whole horizon anyway, so there is nothing to gain from stopping it early."""
+        return type(agent).TC_simulate_stream is not BaseAgent.TC_simulate_stream
+
+    @staticmethod
+    def stream_traces(
+        node: AnalysisTreeNode, remain_time: float, consts: SimConsts, chunk_size: int
+    ) -> Tuple[Set[str], int]:
+        """Simulates the agents of `node` that don't have a trace yet with `TC_simulate_stream`,
+        checking the guards on each new chunk and stopping once one can fire.
+        Returns the agents whose traces were cut short and the number of leading trace indices at
+        which nothing fires."""
+        streams = {
+            agent_id: agent.TC_simulate_stream(
+                node.mode[agent_id],
+                node.init[agent_id],
+                remain_time,
+                consts.time_step,
+                consts.lane_map,
+                chunk_size,
+            )
+            for agent_id, agent in node.agent.items()
+            if agent_id not in node.trace
+        }
+        chunks = {agent_id: [] for agent_id in streams}
+        agents = [agent for agent in node.agent.values() if len(agent.decision_logic.args) > 0]
+        checked = 0
+        while streams:
+            for agent_id, stream in list(streams.items()):
+                chunk = next(stream, None)
+                if chunk is None:
+                    del streams[agent_id]
+                    continue
+                chunk = np.array(chunk)
+                chunk[:, 0] += node.start_time
+                chunks[agent_id].append(chunk)
+            for agent_id, agent_chunks in chunks.items():
+                node.trace[agent_id] = np.vstack(agent_chunks)
+            available = min(len(trace) for trace in node.trace.values())
+            if not streams or available <= checked:
+                continue
+            hit_idx = first_guard_hit(agents, node, consts.lane_map, consts.sensor, checked)
+            if hit_idx == None:
+                hit_idx = find(
+                    range(checked, available),
+                    lambda idx: guard_hit(
+                        agents,
+                        {
+                            aid: (node.trace[aid][idx], node.mode[aid], node.static[aid])
+                            for aid in node.agent
+                        },
+                        consts.lane_map,
+                        consts.sensor,
+                    ),
+                )
+            if hit_idx != None and hit_idx < available:
+                for stream in streams.values():
+                    stream.close()
+                return set(streams), hit_idx
+            checked = available
+        return set(), checked
+
+    @staticmethod
+    def locate_event(
+        node: AnalysisTreeNode, idx: int, consts: SimConsts, tolerance: float
+    ) -> Optional[Dict[str, TraceType]]:
+        """Bisects the time step before `idx`, where something starts firing, for the time at which
+        it happens to within `tolerance`. Returns the traces up to and including the located event,
+        or None when the event can't be moved before `idx`."""
+        agents = [agent for agent in node.agent.values() if len(agent.decision_logic.args) > 0]
+        prev = {aid: node.trace[aid][idx - 1] for aid in node.agent}
+        start_time = list(prev.values())[0][0]
+
+        def advance(dt):
+            states = {}
+            for aid, row in prev.items():
+                trace = node.agent[aid].TC_simulate(
+                    node.mode[aid], list(row[1:]), dt, dt, consts.lane_map
+                )
+                states[aid] = np.array(trace[-1], dtype=float)
+                states[aid][0] = start_time + dt
+            return states
+
+        lo, hi = 0.0, list(node.trace.values())[0][idx][0] - start_time
+        event = None
+        while hi - lo > tolerance:
+            mid = (lo + hi) / 2
+            states = advance(mid)
+            state_dict = {
+                aid: (states[aid], node.mode[aid], node.static[aid]) for aid in node.agent
+            }
+            if guard_hit(agents, state_dict, consts.lane_map, consts.sensor):
+                hi, event = mid, states
+            else:
+                lo = mid
+        if event == None:
+            return None
+        return {aid: np.vstack((node.trace[aid][:idx], event[aid])) for aid in node.agent}
+
+    def get_sim_cache(self) -> Optional[SimulationCache]:
+        """The simulation cache if enabled by `sim_cache_size`, resized to the current config."""
+        if self.config.sim_cache_size <= 0:
+            return None
+        self.sim_cache.max_size = self.config.sim_cache_size
+        self.sim_cache.store = open_store(self.config.cache_path)
+        return self.sim_cache
+
+    def worker_sim_cache(self, agents: Dict[str, BaseAgent], lane_map) -> Optional[SimulationCache]:
+        """The simulation cache for parallel workers. It shares the store of the driver's cache,
+        or a temporary one of their own when `cache_path` isn't set, so that workers reuse each
+        other's traces."""
+        sim_cache = self.get_sim_cache()
+        if sim_cache == None:
+            return None
+        store = sim_cache.store if sim_cache.store != None else session_store()
+        return sim_cache.worker_view(agents, lane_map, store)
+
     def proc_result(self, id, later, next_nodes, traces, cache_updates):
         t = timeit.default_timer()
         # print("got id:", id)
@@ -355,12 +636,14 @@ class Simulator:
         # assert max(n.id for n in self.nodes) == last_id
         for i, node in enumerate(next_nodes):
             node.id = i + 1 + last_id
+            if node.agent is None:
+                node.agent = done_node.agent
             later = 0 if i == 0 else 1
-            self.simulation_queue.append((node, later))
-        self.simulation_queue.sort(key=lambda p: p[1:])
+            self.simulation_queue.push(node, later)
         self.nodes.extend(next_nodes)
+        remain_time = round(self.time_horizon - done_node.start_time, 10)
         for (
-            new,
+            _,
             aid,
             transit_agents,
             full_trace,
@@ -369,15 +652,22 @@ class Simulator:
             run_num,
         ) in cache_updates:
             cached = self.cache.check_hit(
-                aid, done_node.mode[aid], done_node.init[aid], done_node.init
+                aid, done_node.mode[aid], done_node.init[aid], done_node.init, remain_time
             )
-            if new and not cached:
+            # Also adds the segments that were hit but evicted since, or cached for another horizon
+            if cached == None:
                 self.cache.add_segment(
-                    aid, done_node, transit_agents, full_trace, transition, transition_idx, run_num
+                    aid,
+                    done_node,
+                    transit_agents,
+                    full_trace,
+                    transition,
+                    transition_idx,
+                    run_num,
+                    remain_time,
                 )
                 self.num_cached += 1
             else:
-                assert cached != None
                 cached.transitions.extend(
                     convert_sim_trans(
                         aid, transit_agents, done_node.init, transition, transition_idx
@@ -385,6 +675,7 @@ class Simulator:
                 )
                 cached.transitions = dedup(cached.transitions, lambda i: (i.disc, i.cont, i.inits))
                 cached.node_ids.add((run_num, done_node.id))
+                self.cache_budget.update(cached)
             # pre_len = len(cached_segments[aid].transitions)
             # pp(("dedup!", pre_len, len(cached_segments[aid].transitions)))
         # print(f"proc dur {timeit.default_timer() - t}")
@@ -404,94 +695,203 @@ class Simulator:
         if max_height == None:
             max_height = float("inf")
 
-        self.simulation_queue: List[Tuple[AnalysisTreeNode, int]] = [(root, 0)]
+        self.simulation_queue = Scheduler(self.config.scheduling_policy, self.config.priority_fn)
+        self.simulation_queue.push(root)
         self.result_refs = []
         self.nodes = [root]
         self.num_cached = 0
+        self.time_horizon = time_horizon
+        self.cache_budget.max_bytes = self.config.cache_memory_budget
+        self.cache_budget.evict()
         # Perform BFS through the simulation tree to loop through all possible transitions
-        consts = SimConsts(time_step, lane_map, run_num, past_runs, sensor, root.agent)
+        consts = SimConsts(
+            time_step, lane_map, run_num, past_runs, sensor, root.agent, self.get_sim_cache()
+        )
         if self.config.parallel:
-            import ray
-
-            consts_ref = ray.put(consts)
-        while True:
-            wait = False
-            start = timeit.default_timer()
-            if len(self.simulation_queue) > 0:
-                node, later = self.simulation_queue.pop(0)
-                # Check height
-                if node.height >= max_height-1:
+            executor = get_executor(self.config.executor, self.config.num_workers)
+            worker_sim_cache = self.worker_sim_cache(root.agent, lane_map)
+            consts_ref = executor.put(dataclasses.replace(consts, sim_cache=worker_sim_cache))
+        # Nodes waiting to be fused into one task
+        pending = []
+        fusion = TaskFusion(self.config.fused_task_duration, 64 if self.config.task_fusion else 1)
+
+        def dispatch():
+            self.result_refs.append(
+                executor.submit(run_fused, Simulator.simulate_one_task, list(pending), consts_ref)
+            )
+            pending.clear()
+
+        try:
+            while True:
+                wait = False
+                start = timeit.default_timer()
+                if len(self.simulation_queue) > 0:
+                    node, later = self.simulation_queue.pop()
+                    # Check height
+                    if node.height >= max_height-1:
+                        print("max depth reached")
+                        continue
+                    # pp(("start sim", node.start_time, {a: (*node.mode[a], *node.init[a]) for a in node.mode}))
+                    remain_time = round(time_horizon - node.start_time, 10)
+                    if remain_time <= 0:
+                        continue
+                    # For trace not already simulated
+                    cached_segments = {}
+                    for agent_id in node.agent:
+                        mode = node.mode[agent_id]
+                        init = node.init[agent_id]
+                        if self.config.incremental:
+                            # pp(("check hit", agent_id, mode, init))
+                            cached = self.cache.check_hit(
+                                agent_id, mode, init, node.init, remain_time
+                            )
+                            if cached == None and self.config.horizon_reuse:
+                                # A trace over another horizon, to cut or continue
+                                cached = self.cache.check_hit(agent_id, mode, init, node.init)
+                            if cached != None:
+                                self.cache_hits = self.cache_hits[0] + 1, self.cache_hits[1]
+                            else:
+                                self.cache_hits = self.cache_hits[0], self.cache_hits[1] + 1
+                            # pp(("check hit res", agent_id, len(cached.transitions) if cached != None else None))
+                            if cached != None:
+                                cached_segments[agent_id] = cached
+                    old_node_id = None
+                    # Transitions are only carried over from nodes with the same remaining time
+                    if len(cached_segments) == len(node.agent) and all(
+                        s.horizon == remain_time for s in cached_segments.values()
+                    ):
+                        all_node_ids = [s.node_ids for s in cached_segments.values()]
+                        node_ids = list(
+                            functools.reduce(lambda a, b: a.intersection(b), all_node_ids)
+                        )
+                        if len(node_ids) > 0:
+                            old_node_id = node_ids[0]
+                        # else:
+                        #     print(f"not full {node.id}: {node_ids}, {len(cached_segments) == len(node.agent)} | {all_node_ids}")
+                    if not self.config.parallel or old_node_id != None:
+                        # print(f"local {node.id}")
+                        t = timeit.default_timer()
+                        self.proc_result(
+                            *self.simulate_one(
+                                self.config,
+                                cached_segments,
+                                node,
+                                old_node_id,
+                                later,
+                                remain_time,
+                                consts,
+                            )
+                        )
+                        # print(f"node {node.id} dur {timeit.default_timer() - t}")
+                    else:
+                        pending.append(
+                            (
+                                self.config,
+                                cached_segments,
+                                node.without_agents(),
+                                old_node_id,
+                                later,
+                                remain_time,
+                            )
+                        )
+                        free_slots = self.config.parallel_sim_ahead - len(self.result_refs)
+                        queued = len(pending) + len(self.simulation_queue)
+                        if len(pending) >= fusion.size(queued, free_slots):
+                            dispatch()
+                    if len(self.result_refs) >= self.config.parallel_sim_ahead:
+                        wait = True
+                elif len(pending) > 0:
+                    dispatch()
+                elif len(self.result_refs) > 0:
+                    wait = True
+                else:
+                    break
+                if wait:
+                    res, remaining = executor.wait(self.result_refs)
+                    results, duration = executor.get(res)
+                    fusion.record(duration, len(results))
+                    for id, later, next_nodes, traces, cache_updates in results:
+                        self.proc_result(id, later, next_nodes, traces, cache_updates)
+                    self.result_refs = remaining
+        finally:
+            if self.config.parallel:
+                executor.release(consts_ref)
+            if consts.sim_cache is not None:
+                consts.sim_cache.flush()
+        # print("cached", self.num_cached)
+        # pp(self.cache.get_cached_inits())
+        self.simulation_tree = AnalysisTree(root)
+        return self.simulation_tree
+
+    def simulate_batch(
+        self,
+        roots: List[AnalysisTreeNode],
+        sensor,
+        time_horizon,
+        time_step,
+        max_height,
+        lane_map,
+        run_num,
+        past_runs,
+    ) -> List[AnalysisTree]:
+        """Simulates one tree per root, advancing all of them together level by level. Agents that
+        need simulating in the same mode over the same horizon are simulated with a single
+        `TC_simulate_batch` call across all trees. Does not use the incremental cache."""
+        if max_height == None:
+            max_height = float("inf")
+
+        sim_cache = self.get_sim_cache()
+        consts = SimConsts(
+            time_step, lane_map, run_num, past_runs, sensor, roots[0].agent, sim_cache
+        )
+        tree_nodes = [[root] for root in roots]
+        frontier = [(tree_idx, root) for tree_idx, root in enumerate(roots)]
+        while frontier:
+            ready = []
+            for tree_idx, node in frontier:
+                if node.height >= max_height - 1:
                     print("max depth reached")
                     continue
-                # pp(("start sim", node.start_time, {a: (*node.mode[a], *node.init[a]) for a in node.mode}))
                 remain_time = round(time_horizon - node.start_time, 10)
                 if remain_time <= 0:
                     continue
-                # For trace not already simulated
-                cached_segments = {}
+                ready.append((tree_idx, node, remain_time))
+
+            # Group the pending simulations so that each group is one batched call
+            groups = defaultdict(list)
+            for _, node, remain_time in ready:
                 for agent_id in node.agent:
-                    mode = node.mode[agent_id]
-                    init = node.init[agent_id]
-                    if self.config.incremental:
-                        # pp(("check hit", agent_id, mode, init))
-                        cached = self.cache.check_hit(agent_id, mode, init, node.init)
-                        if cached != None:
-                            self.cache_hits = self.cache_hits[0] + 1, self.cache_hits[1]
-                        else:
-                            self.cache_hits = self.cache_hits[0], self.cache_hits[1] + 1
-                        # pp(("check hit res", agent_id, len(cached.transitions) if cached != None else None))
-                        if cached != None:
-                            cached_segments[agent_id] = cached
-                old_node_id = None
-                if len(cached_segments) == len(node.agent):
-                    all_node_ids = [s.node_ids for s in cached_segments.values()]
-                    node_ids = list(functools.reduce(lambda a, b: a.intersection(b), all_node_ids))
-                    if len(node_ids) > 0:
-                        old_node_id = node_ids[0]
-                    # else:
-                    #     print(f"not full {node.id}: {node_ids}, {len(cached_segments) == len(node.agent)} | {all_node_ids}")
-                if not self.config.parallel or old_node_id != None:
-                    # print(f"local {node.id}")
-                    t = timeit.default_timer()
-                    self.proc_result(
-                        *self.simulate_one(
-                            self.config,
-                            cached_segments,
-                            node,
-                            old_node_id,
-                            later,
-                            remain_time,
-                            consts,
-                        )
+                    if agent_id not in node.trace:
+                        groups[(agent_id, tuple(node.mode[agent_id]), remain_time)].append(node)
+            for (agent_id, _, remain_time), group in groups.items():
+                agent, mode = consts.agent_dict[agent_id], group[0].mode[agent_id]
+                inits = [node.init[agent_id] for node in group]
+                if sim_cache != None:
+                    traces = sim_cache.simulate_batch(
+                        agent, mode, inits, remain_time, time_step, lane_map
                     )
-                    # print(f"node {node.id} dur {timeit.default_timer() - t}")
                 else:
-                    self.result_refs.append(
-                        self.simulate_one_remote.remote(
-                            self.config,
-                            cached_segments,
-                            node,
-                            old_node_id,
-                            later,
-                            remain_time,
-                            consts_ref,
-                        )
-                    )
-                if len(self.result_refs) >= self.config.parallel_sim_ahead:
-                    wait = True
-            elif len(self.result_refs) > 0:
-                wait = True
-            else:
-                break
-            if wait:
-                [res], remaining = ray.wait(self.result_refs)
-                id, later, next_nodes, traces, cache_updates = ray.get(res)
-                self.proc_result(id, later, next_nodes, traces, cache_updates)
-                self.result_refs = remaining
-        # print("cached", self.num_cached)
-        # pp(self.cache.get_cached_inits(3))
-        self.simulation_tree = AnalysisTree(root)
-        return self.simulation_tree
+                    traces = agent.TC_simulate_batch(mode, inits, remain_time, time_step, lane_map)
+                for node, trace in zip(group, traces):
+                    trace = np.array(trace)
+                    trace[:, 0] += node.start_time
+                    node.trace[agent_id] = trace
+
+            frontier = []
+            for tree_idx, node, remain_time in ready:
+                _, _, next_nodes, traces, _ = Simulator.simulate_one(
+                    self.config, {}, node, None, 0, remain_time, consts
+                )
+                node.child = next_nodes
+                node.trace = traces
+                last_id = tree_nodes[tree_idx][-1].id
+                for i, next_node in enumerate(next_nodes):
+                    next_node.id = i + 1 + last_id
+                tree_nodes[tree_idx].extend(next_nodes)
+                frontier.extend((tree_idx, next_node) for next_node in next_nodes)
+        if sim_cache != None:
+            sim_cache.flush()
+        return [AnalysisTree(root) for root in roots]
 
     def simulate_simple(
         self,
@@ -623,7 +1023,9 @@ class Simulator:
         track_map: LaneMap,
         sensor,
         agent_dict,
-        print_level: int
+        print_level: int,
+        vectorize: bool = False,
+        scan_from: int = 0,
     ) -> Tuple[
         Optional[Dict[str, List[str]]],
         Optional[Dict[str, List[Tuple[str, List[str], List[float]]]]],
@@ -704,9 +1106,18 @@ class Simulator:
             )
             agent_guard_dict[agent_id].append((path, discrete_variable_dict))
 
+        # Skip ahead to the first index where something can happen; the scalar checks below then
+        # handle the transitions exactly as before
+        start_idx = 0 if cache else max(0, min(scan_from, trace_length - 1))
+        if vectorize and not cache and trace_length > 0:
+            agents = [agent_dict[agent_id] for agent_id in agent_guard_dict]
+            hit_idx = first_guard_hit(agents, node, track_map, sensor, start_idx)
+            if hit_idx != None:
+                start_idx = min(hit_idx, trace_length - 1)
+
         transitions = defaultdict(list)
         # TODO: We can probably rewrite how guard hit are detected and resets are handled for simulation
-        for idx in range(trace_length):
+        for idx in range(start_idx, trace_length):
             if min_trans_ind != None and idx >= min_trans_ind:
                 return None, dict(cached_trans), min_trans_ind
             satisfied_guard = []
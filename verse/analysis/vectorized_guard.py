@@ -0,0 +1,267 @@
+"""Evaluate the guards and asserts of a decision logic on whole traces at once.
+
+The simulation versions of `ModePath.cond` and the asserts are compiled for one state at a time.
+Here the same expressions are lowered to code that accepts NumPy arrays for the continuous
+variables, so that every timestep of a trace segment is checked in a single evaluation:
+
+- `and`/`or`/`not`, chained comparisons and `a if c else b` become element-wise operations that
+  still short-circuit when every element is decided;
+- `any(...)`/`all(...)` over a generator become reductions over the generated values;
+- other calls (e.g. lane map queries) are made once if none of their arguments depend on the
+  trace and once per timestep otherwise.
+
+Anything the lowered code can't handle raises `VectorizeError` so the caller can fall back to the
+per-timestep evaluation.
+"""
+
+import ast, copy, operator
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+from verse.parser.parser import ControllerIR, compile_expr
+
+
+class VectorizeError(Exception):
+    pass
+
+
+_CMP_OPS = {
+    ast.Eq: "eq",
+    ast.NotEq: "ne",
+    ast.Lt: "lt",
+    ast.LtE: "le",
+    ast.Gt: "gt",
+    ast.GtE: "ge",
+    ast.Is: "is_",
+    ast.IsNot: "is_not",
+    ast.In: "contains",
+    ast.NotIn: "not_contains",
+}
+
+
+def _helper(name: str) -> ast.Name:
+    return ast.Name(f"_vg_{name}", ctx=ast.Load())
+
+
+def _thunk(e: ast.expr) -> ast.Lambda:
+    args = ast.arguments(
+        posonlyargs=[], args=[], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]
+    )
+    return ast.Lambda(args, e)
+
+
+class _VectorizeTransformer(ast.NodeTransformer):
+    def visit_BoolOp(self, node: ast.BoolOp):
+        self.generic_visit(node)
+        name = "and" if isinstance(node.op, ast.And) else "or"
+        return ast.Call(_helper(name), [_thunk(v) for v in node.values], [])
+
+    def visit_UnaryOp(self, node: ast.UnaryOp):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.Call(_helper("not"), [node.operand], [])
+        return node
+
+    def visit_Compare(self, node: ast.Compare):
+        self.generic_visit(node)
+        ops = []
+        for op in node.ops:
+            if type(op) not in _CMP_OPS:
+                raise VectorizeError(f"unsupported comparison {op}")
+            ops.append(ast.Constant(_CMP_OPS[type(op)]))
+        return ast.Call(
+            _helper("compare"),
+            [node.left, ast.Tuple(ops, ctx=ast.Load()), *[_thunk(c) for c in node.comparators]],
+            [],
+        )
+
+    def visit_IfExp(self, node: ast.IfExp):
+        self.generic_visit(node)
+        return ast.Call(_helper("where"), [node.test, _thunk(node.body), _thunk(node.orelse)], [])
+
+    def visit_Call(self, node: ast.Call):
+        if (
+            isinstance(node.func, ast.Name)
+            and node.func.id in ("any", "all")
+            and len(node.args) == 1
+            and isinstance(node.args[0], ast.GeneratorExp)
+        ):
+            gen = self.visit(node.args[0])
+            elems = ast.ListComp(gen.elt, gen.generators)
+            return ast.Call(_helper(node.func.id), [elems], [])
+        self.generic_visit(node)
+        if any(isinstance(a, ast.Starred) for a in node.args):
+            raise VectorizeError("starred arguments")
+        return ast.Call(_helper("call"), [node.func, *node.args], node.keywords)
+
+
+def lower_expr(e: ast.expr):
+    """Compiles a simulation expression into code that evaluates it on arrays of states."""
+    return compile_expr(_VectorizeTransformer().visit(copy.deepcopy(e)))
+
+
+def _is_array(v) -> bool:
+    return isinstance(v, np.ndarray) and v.ndim > 0
+
+
+def _has_array(v) -> bool:
+    if _is_array(v):
+        return True
+    if isinstance(v, (list, tuple)):
+        return any(_has_array(e) for e in v)
+    if isinstance(v, SimpleNamespace):
+        return any(_has_array(e) for e in vars(v).values())
+    return False
+
+
+def _length(v) -> int:
+    if _is_array(v):
+        return len(v)
+    if isinstance(v, (list, tuple)):
+        return max((_length(e) for e in v), default=0)
+    if isinstance(v, SimpleNamespace):
+        return max((_length(e) for e in vars(v).values()), default=0)
+    return 0
+
+
+def _take(v, i: int):
+    if _is_array(v):
+        return v[i]
+    if isinstance(v, (list, tuple)):
+        return type(v)(_take(e, i) for e in v)
+    if isinstance(v, SimpleNamespace):
+        return SimpleNamespace(**{k: _take(e, i) for k, e in vars(v).items()})
+    return v
+
+
+def _truth(v):
+    if _is_array(v):
+        return v.astype(bool)
+    return bool(v)
+
+
+def _vg_and(*thunks):
+    res = True
+    for thunk in thunks:
+        res = np.logical_and(res, _truth(thunk()))
+        if not np.any(res):
+            return False
+    return res
+
+
+def _vg_or(*thunks):
+    res = False
+    for thunk in thunks:
+        res = np.logical_or(res, _truth(thunk()))
+        if np.all(res):
+            return True
+    return res
+
+
+def _vg_not(v):
+    return np.logical_not(_truth(v))
+
+
+def _vg_compare(left, ops, *thunks):
+    res = True
+    for op, thunk in zip(ops, thunks):
+        right = thunk()
+        if op == "contains":
+            val = left in right
+        elif op == "not_contains":
+            val = left not in right
+        else:
+            val = getattr(operator, op)(left, right)
+        res = np.logical_and(res, _truth(val))
+        if not np.any(res):
+            return False
+        left = right
+    return res
+
+
+def _vg_where(test, body, orelse):
+    test = _truth(test)
+    if np.all(test):
+        return body()
+    if not np.any(test):
+        return orelse()
+    return np.where(test, body(), orelse())
+
+
+def _vg_any(vals):
+    return _vg_or(*(lambda v=v: v for v in vals))
+
+
+def _vg_all(vals):
+    return _vg_and(*(lambda v=v: v for v in vals))
+
+
+_ELEMENTWISE: Dict[Callable, Callable] = {abs: np.abs}
+
+
+def _vg_call(func, *args, **kwargs):
+    if func in _ELEMENTWISE:
+        return _ELEMENTWISE[func](*args, **kwargs)
+    vals = (args, tuple(kwargs.values()))
+    if not _has_array(vals):
+        return func(*args, **kwargs)
+    res = []
+    for i in range(_length(vals)):
+        r = func(*_take(args, i), **{k: _take(v, i) for k, v in kwargs.items()})
+        if not np.isscalar(r):
+            raise VectorizeError(f"non-scalar result from {func}")
+        res.append(r)
+    return np.array(res)
+
+
+HELPERS: Dict[str, Any] = {
+    name: val for name, val in globals().items() if name.startswith("_vg_")
+}
+
+
+class VectorizedController:
+    """The lowered guards and asserts of one `ControllerIR`."""
+
+    def __init__(self, decision_logic: ControllerIR):
+        # The same expressions as the per-timestep evaluation in the simulator
+        self.guards = [_lower_sim(p.cond_sim) for p in decision_logic.paths]
+        self.asserts = [
+            (_lower_sim(a.pre_sim), _lower_sim(a.cond_sim)) for a in decision_logic.asserts
+        ]
+
+    @staticmethod
+    def _eval(code, env: Dict[str, Any], length: int) -> np.ndarray:
+        res = _truth(eval(code, env))
+        if _is_array(res) and res.shape != (length,):
+            raise VectorizeError(f"unexpected result shape {res.shape}")
+        return np.broadcast_to(res, (length,))
+
+    def hits(self, env: Dict[str, Any], length: int) -> np.ndarray:
+        """Which of the `length` states in `env` fire at least one guard or violate an assert."""
+        env = {**env, **HELPERS}
+        hit = np.zeros(length, dtype=bool)
+        with np.errstate(all="ignore"):
+            for pre, cond in self.asserts:
+                pre_hit = self._eval(pre, env, length)
+                if np.any(pre_hit):
+                    hit |= pre_hit & ~self._eval(cond, env, length)
+            for guard in self.guards:
+                hit |= self._eval(guard, env, length)
+        return hit
+
+
+def _lower_sim(e: Optional[ast.expr]):
+    if e is None:
+        raise VectorizeError("decision logic without simulation expressions")
+    return lower_expr(e)
+
+
+def vectorize_controller(decision_logic: ControllerIR) -> VectorizedController:
+    """Lowers `decision_logic`, keeping the result on it for reuse."""
+    controller = vars(decision_logic).get("_vectorized")
+    if controller is None:
+        controller = VectorizedController(decision_logic)
+        decision_logic._vectorized = controller
+    return controller
@@ -1,35 +1,49 @@
 from enum import Enum, auto
+import dataclasses
 from dataclasses import dataclass
 from collections import defaultdict
-import copy, itertools, functools, pprint
-from typing import Dict, List, Optional, Tuple
+import contextlib, copy, itertools, functools, pprint
+from typing import Dict, Iterator, List, Optional, Tuple
 import numpy as np
 import warnings
 import ast
-import ray, time
+import threading, time
 from verse.parser import unparse
 
 from verse.analysis.analysis_tree import AnalysisTreeNode, AnalysisTree, TraceType
-from verse.analysis.dryvr import calc_bloated_tube, SIMTRACENUM
+from verse.analysis.dryvr import calc_bloated_tube, extend_bloated_tube, SIMTRACENUM
+from verse.analysis.executor import ExecutorBackend, TaskFusion, get_executor, run_fused
 from verse.analysis.incremental import (
+    CacheBudget,
     ReachTubeCache,
     TubeCache,
     convert_reach_trans,
     to_simulate,
     combine_all,
+    time_left,
+    truncate_tube,
+    tube_fits,
 )
 from verse.analysis.incremental import CachedRTTrans, combine_all, reach_trans_suit
+from verse.analysis.persistent_cache import open_store, session_store
+from verse.analysis.scheduler import Scheduler
+from verse.analysis.sim_cache import WRITE_BATCH, SimulationCache
 from verse.analysis.utils import dedup
 from verse.map.lane_map import LaneMap
 from verse.parser.parser import find, ModePath, unparse
 from verse.agents.base_agent import BaseAgent
 from verse.automaton import GuardExpressionAst, ResetExpression
+from verse.automaton.guard import guard_cache
+from verse.automaton.reset import compiled_reset
 
 pp = functools.partial(pprint.pprint, compact=True, width=130)
 
 PathDiffs = List[Tuple[BaseAgent, ModePath]]
 EGO, OTHERS = "ego", "others"
 
+# z3's default context is shared by all threads and isn't thread safe
+_z3_lock = threading.Lock()
+
 
 class ReachabilityMethod(Enum):
     DRYVR = auto()
@@ -49,23 +63,42 @@ class ReachConsts:
     past_runs: List[AnalysisTree]
     sensor: "BaseSensor"
     agent_dict: Dict
+    sim_cache: Optional[SimulationCache] = None
+
+    def sim_func(self, agent: BaseAgent):
+        """The `TC_simulate` of `agent`, going through the simulation cache if there is one."""
+        if self.sim_cache is None:
+            return agent.TC_simulate
+        return self.sim_cache.wrap(agent)
+
+    def sim_batch_func(self, agent: BaseAgent):
+        """The `TC_simulate_batch` of `agent`, going through the simulation cache if there is
+        one."""
+        if self.sim_cache is None:
+            return agent.TC_simulate_batch
+        return self.sim_cache.wrap_batch(agent)
 
 
 class Verifier:
     def __init__(self, config):
         self.reachtube_tree = None
-        self.cache = TubeCache()
-        self.trans_cache = ReachTubeCache()
+        self.cache_budget = CacheBudget(config.cache_memory_budget)
+        self.cache = TubeCache(self.cache_budget)
+        self.trans_cache = ReachTubeCache(self.cache_budget)
         self.tube_cache_hits = (0, 0)
         self.trans_cache_hits = (0, 0)
+        self.sim_cache = SimulationCache(config.sim_cache_size, write_batch=WRITE_BATCH)
+        self.merge_index = None
+        self.time_horizon = None
         self.config = config
-        self.compute_full_reachtube_step_remote = ray.remote(Verifier.compute_full_reachtube_step)
 
     def check_cache_bloated_tube(
         self,
         agent_id,
         mode_label,
         initial_set,
+        time_horizon,
+        time_step,
         combine_seg_length=1000,
     ):
         """
@@ -74,8 +107,10 @@ class Verifier:
         :param TBA
         :return:    the combined bloated tube with all cached tube segs
                     a list of indexs of missing segs
+                    the cached tubes shorter than `time_horizon` for missing segs, to extend
         """
         missing_seg_idx_list = []
+        prefixes = {}
         res_tube = None
         tube_length = 0
         for combine_seg_idx in range(0, len(initial_set), combine_seg_length):
@@ -90,7 +125,9 @@ class Verifier:
                     combined_rect[1, :] = np.maximum(combined_rect[1, :], rect[1, :])
             combined_rect = combined_rect.tolist()
             if self.config.incremental:
-                cached = self.cache.check_hit(agent_id, mode_label, combined_rect)
+                cached = self.cache.check_hit(
+                    agent_id, mode_label, combined_rect, time_horizon, time_step
+                )
                 if cached != None:
                     self.tube_cache_hits = self.tube_cache_hits[0] + 1, self.tube_cache_hits[1]
                     # print('cache', agent_id, time_horizon, self.tube_cache_hits )
@@ -99,9 +136,19 @@ class Verifier:
                     # print('noncache', agent_id, time_horizon, self.tube_cache_hits )
             else:
                 cached = None
-            if cached != None:
-                cur_bloated_tube = cached.tube
+            if cached == None:
+                usable = False
+            elif self.config.horizon_reuse:
+                # Longer tubes are cut
+                usable = time_left(cached.tube, time_horizon, time_step) == 0
+            else:
+                usable = tube_fits(cached.tube, time_horizon, time_step)
+            if usable:
+                # Copied, as the combined tube is updated in place
+                cur_bloated_tube = truncate_tube(cached.tube, time_horizon, time_step).copy()
             else:
+                if cached != None and self.config.horizon_reuse:
+                    prefixes[combine_seg_idx] = cached.tube
                 missing_seg_idx_list.append(combine_seg_idx)
                 continue
             # FIXME
@@ -118,7 +165,7 @@ class Verifier:
                 res_tube[combine_seg_idx * 2 + 1 :: 2, 1:] = np.maximum(
                     res_tube[combine_seg_idx * 2 + 1 :: 2, 1:], cur_bloated_tube[1::2, 1:]
                 )
-        return res_tube, missing_seg_idx_list
+        return res_tube, missing_seg_idx_list, prefixes
 
     @staticmethod
     def calculate_full_bloated_tube_simple(
@@ -137,6 +184,7 @@ class Verifier:
         guard_checker=None,
         guard_str="",
         lane_map=None,
+        sim_batch_func=None,
     ):
         """
         Get the full bloated tube. use cached tubes, calculate noncached tubes
@@ -151,9 +199,10 @@ class Verifier:
             bloating_method = params["bloating_method"]
         cache_tube_updates = []
         if incremental:
-            cached_tube, missing_seg_idx_list = cached_tube_info
+            cached_tube, missing_seg_idx_list, prefixes = cached_tube_info
         else:
             cached_tube, missing_seg_idx_list = None, range(0, len(initial_set), combine_seg_length)
+            prefixes = {}
         res_tube = cached_tube
         if res_tube is None:
             tube_length = 0
@@ -170,17 +219,33 @@ class Verifier:
                     combined_rect[0, :] = np.minimum(combined_rect[0, :], rect[0, :])
                     combined_rect[1, :] = np.maximum(combined_rect[1, :], rect[1, :])
             combined_rect = combined_rect.tolist()
-            cur_bloated_tube = calc_bloated_tube(
-                mode_label,
-                combined_rect,
-                time_horizon,
-                time_step,
-                sim_func,
-                bloating_method,
-                kvalue,
-                sim_trace_num,
-                lane_map=lane_map,
-            )
+            if combine_seg_idx in prefixes:
+                # Only bloat the part of the horizon that the cached tube doesn't cover
+                cur_bloated_tube = extend_bloated_tube(
+                    prefixes[combine_seg_idx],
+                    mode_label,
+                    time_horizon,
+                    time_step,
+                    sim_func,
+                    bloating_method,
+                    kvalue,
+                    sim_trace_num,
+                    lane_map=lane_map,
+                    sim_batch_func=sim_batch_func,
+                )
+            else:
+                cur_bloated_tube = calc_bloated_tube(
+                    mode_label,
+                    combined_rect,
+                    time_horizon,
+                    time_step,
+                    sim_func,
+                    bloating_method,
+                    kvalue,
+                    sim_trace_num,
+                    lane_map=lane_map,
+                    sim_batch_func=sim_batch_func,
+                )
             if incremental:
                 cache_tube_updates.append((agent_id, mode_label, combined_rect, cur_bloated_tube))
             if res_tube is None:
@@ -198,7 +263,44 @@ class Verifier:
                 res_tube[combine_seg_idx * 2 + 1 :: 2, 1:] = np.maximum(
                     res_tube[combine_seg_idx * 2 + 1 :: 2, 1:], cur_bloated_tube[1::2, 1:]
                 )
-        return res_tube.tolist(), cache_tube_updates
+        return res_tube, cache_tube_updates
+
+    @staticmethod
+    def compute_full_reachtube_task(
+        exclusive: bool,
+        config: "ScenarioConfig",
+        cached_trans_tubes: Dict[str, CachedRTTrans],
+        cached_tubes: Dict[str, Tuple],
+        node: AnalysisTreeNode,
+        old_node_id: Optional[Tuple[int, int]],
+        later: int,
+        remain_time: float,
+        max_height: int,
+        params: dict,
+        consts: ReachConsts,
+    ):
+        """`compute_full_reachtube_step` for a node sent to a worker without its agents, which are
+        taken from `consts` instead. The children are returned without agents as well. With
+        `exclusive`, the step holds the z3 lock so that it can run in a thread."""
+        node.agent = consts.agent_dict
+        with _z3_lock if exclusive else contextlib.nullcontext():
+            res = Verifier.compute_full_reachtube_step(
+                config,
+                cached_trans_tubes,
+                cached_tubes,
+                node,
+                old_node_id,
+                later,
+                remain_time,
+                consts,
+                max_height,
+                params,
+            )
+        if consts.sim_cache is not None:
+            consts.sim_cache.flush()
+        for child in res[2]:
+            child.agent = None
+        return res
 
     @staticmethod
     def compute_full_reachtube_step(
@@ -232,6 +334,9 @@ class Verifier:
             if agent_id not in node.trace:
                 # Compute the trace starting from initial condition
                 uncertain_param = node.uncertain_param[agent_id]
+                sim_batch_func = None
+                if config.batch_sample:
+                    sim_batch_func = consts.sim_batch_func(node.agent[agent_id])
                 if consts.reachability_method == ReachabilityMethod.DRYVR:
                     # pp(('tube', agent_id, mode, inits))
                     (
@@ -245,12 +350,13 @@ class Verifier:
                         inits,
                         remain_time,
                         consts.time_step,
-                        node.agent[agent_id].TC_simulate,
+                        consts.sim_func(node.agent[agent_id]),
                         params,
                         100,
                         SIMTRACENUM,
                         combine_seg_length=consts.init_seg_length,
                         lane_map=consts.lane_map,
+                        sim_batch_func=sim_batch_func,
                     )
                     if config.incremental:
                         cache_tube_updates.extend(cache_tube_update)
@@ -274,15 +380,14 @@ class Verifier:
                         init,
                         remain_time,
                         consts.time_step,
-                        node.agent[agent_id].TC_simulate,
+                        consts.sim_func(node.agent[agent_id]),
                         bloating_method, 
                         100,
                         sim_trace_num,
                         lane_map = consts.lane_map,
-                        traces = traces
+                        traces = traces,
+                        sim_batch_func = sim_batch_func
                     )
-                    if isinstance(cur_bloated_tube, np.ndarray):
-                        cur_bloated_tube = cur_bloated_tube.tolist()
                 elif consts.reachability_method == ReachabilityMethod.NEU_REACH:
                     # pylint: disable=E0401
                     from verse.analysis.NeuReach.NeuReach_onestep_rect import postCont
@@ -292,7 +397,7 @@ class Verifier:
                         inits[0],
                         remain_time,
                         consts.time_step,
-                        node.agent[agent_id].TC_simulate,
+                        consts.sim_func(node.agent[agent_id]),
                         consts.lane_map,
                         params,
                     )
@@ -322,10 +427,14 @@ class Verifier:
                         node.agent[agent_id],
                         consts.lane_map,
                     )
+                else:
+                    raise ValueError(
+                        f"Reachability method {consts.reachability_method} is not supported"
+                    )
                 # num_calls += 1
-                trace = np.array(cur_bloated_tube)
+                trace = np.array(cur_bloated_tube, dtype=float)
                 trace[:, 0] += node.start_time
-                node.trace[agent_id] = trace.tolist()
+                node.trace[agent_id] = trace
         # pp(("cached tubes", cached_tubes.keys()))
         new_cache, paths_to_sim = {}, []
         if old_node_id != None:
@@ -425,7 +534,10 @@ class Verifier:
                     next_node_init[agent_idx] = next_init
                 else:
                     next_node_init[agent_idx] = [
-                        [truncated_trace[agent_idx][0][1:], truncated_trace[agent_idx][1][1:]]
+                        [
+                            truncated_trace[agent_idx][0][1:].tolist(),
+                            truncated_trace[agent_idx][1][1:].tolist(),
+                        ]
                     ]
                     # pp(("infer init", agent_idx, next_node_init[agent_idx]))
                     next_node_trace[agent_idx] = truncated_trace[agent_idx]
@@ -454,6 +566,39 @@ class Verifier:
             cache_trans_tube_updates,
         )
 
+    def get_sim_cache(self) -> Optional[SimulationCache]:
+        """The simulation cache if enabled by `sim_cache_size`, resized to the current config."""
+        if self.config.sim_cache_size <= 0:
+            return None
+        self.sim_cache.max_size = self.config.sim_cache_size
+        self.sim_cache.store = open_store(self.config.cache_path)
+        return self.sim_cache
+
+    def worker_sim_cache(self, agents: Dict[str, BaseAgent], lane_map) -> Optional[SimulationCache]:
+        """The simulation cache for parallel workers. It shares the store of the driver's cache,
+        or a temporary one of their own when `cache_path` isn't set, so that workers reuse each
+        other's traces."""
+        sim_cache = self.get_sim_cache()
+        if sim_cache == None:
+            return None
+        store = sim_cache.store if sim_cache.store != None else session_store()
+        return sim_cache.worker_view(agents, lane_map, store)
+
+    def merge_queued(self, node: AnalysisTreeNode) -> bool:
+        """Drops `node` if a dequeued node with the same modes and start time already covers its
+        initial set, or merges it into a queued one if `merge_nodes` allows it. Otherwise indexes
+        it to take later nodes. Returns whether `node` was dropped or merged. The first check stops
+        the loops of nodes with the same start time that a merged initial set can keep
+        satisfying a guard with."""
+        queued, dequeued = self.merge_index.setdefault(_merge_key(node), ([], []))
+        if any(covers(other, node) for other in dequeued):
+            return True
+        for other in queued:
+            if merge_nodes(other, node, self.config.merge_tolerance):
+                return True
+        queued.append(node)
+        return False
+
     def proc_result(
         self,
         id,
@@ -471,19 +616,27 @@ class Verifier:
         done_node.child = next_nodes
         done_node.trace = traces
         done_node.assert_hits = assert_hits
+        if done_node.height <= max_height and self.merge_index != None:
+            next_nodes = [node for node in next_nodes if not self.merge_queued(node)]
+            done_node.child = next_nodes
         last_id = self.nodes[-1].id
         # print([x.id for x in self.nodes])
         for i, next_node in enumerate(next_nodes):
             next_node.id = i + 1 + last_id
+            if next_node.agent is None:
+                next_node.agent = done_node.agent
             later = 0 if i == 0 else 1
             if done_node.height <= max_height:
-                self.verification_queue.append((next_node, later))
-        self.verification_queue.sort(key=lambda p: p[1:])
+                self.verification_queue.push(next_node, later)
         if done_node.height <= max_height:
             self.nodes.extend(next_nodes)
+            self.unfinished.update(next_node.id for next_node in next_nodes)
+        self.unfinished.discard(done_node.id)
+        self.num_finished += 1
         combined_inits = {a: combine_all(inits) for a, inits in done_node.init.items()}
+        remain_time = round(self.time_horizon - done_node.start_time, 10)
         for (
-            new,
+            _,
             aid,
             transit_agents,
             transition,
@@ -491,9 +644,14 @@ class Verifier:
             run_num,
         ) in cache_trans_tube_updates:
             cached = self.trans_cache.check_hit(
-                aid, done_node.mode[aid], combine_all(done_node.init[aid]), done_node.init
+                aid,
+                done_node.mode[aid],
+                combine_all(done_node.init[aid]),
+                done_node.init,
+                remain_time,
             )
-            if new and not cached:
+            # Also adds the tubes that were hit but evicted since
+            if cached == None:
                 self.trans_cache.add_tube(
                     aid,
                     combined_inits,
@@ -502,10 +660,10 @@ class Verifier:
                     transition,
                     transition_idx,
                     run_num,
+                    remain_time,
                 )
                 self.num_cached += 1
             else:
-                assert cached != None
                 cached.transitions.extend(
                     convert_reach_trans(
                         aid, transit_agents, done_node.init, transition, transition_idx
@@ -513,9 +671,11 @@ class Verifier:
                 )
                 cached.transitions = dedup(cached.transitions, lambda i: (i.mode, i.dest, i.inits))
                 cached.node_ids.add((run_num, done_node.id))
+                self.cache_budget.update(cached)
         for agent_id, mode_label, combined_rect, cur_bloated_tube in cache_tube_updates:
             self.cache.add_tube(agent_id, mode_label, combined_rect, cur_bloated_tube)
         # print(f"proc dur {timeit.default_timer() - t}")
+        return done_node
 
     def compute_full_reachtube(
         self,
@@ -531,13 +691,116 @@ class Verifier:
         past_runs,
         params={},
     ):
+        [tree] = self.compute_full_reachtubes(
+            [root],
+            sensor,
+            time_horizon,
+            time_step,
+            max_height,
+            lane_map,
+            init_seg_length,
+            reachability_method,
+            run_num,
+            past_runs,
+            params,
+        )
+        return tree
+
+    def compute_full_reachtubes(
+        self,
+        roots: List[AnalysisTreeNode],
+        sensor,
+        time_horizon,
+        time_step,
+        max_height,
+        lane_map,
+        init_seg_length,
+        reachability_method,
+        run_num,
+        past_runs,
+        params={},
+    ) -> List[AnalysisTree]:
+        """Verifies several roots with the same agents together, sharing one queue and the
+        parallel workers. Returns one tree per root; node ids are unique across the trees."""
+        for _ in self.iter_full_reachtubes(
+            roots,
+            sensor,
+            time_horizon,
+            time_step,
+            max_height,
+            lane_map,
+            init_seg_length,
+            reachability_method,
+            run_num,
+            past_runs,
+            params,
+        ):
+            pass
+        return self.reachtube_trees
+
+    def _out_of_budget(self, roots: List[AnalysisTreeNode], start: float) -> bool:
+        if any(root.id in self.unfinished for root in roots):
+            return False
+        if self.config.node_budget != None and self.num_finished >= self.config.node_budget:
+            return True
+        if self.config.time_budget != None:
+            return time.perf_counter() - start >= self.config.time_budget
+        return False
+
+    def iter_full_reachtubes(
+        self,
+        roots: List[AnalysisTreeNode],
+        sensor,
+        time_horizon,
+        time_step,
+        max_height,
+        lane_map,
+        init_seg_length,
+        reachability_method,
+        run_num,
+        past_runs,
+        params={},
+    ) -> Iterator[AnalysisTreeNode]:
+        """Same as `compute_full_reachtubes`, but yields each node as soon as its reachtube is
+        done. Its children are already attached, but not verified yet. The trees are left in
+        `reachtube_trees` once the iteration ends, or is stopped by the caller. When `node_budget`
+        or `time_budget` runs out, the tasks in flight are finished and verification stops there;
+        the nodes not verified yet are removed from the trees, which are marked as not
+        `complete`. The roots are always verified."""
         if max_height == None:
             max_height = float("inf")
+        start = time.perf_counter()
+        stopped = False
+        self.reachtube_trees, self.reachtube_tree = [], None
 
-        self.verification_queue: List[Tuple[AnalysisTreeNode, int]] = [(root, 0)]
+        self.verification_queue = Scheduler(
+            self.config.scheduling_policy, self.config.priority_fn
+        )
+        for i, root in enumerate(roots):
+            root.id = i
+            self.verification_queue.push(root)
         self.result_refs = []
-        self.nodes = [root]
+        self.nodes = list(roots)
+        # Ids of the nodes that were queued but aren't done yet
+        self.unfinished = set(root.id for root in roots)
+        self.num_finished = 0
+        # Queued and dequeued nodes that new nodes may be merged into, by modes and start time
+        self.merge_index = None
+        if self.config.merge_tolerance != None and not self.config.incremental:
+            self.merge_index = {}
         self.num_cached = 0
+        self.time_horizon = time_horizon
+        if self.config.incremental:
+            self.cache_budget.max_bytes = self.config.cache_memory_budget
+            self.cache_budget.evict()
+            store = open_store(self.config.cache_path)
+            fingerprints = {}
+            if store != None:
+                fingerprints = {
+                    aid: store.fingerprint(agent, lane_map) for aid, agent in roots[0].agent.items()
+                }
+            bloating_method = params.get("bloating_method", "PW")
+            self.cache.bind(store, fingerprints, (time_step, bloating_method))
         num_calls = 0
         num_transitions = 0
         consts = ReachConsts(
@@ -548,132 +811,199 @@ class Verifier:
             run_num,
             past_runs,
             sensor,
-            root.agent,
+            roots[0].agent,
+            self.get_sim_cache(),
         )
+        # Steps on threads hold the z3 lock
+        exclusive = self.config.parallel and self.config.executor == ExecutorBackend.THREAD
         if self.config.parallel:
-            # import ray
-            consts_ref = ray.put(consts)
-        while True:
-            wait = False
-            if len(self.verification_queue) > 0:
-                # print([node.id for node in verification_queue])
-                node, later = self.verification_queue.pop(0)
-                # check height
-                if node.height >= max_height-1:
-                    print("max depth reached")
-                    continue
-                num_transitions += 1
-                # pp(("start ver", node.start_time, {a: (*node.mode[a], *node.init[a]) for a in node.mode}))
-                remain_time = round(time_horizon - node.start_time, 10)
-                if remain_time <= 0:
-                    continue
-                cached_trans_tubes = {}
-                cached_tubes = {}
-                for agent_id in node.agent:
-                    mode = node.mode[agent_id]
-                    inits = node.init[agent_id]
-                    combined = combine_all(inits)
-                    if self.config.incremental:
-                        # CachedRTTrans
-                        cached = self.trans_cache.check_hit(agent_id, mode, combined, node.init)
-                        if cached != None:
-                            self.trans_cache_hits = (
-                                self.trans_cache_hits[0] + 1,
-                                self.trans_cache_hits[1],
-                            )
-                        else:
-                            self.trans_cache_hits = (
-                                self.trans_cache_hits[0],
-                                self.trans_cache_hits[1] + 1,
-                            )
-                        # pp(("check hit", agent_id, mode, combined))
-                        if cached != None:
-                            cached_trans_tubes[agent_id] = cached
-                        # if incremental and DRYVR, check cache tube first
-                        if agent_id not in node.trace and reachability_method == ReachabilityMethod.DRYVR:
-                            # uncertain_param = node.uncertain_param[agent_id]
-                            # CachedTube.tube
-                            cur_bloated_tube, miss_seg_idx_list = self.check_cache_bloated_tube(
-                                agent_id, mode, inits, combine_seg_length=init_seg_length
+            executor = get_executor(self.config.executor, self.config.num_workers)
+            worker_sim_cache = self.worker_sim_cache(roots[0].agent, lane_map)
+            consts_ref = executor.put(dataclasses.replace(consts, sim_cache=worker_sim_cache))
+        # Nodes waiting to be fused into one task
+        pending = []
+        fusion = TaskFusion(self.config.fused_task_duration, 64 if self.config.task_fusion else 1)
+
+        def dispatch():
+            self.result_refs.append(
+                executor.submit(
+                    run_fused, Verifier.compute_full_reachtube_task, list(pending), consts_ref
+                )
+            )
+            pending.clear()
+
+        try:
+            while True:
+                wait = False
+                if not stopped and self._out_of_budget(roots, start):
+                    # Let the tasks in flight finish, but start no new ones
+                    stopped = True
+                    pending.clear()
+                if len(self.verification_queue) > 0 and not stopped:
+                    # print([node.id for node in verification_queue])
+                    node, later = self.verification_queue.pop()
+                    if self.merge_index:
+                        queued, dequeued = self.merge_index.get(_merge_key(node), ([], []))
+                        if any(other is node for other in queued):
+                            queued[:] = [other for other in queued if other is not node]
+                            dequeued.append(node)
+                    # check height
+                    if node.height >= max_height-1:
+                        print("max depth reached")
+                        self.unfinished.discard(node.id)
+                        continue
+                    num_transitions += 1
+                    # pp(("start ver", node.start_time, {a: (*node.mode[a], *node.init[a]) for a in node.mode}))
+                    remain_time = round(time_horizon - node.start_time, 10)
+                    if remain_time <= 0:
+                        self.unfinished.discard(node.id)
+                        continue
+                    cached_trans_tubes = {}
+                    cached_tubes = {}
+                    for agent_id in node.agent:
+                        mode = node.mode[agent_id]
+                        inits = node.init[agent_id]
+                        combined = combine_all(inits)
+                        if self.config.incremental:
+                            # CachedRTTrans
+                            cached = self.trans_cache.check_hit(
+                                agent_id, mode, combined, node.init, remain_time
                             )
-                            cached_tubes[agent_id] = (cur_bloated_tube, miss_seg_idx_list)
-                # FIXME
-                old_node_id = None
-                if len(cached_trans_tubes) == len(node.agent):
-                    all_node_ids = [s.node_ids for s in cached_trans_tubes.values()]
-                    # print('all_node_ids', all_node_ids)
-                    node_ids = list(functools.reduce(lambda a, b: a.intersection(b), all_node_ids))
-                    # print('node_ids', node_ids)
-                    if len(node_ids) > 0:
-                        old_node_id = node_ids[0]
-                    # else:
-                    #     print(f"not full {node.id}: {node_ids}, {len(cached_trans_tubes) == len(node.agent)} | {all_node_ids}")
-                if not self.config.parallel or (old_node_id != None and self.config.try_local):
-                    self.proc_result(
-                        *self.compute_full_reachtube_step(
-                            self.config,
-                            cached_trans_tubes,
-                            cached_tubes,
-                            node,
-                            old_node_id,
-                            later,
-                            remain_time,
-                            consts,
+                            if cached != None:
+                                self.trans_cache_hits = (
+                                    self.trans_cache_hits[0] + 1,
+                                    self.trans_cache_hits[1],
+                                )
+                            else:
+                                self.trans_cache_hits = (
+                                    self.trans_cache_hits[0],
+                                    self.trans_cache_hits[1] + 1,
+                                )
+                            # pp(("check hit", agent_id, mode, combined))
+                            if cached != None:
+                                cached_trans_tubes[agent_id] = cached
+                            # if incremental and DRYVR, check cache tube first
+                            if (
+                                agent_id not in node.trace
+                                and reachability_method == ReachabilityMethod.DRYVR
+                            ):
+                                # uncertain_param = node.uncertain_param[agent_id]
+                                # CachedTube.tube
+                                cached_tubes[agent_id] = self.check_cache_bloated_tube(
+                                    agent_id,
+                                    mode,
+                                    inits,
+                                    remain_time,
+                                    time_step,
+                                    combine_seg_length=init_seg_length,
+                                )
+                    # FIXME
+                    old_node_id = None
+                    if len(cached_trans_tubes) == len(node.agent):
+                        all_node_ids = [s.node_ids for s in cached_trans_tubes.values()]
+                        # print('all_node_ids', all_node_ids)
+                        node_ids = list(
+                            functools.reduce(lambda a, b: a.intersection(b), all_node_ids)
+                        )
+                        # print('node_ids', node_ids)
+                        if len(node_ids) > 0:
+                            old_node_id = node_ids[0]
+                        # else:
+                        #     print(f"not full {node.id}: {node_ids}, {len(cached_trans_tubes) == len(node.agent)} | {all_node_ids}")
+                    if not self.config.parallel or (old_node_id != None and self.config.try_local):
+                        yield self.proc_result(
+                            *self.compute_full_reachtube_step(
+                                self.config,
+                                cached_trans_tubes,
+                                cached_tubes,
+                                node,
+                                old_node_id,
+                                later,
+                                remain_time,
+                                consts,
+                                max_height,
+                                params,
+                            ),
                             max_height,
-                            params,
-                        ),
-                        max_height,
-                    )
+                        )
+                    else:
+                        pending.append(
+                            (
+                                exclusive,
+                                self.config,
+                                cached_trans_tubes,
+                                cached_tubes,
+                                node.without_agents(),
+                                old_node_id,
+                                later,
+                                remain_time,
+                                max_height,
+                                params,
+                            )
+                        )
+                        free_slots = self.config.parallel_ver_ahead - len(self.result_refs)
+                        queued = len(pending) + len(self.verification_queue)
+                        if len(pending) >= fusion.size(queued, free_slots):
+                            dispatch()
+                    if len(self.result_refs) >= self.config.parallel_ver_ahead:
+                        wait = True
+                elif len(pending) > 0:
+                    dispatch()
+                elif len(self.result_refs) > 0:
+                    wait = True
                 else:
-                    self.result_refs.append(
-                        self.compute_full_reachtube_step_remote.remote(
-                            self.config,
-                            cached_trans_tubes,
-                            cached_tubes,
-                            node,
-                            old_node_id,
+                    break
+                # print(len(verification_queue), len(result_refs))
+                if wait:
+                    res, self.result_refs = executor.wait(self.result_refs)
+                    results, duration = executor.get(res)
+                    fusion.record(duration, len(results))
+                    # TODO: may add pipelining
+                    for (
+                        id,
+                        later,
+                        next_nodes,
+                        traces,
+                        assert_hits,
+                        cache_tube_updates,
+                        cache_trans_tube_updates,
+                    ) in results:
+                        yield self.proc_result(
+                            id,
                             later,
-                            remain_time,
-                            consts_ref,
+                            next_nodes,
+                            traces,
+                            assert_hits,
+                            cache_tube_updates,
+                            cache_trans_tube_updates,
                             max_height,
-                            params,
                         )
-                    )
-                if len(self.result_refs) >= self.config.parallel_ver_ahead:
-                    wait = True
-            elif len(self.result_refs) > 0:
-                wait = True
-            else:
-                break
-            # print(len(verification_queue), len(result_refs))
-            if wait:
-                [res], self.result_refs = ray.wait(self.result_refs)
-                (
-                    id,
-                    later,
-                    next_nodes,
-                    traces,
-                    assert_hits,
-                    cache_tube_updates,
-                    cache_trans_tube_updates,
-                ) = ray.get(res)
-                # TODO: may add pipelining
-                self.proc_result(
-                    id,
-                    later,
-                    next_nodes,
-                    traces,
-                    assert_hits,
-                    cache_tube_updates,
-                    cache_trans_tube_updates,
-                    max_height,
-                )
-        self.reachtube_tree = AnalysisTree(root)
+        finally:
+            if self.config.parallel:
+                executor.release(consts_ref)
+            if consts.sim_cache is not None:
+                consts.sim_cache.flush()
+            # Also when the caller stops iterating early, with the nodes verified so far
+            self._collect_trees(roots)
+            self.num_transitions = num_transitions
         # print(f">>>>>>>> Number of calls to reachability engine: {num_calls}")
         # print(f">>>>>>>> Number of transitions happening: {num_transitions}")
-        self.num_transitions = num_transitions
 
-        return self.reachtube_tree
+        return self.reachtube_trees
+
+    def _collect_trees(self, roots: List[AnalysisTreeNode]):
+        """Sets `reachtube_trees` to the trees of `roots` without the unfinished nodes. Trees that
+        had some are marked as not `complete`."""
+        trees = []
+        for root in roots:
+            tree = AnalysisTree(root)
+            if any(node.id in self.unfinished for node in tree.nodes):
+                for node in tree.nodes:
+                    node.child = [child for child in node.child if child.id not in self.unfinished]
+                tree = AnalysisTree(root, complete=False)
+            trees.append(tree)
+        self.reachtube_trees = trees
+        self.reachtube_tree = trees[0]
 
     @staticmethod
     def get_transition_verify_opt(
@@ -739,13 +1069,15 @@ class Verifier:
                             agent, state_dict, track_map
                         )
                         reset = (path.var, path.val_veri)
-                        guard_expression = GuardExpressionAst([path.cond_veri])
-
-                        cont_var_updater = guard_expression.parse_any_all_new(
-                            cont_var_dict_template, discrete_variable_dict, length_dict
+                        compiled = guard_cache.compile(
+                            path.cond_veri,
+                            cont_var_dict_template,
+                            discrete_variable_dict,
+                            length_dict,
                         )
+                        cont_var_updater = compiled.cont_var_updater
                         Verifier.apply_cont_var_updater(cont_var_dict_template, cont_var_updater)
-                        guard_can_satisfied = guard_expression.evaluate_guard_disc(
+                        guard_can_satisfied, guard_expression = compiled.evaluate_guard_disc(
                             agent, discrete_variable_dict, cont_var_dict_template, track_map
                         )
                         if not guard_can_satisfied:
@@ -775,14 +1107,13 @@ class Verifier:
                 agent, state_dict, track_map
             )
             # TODO-PARSER: Get equivalent for this function
-            # Construct the guard expression
-            guard_expression = GuardExpressionAst([path.cond_veri])
-
-            cont_var_updater = guard_expression.parse_any_all_new(
-                cont_var_dict_template, discrete_variable_dict, length_dict
+            # Construct the guard expression, unrolled once per path and number of other agents
+            compiled = guard_cache.compile(
+                path.cond_veri, cont_var_dict_template, discrete_variable_dict, length_dict
             )
+            cont_var_updater = compiled.cont_var_updater
             Verifier.apply_cont_var_updater(cont_var_dict_template, cont_var_updater)
-            guard_can_satisfied = guard_expression.evaluate_guard_disc(
+            guard_can_satisfied, guard_expression = compiled.evaluate_guard_disc(
                 agent, discrete_variable_dict, cont_var_dict_template, track_map
             )
             if not guard_can_satisfied:
@@ -792,6 +1123,7 @@ class Verifier:
             )
 
         trace_length = int(min(len(v) for v in node.trace.values()) // 2)
+        hulls = {aid: RectHull(node.trace[aid]) for aid in node.agent}
         # pp(("trace len", trace_length, {a: len(t) for a, t in node.trace.items()}))
         guard_hits = []
         guard_hit = False
@@ -807,7 +1139,7 @@ class Verifier:
             # end_idx = min(idx+combine_len, trace_length)
             state_dict = {
                 aid: (
-                    combine_rect(node.trace[aid][idx * 2 : end_idx * 2]),
+                    hulls[aid].hull(idx, end_idx),
                     node.mode[aid],
                     node.static[aid],
                 )
@@ -836,10 +1168,13 @@ class Verifier:
                     pre_expr = a.pre
 
                     def eval_expr(expr):
-                        ge = GuardExpressionAst([copy.deepcopy(expr)])
-                        cont_var_updater = ge.parse_any_all_new(cont_vars, disc_vars, len_dict)
-                        Verifier.apply_cont_var_updater(cont_vars, cont_var_updater)
-                        sat = ge.evaluate_guard_disc(agent, disc_vars, cont_vars, track_map)
+                        compiled = guard_cache.compile(expr, cont_vars, disc_vars, len_dict)
+                        Verifier.apply_cont_var_updater(cont_vars, compiled.cont_var_updater)
+                        sat, ge = compiled.evaluate_guard_disc(
+                            agent, disc_vars, cont_vars, track_map
+                        )
+                        if sat and ge.is_hybrid():
+                            ge = copy.deepcopy(ge)
                         if sat:
                             sat = ge.evaluate_guard_hybrid(agent, disc_vars, cont_vars, track_map)
                             if sat:
@@ -880,7 +1215,9 @@ class Verifier:
                 ):
                     assert isinstance(path, ModePath)
                     new_cont_var_dict = copy.deepcopy(cont_vars)
-                    one_step_guard: GuardExpressionAst = copy.deepcopy(guard_expression)
+                    one_step_guard: GuardExpressionAst = guard_expression
+                    if guard_expression.is_hybrid():
+                        one_step_guard = copy.deepcopy(guard_expression)
 
                     Verifier.apply_cont_var_updater(new_cont_var_dict, continuous_variable_updater)
                     guard_can_satisfied = one_step_guard.evaluate_guard_hybrid(
@@ -1060,31 +1397,7 @@ class Verifier:
                         break
                 if not found:
                     raise ValueError(f"Reset continuous variable {cts_variable} not found")
-                # substituting low variables
-
-                symbols = []
-                for var in cont_var_dict:
-                    if var in expr:
-                        symbols.append(var)
-
-                # TODO: Implement this function
-                # The input to this function is a list of used symbols and the cont_var_dict
-                # The ouput of this function is a list of tuple of values for each variable in the symbols list
-                # The function will explor all possible combinations of low bound and upper bound for the variables in the symbols list
-                comb_list = Verifier._get_combinations(symbols, cont_var_dict)
-
-                lb = float("inf")
-                ub = -float("inf")
-
-                for comb in comb_list:
-                    val_dict = {}
-                    tmp = copy.deepcopy(expr)
-                    for symbol_idx, symbol in enumerate(symbols):
-                        tmp = tmp.replace(symbol, str(comb[symbol_idx]))
-                    res = eval(tmp, {}, val_dict)
-                    lb = min(lb, res)
-                    ub = max(ub, res)
-
+                lb, ub = compiled_reset(expr).image(cont_var_dict)
                 rect[0][lhs_idx] = lb
                 rect[1][lhs_idx] = ub
 
@@ -1095,14 +1408,6 @@ class Verifier:
 
         return dest, rect
 
-    @staticmethod
-    def _get_combinations(symbols, cont_var_dict):
-        data_list = []
-        for symbol in symbols:
-            data_list.append(cont_var_dict[symbol])
-        comb_list = list(itertools.product(*data_list))
-        return comb_list
-
 
 def combine_rect(trace):
     """
@@ -1119,6 +1424,111 @@ def combine_rect(trace):
     return combined_trace.tolist()
 
 
+def _merge_key(node: AnalysisTreeNode):
+    modes = tuple(sorted((aid, tuple(mode)) for aid, mode in node.mode.items()))
+    return node.partition, node.start_time, modes
+
+
+def _hull_traces(trace, other):
+    """Hull of two reachtubes over the same time steps, or None if their time steps differ"""
+    if trace.shape != other.shape or not np.array_equal(trace[:, 0], other[:, 0]):
+        return None
+    res = trace.copy()
+    res[0::2, 1:] = np.minimum(trace[0::2, 1:], other[0::2, 1:])
+    res[1::2, 1:] = np.maximum(trace[1::2, 1:], other[1::2, 1:])
+    return res
+
+
+def covers(node: AnalysisTreeNode, other: AnalysisTreeNode) -> bool:
+    """Whether the initial set of `node` contains the one of `other`"""
+    if node.static != other.static or node.uncertain_param != other.uncertain_param:
+        return False
+    for aid in node.init:
+        own = np.array(combine_all(node.init[aid]), dtype=float)
+        new = np.array(combine_all(other.init[aid]), dtype=float)
+        if np.any(new[0] < own[0]) or np.any(new[1] > own[1]):
+            return False
+    return True
+
+
+def merge_nodes(node: AnalysisTreeNode, other: AnalysisTreeNode, tolerance: float) -> bool:
+    """
+    Widens the initial set of `node` to the hull of the initial sets of `node` and `other`, if the
+    volume of the hull is at most `1 + tolerance` times the sum of their volumes. Volumes are taken
+    over the dimensions in which the hull isn't flat. Precomputed reachtubes of `node` are hulled
+    with those of `other`, or dropped to be recomputed when `other` has none.
+
+    :return: whether `other` was merged into `node`
+    """
+    if node.static != other.static or node.uncertain_param != other.uncertain_param:
+        return False
+    agents = sorted(node.init)
+    own = {aid: np.array(combine_all(node.init[aid]), dtype=float) for aid in agents}
+    new = {aid: np.array(combine_all(other.init[aid]), dtype=float) for aid in agents}
+    hull = {
+        aid: np.stack([np.minimum(own[aid][0], new[aid][0]), np.maximum(own[aid][1], new[aid][1])])
+        for aid in agents
+    }
+
+    def widths(rects):
+        return np.concatenate([rects[aid][1] - rects[aid][0] for aid in agents])
+
+    hull_widths = widths(hull)
+    spread = hull_widths > 0
+    volume = lambda w: float(np.prod(w[spread]))
+    if volume(hull_widths) > (1 + tolerance) * (volume(widths(own)) + volume(widths(new))):
+        return False
+    for aid in agents:
+        if node.init[aid] != other.init[aid]:
+            node.init[aid] = [hull[aid].tolist()]
+        if aid in node.trace:
+            merged = _hull_traces(node.trace[aid], other.trace[aid]) if aid in other.trace else None
+            if merged is None:
+                del node.trace[aid]
+            else:
+                node.trace[aid] = merged
+    return True
+
+
+class RectHull:
+    """
+    Sparse table over the rects of a reachtube, giving the rect that bounds any window of
+    consecutive rects in O(1). Level k holds the bounds of every window of 2**k rects, and a
+    window is covered by two overlapping windows of the largest level that fits in it.
+
+    :param trace: the reachtube (2d list or array of alternating lower and upper bounds)
+    """
+
+    def __init__(self, trace):
+        trace = np.asarray(trace, dtype=float)
+        rects = len(trace) // 2
+        self.lower = [trace[0 : rects * 2 : 2]]
+        self.upper = [trace[1 : rects * 2 : 2]]
+        width = 1
+        while width * 2 <= rects:
+            lower, upper = self.lower[-1], self.upper[-1]
+            self.lower.append(np.minimum(lower[:-width], lower[width:]))
+            self.upper.append(np.maximum(upper[:-width], upper[width:]))
+            width *= 2
+
+    def __len__(self) -> int:
+        return len(self.lower[0])
+
+    def hull(self, start: int, end: int):
+        """
+        Same as `combine_rect` on rects `start` to `end` (exclusive) of the reachtube
+
+        :return: the combined rect (2d list)
+        """
+        if not 0 <= start < end <= len(self):
+            raise ValueError(f"[{start}, {end}) isn't a non-empty window of the {len(self)} rects")
+        level = (end - start).bit_length() - 1
+        other = end - (1 << level)
+        lower = np.minimum(self.lower[level][start], self.lower[level][other])
+        upper = np.maximum(self.upper[level][start], self.upper[level][other])
+        return [lower.tolist(), upper.tolist()]
+
+
 def checkHeight(root, max_height):
     if root:
         # First recur on left child
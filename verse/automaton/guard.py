@@ -1,5 +1,6 @@
+from collections import OrderedDict
 from pprint import pp
-from typing import Any
+from typing import Any, Dict, Hashable, List, Tuple
 import pickle
 import ast
 
@@ -8,6 +9,7 @@ from z3 import *
 from verse.map import LaneMap, AbstractLane
 from verse.analysis.utils import *
 from verse.agents.base_agent import BaseAgent
+from verse.automaton.interval_guard import evaluate_guard_interval
 from verse.parser import Reduction, ReductionType, unparse
 
 
@@ -72,72 +74,49 @@ class ValueSubstituter(ast.NodeTransformer):
 
 
 class GuardExpressionAst:
+    path_counts = {"constant": 0, "interval": 0, "z3": 0}
+    """How many `evaluate_guard_cont` calls in this process were decided without looking at the
+    continuous variables, by interval arithmetic and by z3."""
+
+    @staticmethod
+    def reset_path_counts():
+        for path in GuardExpressionAst.path_counts:
+            GuardExpressionAst.path_counts[path] = 0
+
     def __init__(self, guard_list, guard_idx=0):
         self.ast_list = copy.deepcopy(guard_list)
-        self.cont_variables = {}
-        self.varDict = {}
         self.guard_idx = guard_idx
-
-    def _build_guard(self, guard_str, agent):
-        """
-        Build solver for current guard based on guard string
-
-        Args:
-            guard_str (str): the guard string.
-            For example:"And(v>=40-0.1*u, v-40+0.1*u<=0)"
-
-        Returns:
-            A Z3 Solver obj that check for guard.
-            A symbol index dic obj that indicates the index
-            of variables that involved in the guard.
-        """
-        cur_solver = Solver()
-        # This magic line here is because SymPy will evaluate == to be False
-        # Therefore we are not be able to get free symbols from it
-        # Thus we need to replace "==" to something else
-
-        symbols_map = {v: k for k, v in self.cont_variables.items() if k in guard_str}
-
-        for vars in reversed(self.cont_variables):
-            guard_str = guard_str.replace(vars, self.cont_variables[vars])
-        # XXX `locals` should override `globals` right?
-        cur_solver.add(
-            eval(guard_str, globals(), self.varDict)
-        )  # TODO use an object instead of `eval` a string
-        return cur_solver, symbols_map
+        self.disc_var_updater = {}
+        self._z3_expression = None
+        self._hybrid = None
+
+    def is_hybrid(self) -> bool:
+        """Whether the guard calls map functions, which `evaluate_guard_hybrid` replaces by their
+        range over the continuous variables. Other guards aren't modified by it."""
+        if self._hybrid == None:
+            self._hybrid = any(
+                isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                for root in self.ast_list
+                for node in ast.walk(root)
+            )
+        return self._hybrid
 
     def evaluate_guard_cont(self, agent, continuous_variable_dict, track_map):
-        res = False
-        is_contained = False
-
-        for cont_vars in continuous_variable_dict:
-            underscored = cont_vars.replace(".", "_")
-            self.cont_variables[cont_vars] = underscored
-            self.varDict[underscored] = Real(underscored)
-
-        z3_string = self.generate_z3_expression()
+        if self._z3_expression == None:
+            self._z3_expression = self.generate_z3_expression()
+        z3_string = self._z3_expression
         if isinstance(z3_string, bool):
+            GuardExpressionAst.path_counts["constant"] += 1
             return z3_string, z3_string
 
-        cur_solver, symbols = self._build_guard(z3_string, agent)
-        cur_solver.push()
-        for symbol in symbols:
-            start, end = continuous_variable_dict[symbols[symbol]]
-            cur_solver.add(self.varDict[symbol] >= start, self.varDict[symbol] <= end)
-        if cur_solver.check() == sat:
-            # The reachtube hits the guard
-            cur_solver.pop()
-            res = True
-
-            tmp_solver = Solver()
-            tmp_solver.add(Not(cur_solver.assertions()[0]))
-            for symbol in symbols:
-                start, end = continuous_variable_dict[symbols[symbol]]
-                tmp_solver.add(self.varDict[symbol] >= start, self.varDict[symbol] <= end)
-            if tmp_solver.check() == unsat:
-                is_contained = True
-
-        return res, is_contained
+        # Boxes and linear guards can usually be decided from the bounds alone
+        decided = evaluate_guard_interval(z3_string, continuous_variable_dict)
+        if decided != None:
+            GuardExpressionAst.path_counts["interval"] += 1
+            return decided
+
+        GuardExpressionAst.path_counts["z3"] += 1
+        return z3_guard(z3_string, continuous_variable_dict).check(continuous_variable_dict)
 
     def generate_z3_expression(self):
         """
@@ -255,6 +234,8 @@ class GuardExpressionAst:
         By doing this, all calls that need both continuous and discrete variables as input will now become only continuous
         variables. We can then handle these using what we already have for the continous variables
         """
+        self._z3_expression = None
+        self._hybrid = None
         res = True
         for i, node in enumerate(self.ast_list):
             tmp, self.ast_list[i] = self._evaluate_guard_hybrid(
@@ -564,6 +545,8 @@ class GuardExpressionAst:
         """
         Evaluate guard that involves only discrete variables.
         """
+        self._z3_expression = None
+        self._hybrid = None
         res = True
         for i, node in enumerate(self.ast_list):
             tmp, self.ast_list[i] = self._evaluate_guard_disc(
@@ -888,6 +871,8 @@ class GuardExpressionAst:
         disc_var_dict: Dict[str, float],
         len_dict: Dict[str, int],
     ) -> None:
+        self._z3_expression = None
+        self._hybrid = None
         for i in range(len(self.ast_list)):
             root = self.ast_list[i]
             j = 0
@@ -1018,6 +1003,9 @@ class GuardExpressionAst:
         disc_var_dict: Dict[str, float],
         len_dict: Dict[str, int],
     ) -> Dict[str, List[str]]:
+        self._z3_expression = None
+        self._hybrid = None
+        self.disc_var_updater = {}
         cont_var_updater = {}
         for i in range(len(self.ast_list)):
             root = self.ast_list[i]
@@ -1135,11 +1123,15 @@ class GuardExpressionAst:
                     elif variable_name in disc_var_dict:
                         variable_val = disc_var_dict[variable_name][iter_pos]
                         disc_var_dict[tmp_variable_name] = variable_val
-                        # if variable_name not in disc_var_updater:
-                        #     disc_var_updater[variable_name] = [(tmp_variable_name, iter_pos)]
-                        # else:
-                        #     if (tmp_variable_name, iter_pos) not in disc_var_updater[variable_name]:
-                        #         disc_var_updater[variable_name].append((tmp_variable_name, iter_pos))
+                        if variable_name not in self.disc_var_updater:
+                            self.disc_var_updater[variable_name] = [(tmp_variable_name, iter_pos)]
+                        else:
+                            if (tmp_variable_name, iter_pos) not in self.disc_var_updater[
+                                variable_name
+                            ]:
+                                self.disc_var_updater[variable_name].append(
+                                    (tmp_variable_name, iter_pos)
+                                )
 
             # elif isinstance(node, ast.Name):
             #     if node.id in targ_var_list:
@@ -1184,6 +1176,152 @@ class GuardExpressionAst:
         return root
 
 
+class Z3Guard:
+    """A guard string parsed into a z3 term once, so that checking it over a box of the
+    continuous variables only adds the bounds of the box."""
+
+    def __init__(self, guard_str: str, variables: List[str]):
+        cont_variables = {var: var.replace(".", "_") for var in variables}
+        self.var_dict = {underscored: Real(underscored) for underscored in cont_variables.values()}
+        self.symbols = {v: k for k, v in cont_variables.items() if k in guard_str}
+        for var in reversed(cont_variables):
+            guard_str = guard_str.replace(var, cont_variables[var])
+        # XXX `locals` should override `globals` right?
+        self.term = eval(guard_str, globals(), self.var_dict)
+
+    def check(self, continuous_variable_dict) -> Tuple[bool, bool]:
+        """Whether some point of the box given by `continuous_variable_dict` satisfies the guard
+        and whether all of them do."""
+        bounds = []
+        for symbol, var in self.symbols.items():
+            start, end = continuous_variable_dict[var]
+            bounds += [self.var_dict[symbol] >= start, self.var_dict[symbol] <= end]
+        # Fresh solvers rather than push/pop, as incremental solving gives up on nonlinear guards
+        # that the default tactics decide
+        cur_solver = Solver()
+        cur_solver.add(self.term, *bounds)
+        if cur_solver.check() != sat:
+            return False, False
+        # The reachtube hits the guard
+        tmp_solver = Solver()
+        tmp_solver.add(Not(self.term), *bounds)
+        return True, tmp_solver.check() == unsat
+
+
+_z3_guards: "OrderedDict[Hashable, Z3Guard]" = OrderedDict()
+_Z3_GUARDS_SIZE = 1024
+
+
+def z3_guard(guard_str: str, continuous_variable_dict) -> Z3Guard:
+    """The `Z3Guard` for `guard_str` over the variables of `continuous_variable_dict`, parsed on
+    first use and then kept in a bounded LRU cache."""
+    key = (guard_str, tuple(continuous_variable_dict))
+    if key not in _z3_guards:
+        _z3_guards[key] = Z3Guard(guard_str, list(continuous_variable_dict))
+        if len(_z3_guards) > _Z3_GUARDS_SIZE:
+            _z3_guards.popitem(last=False)
+    _z3_guards.move_to_end(key)
+    return _z3_guards[key]
+
+
+class CompiledGuard:
+    """A guard with its any/all unrolled for a given set of variables and number of other agents.
+    The result of `evaluate_guard_disc` is memoized on the agent, the map and the values of the
+    discrete variables, so that evaluating the guard again only has to bind the continuous
+    variables."""
+
+    def __init__(self, source: ast.expr, guard: GuardExpressionAst, cont_var_updater):
+        self.source = source
+        self.guard = guard
+        self.cont_var_updater = cont_var_updater
+        self.disc_var_updater = guard.disc_var_updater
+        self.disc_results: "OrderedDict[Hashable, Tuple[Any, GuardExpressionAst, Any]]" = (
+            OrderedDict()
+        )
+
+    def apply_disc_var_updater(self, disc_var_dict):
+        for variable in self.disc_var_updater:
+            for unrolled_variable, unrolled_variable_index in self.disc_var_updater[variable]:
+                disc_var_dict[unrolled_variable] = disc_var_dict[variable][unrolled_variable_index]
+
+    def evaluate_guard_disc(
+        self, agent, discrete_variable_dict, continuous_variable_dict, track_map
+    ) -> Tuple[Any, GuardExpressionAst]:
+        """`GuardExpressionAst.evaluate_guard_disc` on a copy of the unrolled guard, returned along
+        with the result. The returned guard is shared, so a hybrid guard must be copied before
+        calling `evaluate_guard_hybrid` on it."""
+        # The map is kept with the result, so its id isn't reused while the result is cached
+        key = (
+            agent.id,
+            id(track_map),
+            tuple((var, repr(val)) for var, val in discrete_variable_dict.items()),
+            tuple(continuous_variable_dict),
+        )
+        cached = self.disc_results.get(key)
+        if cached == None or cached[2] is not track_map:
+            guard = copy.deepcopy(self.guard)
+            res = guard.evaluate_guard_disc(
+                agent, discrete_variable_dict, continuous_variable_dict, track_map
+            )
+            self.disc_results[key] = res, guard, track_map
+            if len(self.disc_results) > GuardCache.DISC_RESULTS_SIZE:
+                self.disc_results.popitem(last=False)
+        self.disc_results.move_to_end(key)
+        res, guard, _ = self.disc_results[key]
+        return res, guard
+
+
+class GuardCache:
+    """Bounded LRU cache of `CompiledGuard`s, keyed by the guard's AST in the decision logic, the
+    continuous and discrete variables and the number of other agents it is unrolled for. Like the
+    simulation cache, the result is undefined when a decision logic is modified in place."""
+
+    DISC_RESULTS_SIZE = 64
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.cache: "OrderedDict[Hashable, CompiledGuard]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def clear(self):
+        self.cache.clear()
+
+    def compile(
+        self,
+        expr: ast.expr,
+        cont_var_dict: Dict[str, float],
+        disc_var_dict: Dict[str, float],
+        len_dict: Dict[str, int],
+    ) -> CompiledGuard:
+        """Unrolls the any/all in `expr` like `GuardExpressionAst.parse_any_all_new`, adding the
+        discrete variables of the other agents to `disc_var_dict`. The caller still has to apply
+        the returned guard's `cont_var_updater`."""
+        key = (
+            id(expr),
+            tuple(sorted(len_dict.items())),
+            tuple(cont_var_dict),
+            tuple(disc_var_dict),
+        )
+        compiled = self.cache.get(key)
+        if compiled != None and compiled.source is expr:
+            compiled.apply_disc_var_updater(disc_var_dict)
+        else:
+            guard = GuardExpressionAst([expr])
+            cont_var_updater = guard.parse_any_all_new(cont_var_dict, disc_var_dict, len_dict)
+            compiled = CompiledGuard(expr, guard, cont_var_updater)
+            self.cache[key] = compiled
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        self.cache.move_to_end(key)
+        return compiled
+
+
+guard_cache = GuardCache()
+"""The guards compiled by the verifier in this process."""
+
+
 if __name__ == "__main__":
     with open("tmp.pickle", "rb") as f:
         guard_list = pickle.load(f)
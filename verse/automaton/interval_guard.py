@@ -0,0 +1,529 @@
+"""Interval arithmetic evaluation of the guard expressions produced by
+`GuardExpressionAst.generate_z3_expression`.
+
+Every continuous variable ranges over its `[lower, upper]` bounds, and the question is the one
+`evaluate_guard_cont` asks z3: does some point of this box satisfy the guard, and do all of them?
+Arithmetic is evaluated with interval arithmetic, which over-approximates the range of an
+expression and gives its exact range when every variable occurs once. Comparisons are decided from
+these ranges and combined through `And`/`Or`/`Not` with three valued logic, with None for what
+can't be decided this way. Results within a small margin of a comparison boundary are left
+undecided, so that the decided ones agree with z3 despite floating point rounding.
+"""
+
+import ast
+import math
+from typing import Dict, List, Optional, Set, Tuple
+
+Interval = Tuple[float, float]
+Result = Tuple[Optional[bool], Optional[bool]]
+
+_MARGIN = 1e-9
+
+
+class _Undecided(Exception):
+    pass
+
+
+def _name(node: ast.AST) -> str:
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return _name(node.value) + "." + node.attr
+    raise _Undecided()
+
+
+def _mul(a: Interval, b: Interval) -> Interval:
+    products = [a[0] * b[0], a[0] * b[1], a[1] * b[0], a[1] * b[1]]
+    if any(math.isnan(p) for p in products):
+        raise _Undecided()
+    return min(products), max(products)
+
+
+def _div(a: Interval, b: Interval) -> Interval:
+    if b[0] <= 0 <= b[1]:
+        raise _Undecided()
+    quotients = [a[0] / b[0], a[0] / b[1], a[1] / b[0], a[1] / b[1]]
+    if any(math.isnan(q) for q in quotients):
+        raise _Undecided()
+    return min(quotients), max(quotients)
+
+
+def _pow(a: Interval, exp: int) -> Interval:
+    if exp == 0:
+        return 1.0, 1.0
+    lower, upper = a[0] ** exp, a[1] ** exp
+    if exp % 2 == 1 or a[0] >= 0:
+        return lower, upper
+    if a[1] <= 0:
+        return upper, lower
+    return 0.0, max(lower, upper)
+
+
+def _sin(a: Interval) -> Interval:
+    if not (math.isfinite(a[0]) and math.isfinite(a[1])):
+        raise _Undecided()
+    if a[1] - a[0] >= 2 * math.pi:
+        return -1.0, 1.0
+    lower, upper = sorted([math.sin(a[0]), math.sin(a[1])])
+    # The extremes inside the interval are at pi / 2 + 2 k pi and -pi / 2 + 2 k pi
+    if math.pi / 2 + 2 * math.pi * math.ceil((a[0] - math.pi / 2) / (2 * math.pi)) <= a[1]:
+        upper = 1.0
+    if -math.pi / 2 + 2 * math.pi * math.ceil((a[0] + math.pi / 2) / (2 * math.pi)) <= a[1]:
+        lower = -1.0
+    return lower, upper
+
+
+def _cos(a: Interval) -> Interval:
+    return _sin((a[0] + math.pi / 2, a[1] + math.pi / 2))
+
+
+def _exp(a: Interval) -> Interval:
+    try:
+        return math.exp(a[0]), math.exp(a[1])
+    except OverflowError:
+        raise _Undecided()
+
+
+def _log(a: Interval) -> Interval:
+    if a[0] <= 0:
+        raise _Undecided()
+    return math.log(a[0]), math.log(a[1])
+
+
+def _sqrt(a: Interval) -> Interval:
+    if a[0] < 0:
+        raise _Undecided()
+    return math.sqrt(a[0]), math.sqrt(a[1])
+
+
+def _abs(a: Interval) -> Interval:
+    if a[0] >= 0:
+        return a
+    if a[1] <= 0:
+        return -a[1], -a[0]
+    return 0.0, max(-a[0], a[1])
+
+
+def _neg(a: Interval) -> Interval:
+    return -a[1], -a[0]
+
+
+def _add(a: Interval, b: Interval) -> Interval:
+    return a[0] + b[0], a[1] + b[1]
+
+
+def _sub(a: Interval, b: Interval) -> Interval:
+    return a[0] - b[1], a[1] - b[0]
+
+
+def _abs_derivative(a: Interval) -> Interval:
+    if a[0] > 0:
+        return 1.0, 1.0
+    if a[1] < 0:
+        return -1.0, -1.0
+    return -1.0, 1.0
+
+
+def _sqrt_derivative(a: Interval) -> Interval:
+    if a[0] <= 0:
+        raise _Undecided()
+    return _div((1.0, 1.0), _mul((2.0, 2.0), _sqrt(a)))
+
+
+# Interval extensions of the functions a reset or guard may call, with those of their derivatives
+_FUNCTIONS = {
+    "sin": (_sin, _cos),
+    "cos": (_cos, lambda a: _neg(_sin(a))),
+    "exp": (_exp, _exp),
+    "log": (_log, lambda a: _div((1.0, 1.0), a)),
+    "sqrt": (_sqrt, _sqrt_derivative),
+    "abs": (_abs, _abs_derivative),
+}
+_MODULES = ("math", "np", "numpy")
+
+
+def _function(node: ast.Call):
+    """The interval extensions of the function `node` calls with a single argument, such as
+    `sin(x)` or `math.sin(x)`."""
+    name = _name(node.func)
+    module, _, name = name.rpartition(".")
+    if module not in ("",) + _MODULES or name not in _FUNCTIONS:
+        raise _Undecided()
+    if len(node.args) != 1 or node.keywords:
+        raise _Undecided()
+    return _FUNCTIONS[name]
+
+
+def _interval(node: ast.AST, bounds: Dict[str, Interval]) -> Interval:
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise _Undecided()
+        return float(node.value), float(node.value)
+    if isinstance(node, (ast.Name, ast.Attribute)):
+        name = _name(node)
+        if name not in bounds:
+            raise _Undecided()
+        lower, upper = bounds[name]
+        return float(lower), float(upper)
+    if isinstance(node, ast.UnaryOp):
+        value = _interval(node.operand, bounds)
+        if isinstance(node.op, ast.USub):
+            return _neg(value)
+        if isinstance(node.op, ast.UAdd):
+            return value
+        raise _Undecided()
+    if isinstance(node, ast.Call):
+        function, _ = _function(node)
+        return function(_interval(node.args[0], bounds))
+    if isinstance(node, ast.BinOp):
+        left = _interval(node.left, bounds)
+        if isinstance(node.op, ast.Pow):
+            exp = node.right
+            if not (
+                isinstance(exp, ast.Constant) and isinstance(exp.value, int) and exp.value >= 0
+            ):
+                raise _Undecided()
+            return _pow(left, exp.value)
+        right = _interval(node.right, bounds)
+        if isinstance(node.op, ast.Add):
+            return _add(left, right)
+        if isinstance(node.op, ast.Sub):
+            return _sub(left, right)
+        if isinstance(node.op, ast.Mult):
+            return _mul(left, right)
+        if isinstance(node.op, ast.Div):
+            return _div(left, right)
+    raise _Undecided()
+
+
+def _gradient(node: ast.AST, bounds: Dict[str, Interval]) -> Tuple[Interval, Dict[str, Interval]]:
+    """The range of `node` over the box given by `bounds`, with the ranges of its partial
+    derivatives in the variables it depends on, by forward mode differentiation in interval
+    arithmetic."""
+    if isinstance(node, (ast.Name, ast.Attribute)):
+        return _interval(node, bounds), {_name(node): (1.0, 1.0)}
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value, grad = _gradient(node.operand, bounds)
+        if isinstance(node.op, ast.UAdd):
+            return value, grad
+        return _neg(value), {var: _neg(d) for var, d in grad.items()}
+    if isinstance(node, ast.Call):
+        function, derivative = _function(node)
+        value, grad = _gradient(node.args[0], bounds)
+        factor = derivative(value)
+        return function(value), {var: _mul(factor, d) for var, d in grad.items()}
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+        value, grad = _gradient(node.left, bounds)
+        exp = node.right
+        if not (isinstance(exp, ast.Constant) and isinstance(exp.value, int) and exp.value >= 0):
+            raise _Undecided()
+        if exp.value == 0:
+            return (1.0, 1.0), {}
+        factor = _mul((exp.value, exp.value), _pow(value, exp.value - 1))
+        return _pow(value, exp.value), {var: _mul(factor, d) for var, d in grad.items()}
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Div)):
+        left, left_grad = _gradient(node.left, bounds)
+        right, right_grad = _gradient(node.right, bounds)
+        zero = (0.0, 0.0)
+        grad = {}
+        for var in set(left_grad) | set(right_grad):
+            dl, dr = left_grad.get(var, zero), right_grad.get(var, zero)
+            if isinstance(node.op, ast.Add):
+                grad[var] = _add(dl, dr)
+            elif isinstance(node.op, ast.Sub):
+                grad[var] = _sub(dl, dr)
+            elif isinstance(node.op, ast.Mult):
+                grad[var] = _add(_mul(dl, right), _mul(left, dr))
+            else:
+                grad[var] = _sub(_div(dl, right), _mul(_div(left, _pow(right, 2)), dr))
+        if isinstance(node.op, ast.Add):
+            return _add(left, right), grad
+        if isinstance(node.op, ast.Sub):
+            return _sub(left, right), grad
+        if isinstance(node.op, ast.Mult):
+            return _mul(left, right), grad
+        return _div(left, right), grad
+    return _interval(node, bounds), {}
+
+
+def _variables(node: ast.AST) -> List[str]:
+    """Every occurrence of a variable in `node`."""
+    if isinstance(node, (ast.Name, ast.Attribute)):
+        return [_name(node)]
+    if isinstance(node, ast.Call):
+        return [var for arg in node.args for var in _variables(arg)]
+    return [var for child in ast.iter_child_nodes(node) for var in _variables(child)]
+
+
+def expression_range(
+    node: ast.AST, bounds: Dict[str, Interval], exact: bool = True
+) -> Optional[Interval]:
+    """The range of the arithmetic expression `node` over the box given by `bounds`. Returns None
+    unless interval arithmetic gives it exactly, that is when every variable occurs once and the
+    expression only uses the operators and functions above. With `exact` False, returns the
+    over-approximation interval arithmetic gives when variables occur more than once as well."""
+    try:
+        occurrences = _variables(node)
+        if exact and len(occurrences) != len(set(occurrences)):
+            return None
+        return _interval(node, bounds)
+    except (_Undecided, TypeError, ValueError):
+        return None
+
+
+def is_monotone(node: ast.AST, bounds: Dict[str, Interval]) -> bool:
+    """Whether the arithmetic expression `node` is provably monotone in each of its variables over
+    the box given by `bounds`, in which case its extremes are at corners of the box. False when
+    this can't be shown, e.g. when a partial derivative may change sign."""
+    try:
+        _, grad = _gradient(node, bounds)
+    except (_Undecided, TypeError, ValueError):
+        return False
+    return all(lower >= 0 or upper <= 0 for lower, upper in grad.values())
+
+
+def _is_fixed(bound) -> bool:
+    try:
+        return float(bound[0]) == float(bound[1])
+    except (TypeError, ValueError, IndexError):
+        return False
+
+
+def _free_variables(node: ast.AST, bounds: Dict[str, Interval]) -> List[str]:
+    """Occurrences of the variables in `node` that aren't fixed to a single value by `bounds`."""
+    return [var for var in _variables(node) if not (var in bounds and _is_fixed(bounds[var]))]
+
+
+def _compare(op: ast.cmpop, diff: Interval, margin: float, exact: bool) -> Result:
+    """Decides `left op right` given the range of `left - right`. When the range is `exact` rather
+    than an over-approximation, a range on both sides of the boundary means some but not all points
+    satisfy the comparison."""
+    lower, upper = diff
+    above, below = lower > margin, upper < -margin
+    across = exact and lower < -margin and upper > margin
+    if isinstance(op, (ast.GtE, ast.Gt)):
+        if above or below:
+            return above, above
+    elif isinstance(op, (ast.LtE, ast.Lt)):
+        if above or below:
+            return below, below
+    elif isinstance(op, (ast.Eq, ast.NotEq)):
+        if above or below:
+            return isinstance(op, ast.NotEq), isinstance(op, ast.NotEq)
+    else:
+        return None, None
+    if across:
+        return True, False
+    return None, None
+
+
+def _all(values) -> Optional[bool]:
+    res = True
+    for value in values:
+        if value == False:
+            return False
+        if value == None:
+            res = None
+    return res
+
+
+def _any(values) -> Optional[bool]:
+    res = False
+    for value in values:
+        if value == True:
+            return True
+        if value == None:
+            res = None
+    return res
+
+
+def _disjoint(children: List[Tuple[Result, Set[str]]]) -> bool:
+    seen = set()
+    for _, variables in children:
+        if seen & variables:
+            return False
+        seen |= variables
+    return True
+
+
+def _conjunction(children: List[Tuple[Result, Set[str]]]) -> Result:
+    sat = _all(res[0] for res, _ in children)
+    contained = _all(res[1] for res, _ in children)
+    # Some point satisfies every child only if the children don't constrain the same variables
+    if sat == True and not _disjoint(children) and contained != True:
+        sat = None
+    return sat, contained
+
+
+def _disjunction(children: List[Tuple[Result, Set[str]]]) -> Result:
+    sat = _any(res[0] for res, _ in children)
+    contained = _any(res[1] for res, _ in children)
+    # Every point satisfies some child only if one child always holds, unless they share variables
+    if contained == False and not _disjoint(children):
+        contained = None
+    return sat, contained
+
+
+def _negation(res: Result) -> Result:
+    sat, contained = res
+    return (
+        None if contained == None else not contained,
+        None if sat == None else not sat,
+    )
+
+
+def _constant(node: ast.AST) -> Optional[float]:
+    try:
+        if _variables(node):
+            return None
+        lower, upper = _interval(node, {})
+    except _Undecided:
+        return None
+    return lower if lower == upper else None
+
+
+def _bound(node: ast.AST) -> Optional[Tuple[ast.AST, bool, float]]:
+    """Splits a comparison between an expression and a constant, such as `ego.x - other.x < 5`, into
+    the expression, whether the constant is a lower bound and the constant."""
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+        return None
+    op, left, right = node.ops[0], node.left, node.comparators[0]
+    if not isinstance(op, (ast.Lt, ast.LtE, ast.Gt, ast.GtE)):
+        return None
+    value = _constant(right)
+    if value != None:
+        return left, isinstance(op, (ast.Gt, ast.GtE)), value
+    value = _constant(left)
+    if value != None:
+        return right, isinstance(op, (ast.Lt, ast.LtE)), value
+    return None
+
+
+def _range_within(
+    expr: ast.AST, lower: float, upper: float, bounds: Dict[str, Interval]
+) -> Tuple[Result, Set[str]]:
+    """Decides `lower <= expr <= upper`, up to the strictness of the bounds."""
+    occurrences = _free_variables(expr, bounds)
+    variables = set(occurrences)
+    try:
+        lo, hi = _interval(expr, bounds)
+    except _Undecided:
+        return (None, None), variables
+    exact = len(occurrences) == len(variables)
+    finite = [abs(v) for v in (lo, hi, lower, upper) if math.isfinite(v)]
+    margin = _MARGIN * max([1.0] + finite)
+    if hi < lower - margin or lo > upper + margin or lower > upper + margin:
+        return (False, False), variables
+    if lo > lower + margin and hi < upper - margin:
+        return (True, True), variables
+    if exact and max(lo, lower) < min(hi, upper) - margin:
+        return (True, False), variables
+    return (None, None), variables
+
+
+def _conjunction_of(nodes: List[ast.AST], bounds: Dict[str, Interval]) -> Tuple[Result, Set[str]]:
+    """`And` of `nodes`. Bounds on the same expression, as in `-1 < ego.x - other.x < 1` written as
+    two comparisons, are decided together so that their shared variables don't prevent deciding
+    the conjunction."""
+    children, ranges = [], {}
+    for node in nodes:
+        bound = _bound(node)
+        if bound == None:
+            children.append(_truth(node, bounds))
+            continue
+        expr, is_lower, value = bound
+        key = ast.dump(expr)
+        _, lower, upper = ranges.get(key, (expr, -math.inf, math.inf))
+        if is_lower:
+            lower = max(lower, value)
+        else:
+            upper = min(upper, value)
+        ranges[key] = expr, lower, upper
+    children += [
+        _range_within(expr, lower, upper, bounds) for expr, lower, upper in ranges.values()
+    ]
+    variables = set().union(*(v for _, v in children))
+    return _conjunction(children), variables
+
+
+def _truth(node: ast.AST, bounds: Dict[str, Interval]) -> Tuple[Result, Set[str]]:
+    """Whether some point of the box satisfies `node` and whether all of them do, together with the
+    variables `node` depends on."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, bool):
+        return (node.value, node.value), set()
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        if node.func.id == "And":
+            return _conjunction_of(node.args, bounds)
+        children = [_truth(arg, bounds) for arg in node.args]
+        variables = set().union(*(v for _, v in children))
+        if node.func.id == "Or":
+            return _disjunction(children), variables
+        if node.func.id == "Not" and len(children) == 1:
+            return _negation(children[0][0]), variables
+        return (None, None), variables
+    if isinstance(node, ast.BoolOp):
+        if isinstance(node.op, ast.And):
+            return _conjunction_of(node.values, bounds)
+        children = [_truth(value, bounds) for value in node.values]
+        variables = set().union(*(v for _, v in children))
+        return _disjunction(children), variables
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        res, variables = _truth(node.operand, bounds)
+        return _negation(res), variables
+    try:
+        occurrences = _free_variables(node, bounds)
+    except _Undecided:
+        return (None, None), set()
+    variables = set(occurrences)
+    if not isinstance(node, ast.Compare):
+        return (None, None), variables
+    try:
+        values = [_interval(node.left, bounds)]
+        values += [_interval(comparator, bounds) for comparator in node.comparators]
+    except _Undecided:
+        return (None, None), variables
+    # Interval arithmetic gives the exact range when every variable occurs once
+    exact = len(node.ops) == 1 and len(occurrences) == len(variables)
+    results = []
+    for op, left, right in zip(node.ops, values, values[1:]):
+        diff = left[0] - right[1], left[1] - right[0]
+        scale = max(1.0, abs(left[0]), abs(left[1]), abs(right[0]), abs(right[1]))
+        results.append(_compare(op, diff, _MARGIN * scale, exact))
+    if len(results) == 1:
+        return results[0], variables
+    return _conjunction([(res, variables) for res in results]), variables
+
+
+def evaluate_guard_interval(expr: str, bounds: Dict[str, Interval]) -> Optional[Result]:
+    """Decides whether some point of the box given by `bounds`, a dict from variable names such as
+    `ego.x` to `[lower, upper]`, satisfies the guard `expr` and whether all of them do. Returns None
+    when interval arithmetic can't decide both."""
+    try:
+        tree = ast.parse(expr, mode="eval")
+    except SyntaxError:
+        return None
+    (sat, contained), _ = _truth(tree.body, bounds)
+    # A point of the box that satisfies the guard shows it can be satisfied, and one that violates
+    # it shows the box isn't contained
+    scalars = {}
+    for var, bound in bounds.items():
+        try:
+            scalars[var] = float(bound[0]), float(bound[1])
+        except (TypeError, ValueError, IndexError):
+            pass
+    witnesses = [
+        {var: ((lo + hi) / 2, (lo + hi) / 2) for var, (lo, hi) in scalars.items()},
+        {var: (lo, lo) for var, (lo, hi) in scalars.items()},
+        {var: (hi, hi) for var, (lo, hi) in scalars.items()},
+    ]
+    for point in witnesses:
+        if sat != None and contained != None:
+            break
+        (holds, _), _ = _truth(tree.body, point)
+        if holds == True and sat == None:
+            sat = True
+        elif holds == False and contained == None:
+            contained = False
+    if sat == None or contained == None:
+        return None
+    return sat, contained
@@ -1,9 +1,17 @@
-import itertools, copy
+import ast, itertools, copy, math
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 import numpy as np
 
+from verse.automaton.interval_guard import expression_range, is_monotone
 from verse.parser import unparse
 
 
+# Functions a reset may call, for evaluating it at the corners of a box
+_FUNCTIONS = {"math": math, "np": np, "numpy": np, "abs": abs}
+_FUNCTIONS.update({name: getattr(math, name) for name in ("sin", "cos", "exp", "log", "sqrt")})
+
+
 class ResetExpression:
     def __init__(self, reset):
         reset_var, reset_val_ast = reset
@@ -19,6 +27,99 @@ class ResetExpression:
         return self.var == o.var and self.expr == o.expr
 
 
+def _dotted(node: ast.AST) -> Optional[str]:
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        value = _dotted(node.value)
+        return None if value is None else value + "." + node.attr
+    return None
+
+
+class _Substitute(ast.NodeTransformer):
+    """Replaces the given dotted names with plain names, so that they can be bound by `eval`."""
+
+    def __init__(self, names: Dict[str, str]):
+        self.names = names
+
+    def _visit_name(self, node):
+        name = _dotted(node)
+        if name in self.names:
+            return ast.copy_location(ast.Name(id=self.names[name], ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+    visit_Name = _visit_name
+    visit_Attribute = _visit_name
+
+
+class CompiledReset:
+    """
+    A continuous reset expression, parsed once. `image` gives its range over a box of the
+    continuous variables, with interval arithmetic where that is exact. When a variable occurs more
+    than once, it takes the extremes of the values at the corners of the box if the expression is
+    provably monotone in each variable, and the over-approximation of interval arithmetic
+    otherwise.
+
+    :param expr: the right hand side of the reset
+    """
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        self.tree = ast.parse(expr, mode="eval")
+        self.names = []
+        for node in ast.walk(self.tree):
+            name = _dotted(node)
+            if name != None and name not in self.names:
+                self.names.append(name)
+        self.corner_code: Dict[Tuple[str, ...], object] = {}
+
+    def _corner_code(self, symbols: Tuple[str, ...]):
+        if symbols not in self.corner_code:
+            names = {symbol: f"_v{i}" for i, symbol in enumerate(symbols)}
+            tree = _Substitute(names).visit(copy.deepcopy(self.tree))
+            self.corner_code[symbols] = compile(ast.fix_missing_locations(tree), "<reset>", "eval")
+        return self.corner_code[symbols]
+
+    def image(self, cont_var_dict) -> Tuple[float, float]:
+        """
+        Range of the expression when each variable `v` ranges over `cont_var_dict[v]`
+
+        :return: lower and upper bound
+        """
+        symbols = tuple(name for name in self.names if name in cont_var_dict)
+        bounds = {symbol: cont_var_dict[symbol] for symbol in symbols}
+        res = expression_range(self.tree.body, bounds)
+        if res != None:
+            return res
+        if is_monotone(self.tree.body, bounds):
+            code = self._corner_code(symbols)
+            lb, ub = float("inf"), -float("inf")
+            for comb in itertools.product(*bounds.values()):
+                values = {f"_v{i}": value for i, value in enumerate(comb)}
+                res = eval(code, dict(_FUNCTIONS), values)
+                lb = min(lb, res)
+                ub = max(ub, res)
+            return lb, ub
+        res = expression_range(self.tree.body, bounds, exact=False)
+        if res == None:
+            raise ValueError(f"Can't bound the reset {self.expr} over {bounds}")
+        return res
+
+
+_compiled_resets: "OrderedDict[str, CompiledReset]" = OrderedDict()
+_COMPILED_RESETS_SIZE = 1024
+
+
+def compiled_reset(expr: str) -> CompiledReset:
+    """The `CompiledReset` for `expr`, parsed on first use and then kept in a bounded LRU cache."""
+    if expr not in _compiled_resets:
+        _compiled_resets[expr] = CompiledReset(expr)
+        if len(_compiled_resets) > _COMPILED_RESETS_SIZE:
+            _compiled_resets.popitem(last=False)
+    _compiled_resets.move_to_end(expr)
+    return _compiled_resets[expr]
+
+
 # class ResetExpression:
 #     def __init__(self, reset_list):
 #         self.ast_list = []
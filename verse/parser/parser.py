@@ -184,6 +184,9 @@ class CompiledAssert:
     cond: Any  # FIXME type for compiled python (`code`?)
     label: str
     pre: Any
+    # The expressions `cond` and `pre` were compiled from
+    cond_sim: Optional[ast.expr] = field(default=None, compare=False)
+    pre_sim: Optional[ast.expr] = field(default=None, compare=False)
 
 
 @dataclass
@@ -302,6 +305,7 @@ class ModePath:
     var: str
     val: Any
     val_veri: ast.expr
+    cond_sim: Optional[ast.expr] = None  # The expression `cond` was compiled from
 
     def __eq__(self, other: "ModePath") -> bool:
         if other == None:
@@ -385,12 +389,10 @@ class ControllerIR:
         # for a in asserts_veri:
         #     # print(a)
         #     print(ControllerIR.dump(a.pre), ControllerIR.dump(a.cond, True))
-        asserts_sim = [
-            CompiledAssert(
-                compile_expr(Env.trans_args(c, False)), l, compile_expr(Env.trans_args(p, False))
-            )
-            for c, l, p in asserts
-        ]
+        asserts_sim = []
+        for c, l, p in asserts:
+            c, p = Env.trans_args(c, False), Env.trans_args(p, False)
+            asserts_sim.append(CompiledAssert(compile_expr(c), l, compile_expr(p), c, p))
 
         assert isinstance(controller, Lambda)
         paths = []
@@ -404,9 +406,11 @@ class ControllerIR:
                     cond = merge_conds(case.cond)
                     cond_veri = Env.trans_args(copy.deepcopy(cond), True)
                     val_veri = Env.trans_args(copy.deepcopy(case.val), True)
-                    cond = compile_expr(Env.trans_args(cond, False))
+                    cond_sim = Env.trans_args(cond, False)
                     val = compile_expr(Env.trans_args(case.val, False))
-                    paths.append(ModePath(cond, cond_veri, var, val, val_veri))
+                    paths.append(
+                        ModePath(compile_expr(cond_sim), cond_veri, var, val, val_veri, cond_sim)
+                    )
         return ControllerIR(
             controller.args,
             paths,
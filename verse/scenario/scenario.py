@@ -1,4 +1,4 @@
-from typing import Tuple, List, Dict
+from typing import Callable, Iterator, Tuple, List, Dict, Optional
 import copy
 from dataclasses import dataclass
 import numpy as np
@@ -6,6 +6,8 @@ import numpy as np
 from verse.agents.base_agent import BaseAgent
 from verse.analysis import Simulator, Verifier, AnalysisTreeNode, AnalysisTree, ReachabilityMethod
 from verse.analysis.analysis_tree import AnalysisTreeNodeType
+from verse.analysis.executor import ExecutorBackend, get_executor
+from verse.analysis.scheduler import SchedulingPolicy
 from verse.analysis.utils import sample_rect
 from verse.parser.parser import ControllerIR
 from verse.sensor.base_sensor import BaseSensor
@@ -14,12 +16,75 @@ from verse.map.lane_map import LaneMap
 EGO, OTHERS = "ego", "others"
 
 
-def _check_ray_init(parallel: bool) -> None:
-    if parallel:
-        import ray
-
-        if not ray.is_initialized():
-            ray.init()
+def _start_executor(config: "ScenarioConfig") -> None:
+    if config.parallel:
+        get_executor(config.executor, config.num_workers)
+
+
+def _tube_widths(tree: AnalysisTree) -> Dict[str, np.ndarray]:
+    """Largest width of each agent's reachtubes in each state dimension over the tree."""
+    widths = {}
+    for node in tree.nodes:
+        for aid, trace in node.trace.items():
+            trace = np.asarray(trace, dtype=float)
+            if len(trace) < 2:
+                continue
+            width = np.max(trace[1::2, 1:] - trace[::2, 1:], axis=0)
+            widths[aid] = np.maximum(widths[aid], width) if aid in widths else width
+    return widths
+
+
+def _bisect_init(init: Dict[str, list], tree: AnalysisTree) -> Optional[List[Dict[str, list]]]:
+    """Splits the initial set `init`, verified as `tree`, in two along the most sensitive dimension:
+    the one whose reachtube width grows the most relative to its initial width. Returns None when
+    every initial set is a point."""
+    widths = _tube_widths(tree)
+    best, best_growth = None, 0.0
+    for aid, (lower, upper) in init.items():
+        if aid not in widths:
+            continue
+        for dim, (lo, hi) in enumerate(zip(lower, upper)):
+            if hi > lo and dim < len(widths[aid]):
+                growth = widths[aid][dim] / (hi - lo)
+                if best == None or growth > best_growth:
+                    best, best_growth = (aid, dim), growth
+    if best == None:
+        return None
+    aid, dim = best
+    lower, upper = list(init[aid][0]), list(init[aid][1])
+    mid = (lower[dim] + upper[dim]) / 2
+    left_upper, right_lower = list(upper), list(lower)
+    left_upper[dim], right_lower[dim] = mid, mid
+    return [{**init, aid: [lower, left_upper]}, {**init, aid: [right_lower, upper]}]
+
+
+def _merge_partitions(init: Dict[str, list], trees: List[AnalysisTree]) -> AnalysisTree:
+    """Merges the trees verified from the parts of the initial set `init` into one tree. Its root
+    holds the initial set and the part trees are its children, with `partition` set to their
+    index and heights and ids renumbered."""
+    first = trees[0].root
+    root = AnalysisTreeNode.root_from_inits(
+        init={aid: [rect] for aid, rect in init.items()},
+        mode=first.mode,
+        static=first.static,
+        uncertain_param=first.uncertain_param,
+        agent=first.agent,
+        ndigits=first.ndigits,
+        type=first.type,
+    )
+    root.trace = {
+        aid: np.array([[first.start_time, *lower], [first.start_time, *upper]], dtype=float)
+        for aid, (lower, upper) in init.items()
+    }
+    root.child = [tree.root for tree in trees]
+    for i, tree in enumerate(trees):
+        for node in tree.nodes:
+            node.partition = i
+            node.height += 1
+    tree = AnalysisTree(root, all(tree.complete for tree in trees))
+    for i, node in enumerate(tree.nodes):
+        node.id = i
+    return tree
 
 
 @dataclass(frozen=True)
@@ -40,11 +105,97 @@ class ScenarioConfig:
     parallel_ver_ahead: int = 8
     """The number of verification tasks to dispatch before waiting."""
     parallel: bool = True
-    """Enable parallelization. Uses the Ray library. Could be slower for small scenarios."""
+    """Enable parallelization. Uses the backend selected by `executor`. Could be slower for small
+    scenarios."""
+    executor: ExecutorBackend = ExecutorBackend.RAY
+    """Backend that runs the parallel tasks. Can be RAY, PROCESS, THREAD and INLINE. The process and
+    thread pools start much faster than Ray and are usually better on a single machine."""
+    num_workers: Optional[int] = None
+    """Number of workers of the executor. Defaults to the backend's own default, usually the number
+    of CPUs."""
+    task_fusion: bool = True
+    """Fuse several queued nodes into one parallel task when nodes are quick to process, so that
+    scheduling and serialization overheads are paid once per batch."""
+    fused_task_duration: float = 0.05
+    """Target runtime in seconds of a fused task, used with the measured per node runtime to size
+    the batches."""
     try_local: bool = False
     """Heuristic. When enabled, try to use the local thread when some results are cached."""
     print_level: int = 1
     """Adjust print_level from 0 - 2 to print different information."""
+    batch_simulate: bool = False
+    """Advance all initial conditions of `simulate_multi` together, simulating agents that share a
+    mode in one `TC_simulate_batch` call. Only applies to an explicit `init_dict_list`, and is
+    ignored when `incremental` is enabled."""
+    batch_sample: bool = False
+    """Simulate the sample traces of the DryVR reachability methods in one `TC_simulate_batch`
+    call per tube, instead of one `TC_simulate` call per sample. Only faster for agents that
+    override `TC_simulate_batch` with a vectorized implementation."""
+    vectorize_guards: bool = True
+    """Check the guards and asserts of a simulation over whole trace segments with NumPy to find
+    where the first transition can happen. Only used with the default sensor; falls back to checking
+    every timestep when a guard can't be vectorized."""
+    stream_simulate: bool = False
+    """Simulate with `TC_simulate_stream` and stop integrating once a guard can fire, instead of
+    always simulating to the time horizon. Ignored when `incremental` is enabled."""
+    stream_chunk_size: int = 50
+    """Number of trace rows requested from each agent at a time when `stream_simulate` is
+    enabled."""
+    event_location: bool = False
+    """When a guard starts firing between two time steps of a simulation, bisect that step on the
+    agent dynamics and start the next node at the located event time instead of the next step."""
+    event_tolerance: float = 1e-6
+    """Width of the time interval the bisection of `event_location` stops at."""
+    scheduling_policy: SchedulingPolicy = SchedulingPolicy.DEFAULT
+    """Order in which simulation/verification explores the tree. Can be DEFAULT, BFS, DFS,
+    EARLIEST_START and PRIORITY."""
+    priority_fn: Optional[Callable[[AnalysisTreeNode], float]] = None
+    """Priority of a node for the PRIORITY scheduling policy. Nodes with lower values go first."""
+    refine_budget: int = 0
+    """Number of times `verify` may bisect an initial set to tighten the result. A part of the
+    initial set is bisected when its reachtubes hit an assert or get wider than `refine_width`,
+    along the dimension whose width grows the most from the initial set. The parts of each round
+    are verified together and merged into one tree, whose nodes record their `partition`. 0
+    disables refinement. Ignored when `incremental` is enabled."""
+    refine_width: Optional[float] = None
+    """Reachtube width in any state dimension above which `refine_budget` bisects the initial set.
+    When None, only assert hits are refined."""
+    merge_tolerance: Optional[float] = None
+    """Lets verification merge a new node into a queued node with the same modes and start time,
+    verifying both from the hull of their initial sets, when the volume of the hull is at most
+    `1 + merge_tolerance` times the sum of their volumes. 0 only merges nodes whose hull adds no
+    volume, such as duplicates; larger values trade precision for smaller trees. None disables
+    merging. Ignored when `incremental` is enabled."""
+    node_budget: Optional[int] = None
+    """Number of nodes verification may compute before it stops, returning a partial tree that
+    isn't `complete`. The root is always computed. None for no limit."""
+    time_budget: Optional[float] = None
+    """Wall clock time in seconds after which verification stops, returning a partial tree that
+    isn't `complete`. The root and the tasks already started are finished first. None for no
+    limit."""
+    sim_cache_size: int = 0
+    """Number of `TC_simulate` traces to keep in an LRU cache keyed by agent, mode, initial point
+    and time step, so that repeated simulations (e.g. the samples of DryVR bloating) are reused
+    within and across runs. Longer cached traces also answer shorter horizons. 0 disables the
+    cache; only enable it for agents with deterministic dynamics."""
+    cache_path: Optional[str] = None
+    """Path of a SQLite database that keeps the traces of the `sim_cache_size` cache and, with
+    `incremental`, the DryVR tubes of verification, so that they are reused after restarts and by
+    other processes using the same file. Entries are keyed by a fingerprint of the agent dynamics
+    (the source of the agent classes and their modules, their class-level attributes, and the
+    attributes of the agent other than the decision logic) and of the map; the decision logic may
+    change between runs. None keeps the caches in memory only."""
+    cache_memory_budget: Optional[int] = None
+    """Approximate number of bytes that the incremental caches of the simulator, and those of the
+    verifier, may each hold. Once over, the least recently used entries are evicted; the count is
+    kept in `cache_budget.evictions`. None for no limit."""
+    horizon_reuse: bool = False
+    """With `incremental`, also reuse traces and DryVR tubes cached for nodes with a different
+    remaining time. They are cut to a shorter horizon, or continued from their last state or box
+    to a longer one. The results then aren't those of a fresh run: a continued trace differs by
+    the integration error, which can move a transition by a time step, and cut or continued tubes
+    are looser. Off by default, in which case only results over the same remaining time, which
+    match, are reused."""
 
 
 class Scenario:
@@ -214,7 +365,7 @@ class Scenario:
             `seed`: the random seed for sampling a point in the region specified by the initial
             conditions
         '''
-        _check_ray_init(self.config.parallel)
+        _start_executor(self.config)
         self._get_init_from_agent()
         self._check_init()
         root = AnalysisTreeNode.root_from_inits(
@@ -247,39 +398,56 @@ class Scenario:
             `seed`: the random seed for sampling a point in the region specified by the initial
             conditions
         '''
-        _check_ray_init(self.config.parallel)
+        _start_executor(self.config)
         self._get_init_from_agent()
         self._check_init()
-        tree_list = []
         if init_dict_list is None:
-            for i in range(10):
-                tree_list.append(self.simulate(time_horizon, time_step, max_height, seed))
-        else:
-            for init_dict in init_dict_list:
-                root = AnalysisTreeNode.root_from_inits(
-                    init=init_dict,
-                    mode={
-                        aid: tuple(elem if isinstance(elem, str) else elem.name for elem in modes)
-                        for aid, modes in self.init_mode_dict.items()
-                    },
-                    static={aid: [elem.name for elem in modes] for aid, modes in self.static_dict.items()},
-                    uncertain_param=self.uncertain_param_dict,
-                    agent=self.agent_dict,
-                    type=AnalysisTreeNodeType.SIM_TRACE,
-                    ndigits=10,
-                )
-                tree = self.simulator.simulate(
-                    root,
-                    self.sensor,
-                    time_horizon,
-                    time_step,
-                    max_height,
-                    self.map,
-                    len(self.past_runs),
-                    self.past_runs,
-                )
-                self.past_runs.append(tree)
-                tree_list.append(tree)            
+            # Sampled run by run, so that a seed gives the same traces as before batching
+            return [self.simulate(time_horizon, time_step, max_height, seed) for _ in range(10)]
+        roots = [
+            AnalysisTreeNode.root_from_inits(
+                init=init_dict,
+                mode={
+                    aid: tuple(elem if isinstance(elem, str) else elem.name for elem in modes)
+                    for aid, modes in self.init_mode_dict.items()
+                },
+                static={
+                    aid: [elem.name for elem in modes] for aid, modes in self.static_dict.items()
+                },
+                uncertain_param=self.uncertain_param_dict,
+                agent=self.agent_dict,
+                type=AnalysisTreeNodeType.SIM_TRACE,
+                ndigits=10,
+            )
+            for init_dict in init_dict_list
+        ]
+        if self.config.batch_simulate and not self.config.incremental:
+            tree_list = self.simulator.simulate_batch(
+                roots,
+                self.sensor,
+                time_horizon,
+                time_step,
+                max_height,
+                self.map,
+                len(self.past_runs),
+                self.past_runs,
+            )
+            self.past_runs.extend(tree_list)
+            return tree_list
+        tree_list = []
+        for root in roots:
+            tree = self.simulator.simulate(
+                root,
+                self.sensor,
+                time_horizon,
+                time_step,
+                max_height,
+                self.map,
+                len(self.past_runs),
+                self.past_runs,
+            )
+            self.past_runs.append(tree)
+            tree_list.append(tree)
         return tree_list
 
     def simulate_simple(self, time_horizon, time_step, max_height=None, seed=None) -> AnalysisTree:
@@ -316,28 +484,25 @@ class Scenario:
         self.past_runs.append(tree)
         return tree
 
-    def verify(self, time_horizon, time_step, max_height=None, params={}) -> AnalysisTree:
-        '''Compute the set of reachable states, starting from a set of initial states states.'''
-        _check_ray_init(self.config.parallel)
+    def _verify_init(self) -> Dict[str, list]:
+        _start_executor(self.config)
         self._check_init()
-        root = AnalysisTreeNode.root_from_inits(
-            init={
-                aid: [[init, init] if np.array(init).ndim < 2 else init]
-                for aid, init in self.init_dict.items()
-            },
-            mode={
-                aid: tuple(elem if isinstance(elem, str) else elem.name for elem in modes)
-                for aid, modes in self.init_mode_dict.items()
-            },
-            static={aid: [elem.name for elem in modes] for aid, modes in self.static_dict.items()},
-            uncertain_param=self.uncertain_param_dict,
-            agent=self.agent_dict,
-            type=AnalysisTreeNodeType.REACH_TUBE,
-            ndigits=10,
-        )
-
-        tree = self.verifier.compute_full_reachtube(
-            root,
+        return {
+            aid: [init, init] if np.array(init).ndim < 2 else init
+            for aid, init in self.init_dict.items()
+        }
+
+    def verify_iter(
+        self, time_horizon, time_step, max_height=None, params={}
+    ) -> Iterator[AnalysisTreeNode]:
+        '''Same as `verify`, but yields each node of the tree as soon as its reachtube is done, so
+        that results can be checked or plotted while verification runs. The tree is appended to
+        `past_runs` once the iteration ends. When the iterator is closed early, e.g. by breaking
+        out of a loop over it, the nodes verified so far are kept in `past_runs` and
+        `verifier.reachtube_tree` as a tree that isn't `complete`. `refine_budget` isn't
+        applied.'''
+        nodes = self.verifier.iter_full_reachtubes(
+            [self._reach_root(self._verify_init())],
             self.sensor,
             time_horizon,
             time_step,
@@ -349,9 +514,96 @@ class Scenario:
             self.past_runs,
             params,
         )
+        try:
+            yield from nodes
+        finally:
+            if self.verifier.reachtube_tree != None:
+                self.past_runs.append(self.verifier.reachtube_tree)
+
+    def verify(self, time_horizon, time_step, max_height=None, params={}) -> AnalysisTree:
+        '''Compute the set of reachable states, starting from a set of initial states states.'''
+        init = self._verify_init()
+        if self.config.refine_budget > 0 and not self.config.incremental:
+            tree = self._verify_refined(init, time_horizon, time_step, max_height, params)
+        else:
+            tree = self.verifier.compute_full_reachtube(
+                self._reach_root(init),
+                self.sensor,
+                time_horizon,
+                time_step,
+                max_height,
+                self.map,
+                self.config.init_seg_length,
+                self.config.reachability_method,
+                len(self.past_runs),
+                self.past_runs,
+                params,
+            )
         self.past_runs.append(tree)
         return tree
 
+    def _reach_root(self, init: Dict[str, list]) -> AnalysisTreeNode:
+        return AnalysisTreeNode.root_from_inits(
+            init={aid: [rect] for aid, rect in init.items()},
+            mode={
+                aid: tuple(elem if isinstance(elem, str) else elem.name for elem in modes)
+                for aid, modes in self.init_mode_dict.items()
+            },
+            static={aid: [elem.name for elem in modes] for aid, modes in self.static_dict.items()},
+            uncertain_param=self.uncertain_param_dict,
+            agent=self.agent_dict,
+            type=AnalysisTreeNodeType.REACH_TUBE,
+            ndigits=10,
+        )
+
+    def _needs_refinement(self, tree: AnalysisTree) -> bool:
+        if any(node.assert_hits for node in tree.nodes):
+            return True
+        if self.config.refine_width == None:
+            return False
+        return any(np.max(w) > self.config.refine_width for w in _tube_widths(tree).values())
+
+    def _verify_refined(
+        self, init: Dict[str, list], time_horizon, time_step, max_height, params
+    ) -> AnalysisTree:
+        '''`verify` with the initial set bisected until every part is verified without needing
+        refinement or `refine_budget` bisections were made.'''
+        budget = self.config.refine_budget
+        # Parts are keyed by the halves taken to reach them, which orders them spatially
+        pending, done = [((), init)], []
+        while pending:
+            trees = self.verifier.compute_full_reachtubes(
+                [self._reach_root(part) for _, part in pending],
+                self.sensor,
+                time_horizon,
+                time_step,
+                max_height,
+                self.map,
+                self.config.init_seg_length,
+                self.config.reachability_method,
+                len(self.past_runs),
+                self.past_runs,
+                params,
+            )
+            refined = []
+            # Parts that ran out of node_budget or time_budget aren't worth refining
+            if not all(tree.complete for tree in trees):
+                budget = 0
+            for (key, part), tree in zip(pending, trees):
+                halves = None
+                if budget > 0 and self._needs_refinement(tree):
+                    halves = _bisect_init(part, tree)
+                if halves == None:
+                    done.append((key, tree))
+                else:
+                    budget -= 1
+                    refined += [(key + (i,), half) for i, half in enumerate(halves)]
+            pending = refined
+        done.sort(key=lambda p: p[0])
+        if len(done) == 1:
+            return done[0][1]
+        return _merge_partitions(init, [tree for _, tree in done])
+
 
 @dataclass
 class ExprConfig:
@@ -399,6 +651,7 @@ class Benchmark:
     run_time: float
     cache_size: float
     cache_hits: Tuple[int, int]
+    cache_evictions: int
     leaves: int
     _start_time: float
     parallelness: float
@@ -430,24 +683,27 @@ class Benchmark:
         if self.config.sim:
             self.cache_size = asizeof.asizeof(self.scenario.simulator.cache) / 1_000_000
             self.cache_hits = self.scenario.simulator.cache_hits
+            self.cache_evictions = self.scenario.simulator.cache_budget.evictions
         else:
+            # Together, as the caches share their budget
             self.cache_size = (
-                asizeof.asizeof(self.scenario.verifier.cache)
-                + asizeof.asizeof(self.scenario.verifier.trans_cache)
-            ) / 1_000_000
+                asizeof.asizeof(self.scenario.verifier.cache, self.scenario.verifier.trans_cache)
+                / 1_000_000
+            )
             self.cache_hits = (
                 self.scenario.verifier.tube_cache_hits[0]
                 + self.scenario.verifier.trans_cache_hits[0],
                 self.scenario.verifier.tube_cache_hits[1]
                 + self.scenario.verifier.trans_cache_hits[1],
             )
+            self.cache_evictions = self.scenario.verifier.cache_budget.evictions
         self.num_agent = len(self.scenario.agent_dict)
         self.map_name = self.scenario.map.__class__.__name__
         if self.map_name == "LaneMap":
             self.map_name = "N/A"
         self.num_nodes = len(self.traces.nodes)
         self.leaves = self.traces.leaves()
-        if self.config.config.parallel:
+        if self.config.config.parallel and self.config.config.executor == ExecutorBackend.RAY:
             import ray
 
             parallel_time = (
@@ -494,7 +750,7 @@ class Benchmark:
         print("#leaves:", self.leaves)
         print(f"run time: {self.run_time:.2f}s")
         print(f"timesteps: {self.timesteps}s")
-        if self.config.config.parallel:
+        if self.config.config.parallel and self.config.config.executor == ExecutorBackend.RAY:
             print(f"parallelness: {self.parallelness:.2f}")
         if self.config.config.incremental:
             print(f"cache size: {self.cache_size:.2f}MB")
@@ -502,6 +758,15 @@ class Benchmark:
             print(
                 f"cache hit rate: {self.cache_hits[0] / (self.cache_hits[0] + self.cache_hits[1]) * 100:.2f}%"
             )
+            print(f"cache evictions: {self.cache_evictions}")
+        if self.config.config.sim_cache_size > 0:
+            sim_cache = (
+                self.scenario.simulator.sim_cache
+                if self.config.sim
+                else self.scenario.verifier.sim_cache
+            )
+            print(f"sim cache hit: {sim_cache.hits}")
+            print(f"sim cache hit rate: {sim_cache.hit_rate * 100:.2f}%")
 
     def swap_dl(self, id: str, alt_ctlr: str):
         self.scenario.agent_dict[id].decision_logic = ControllerIR.parse(fn=alt_ctlr)